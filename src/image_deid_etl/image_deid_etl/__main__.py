@@ -2,24 +2,47 @@ import argparse
 import json
 import logging.config
 import os
+import shutil
+import signal
+import socket
 import sys
 import tempfile
+import threading
+import time
+from functools import lru_cache
 from glob import glob
 
 import boto3
 import flywheel
-from sqlalchemy.exc import IntegrityError
 
-from image_deid_etl.custom_etl import delete_acquisitions_by_modality, delete_sessions
 from image_deid_etl.custom_flywheel import inject_sidecar_metadata
 from image_deid_etl.database import (
+    LeaseHeartbeat,
+    claim_next_study,
+    claim_study,
     create_schema,
+    enqueue_studies,
+    fail_abandoned_studies,
     import_uuids_from_set,
-    get_all_processed_uuids,
+    get_changes_cursor,
+    get_unprocessed_uuids,
+    set_changes_cursor,
+    update_study_jobs,
 )
 from image_deid_etl.exceptions import ImproperlyConfigured
+from image_deid_etl.filters import delete_excluded_acquisitions
+from image_deid_etl.header_index import build_header_index
+from image_deid_etl.sidecars import SIDECAR_CACHE
 from image_deid_etl.main_pipeline import validate_info, run_deid
-from image_deid_etl.orthanc import get_orthanc_url, get_uuids, download_unpack_copy
+from image_deid_etl.restructure import manifest_projects, rename_project
+from image_deid_etl.orthanc import (
+    all_study_uuids,
+    get_orthanc_url,
+    get_last_change,
+    get_stable_study_changes,
+    download_unpack_copy,
+    log_latency_reports,
+)
 
 ENVIRONMENT = os.getenv("IMAGE_DEID_ETL_ENV", "Development")
 VALID_ENVIRONMENTS = ("Production", "Staging", "Development")
@@ -95,6 +118,21 @@ logging.config.dictConfig(LOGGING)
 logger = logging.getLogger(__name__)
 
 
+def get_worker_id() -> str:
+    """Identify this process as the owner of study claims."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    aws_batch_job_id = os.getenv("AWS_BATCH_JOB_ID")
+    if aws_batch_job_id:
+        worker_id = f"{aws_batch_job_id}/{worker_id}"
+    return worker_id
+
+
+@lru_cache(maxsize=None)
+def get_flywheel_client() -> flywheel.Client:
+    """Return a Flywheel client shared by every study this process handles."""
+    return flywheel.Client(api_key=FLYWHEEL_API_KEY)
+
+
 def initdb(args) -> int:
     logger.info("Initializing database schema...")
     create_schema()
@@ -109,22 +147,58 @@ def import_uuids(args) -> int:
     file.
     """
     try:
-        uuids_to_import = json.load(args.uuid_file)
-        import_uuids_from_set(uuids_to_import)
-        logger.info("Imported %d new UUIDs.", len(uuids_to_import))
+        uuids_to_import = json.load(args.file)
+        inserted, skipped = import_uuids_from_set(uuids_to_import, args.chunk_size)
+        logger.info(
+            "Imported %d new UUIDs; skipped %d already processed UUIDs.",
+            inserted,
+            skipped,
+        )
         return 0
     except Exception as e:
-        logger.error("Error: %r\nAre you trying to import already processed UUIDs?", e)
+        logger.error("Error: %r", e)
         return 1
 
 
 def check(args) -> int:
-    new_uuids, _, _ = get_uuids(get_orthanc_url(), get_all_processed_uuids(), "all")
+    orthanc_url = get_orthanc_url()
+    cursor = get_changes_cursor()
+
+    if args.full or cursor is None:
+        # Full reconciliation: diff every study on the instance against the
+        # database. Read the change log position first, so that nothing that
+        # arrives while listing studies is skipped by the next incremental run.
+        logger.info("Reconciling all studies on Orthanc...")
+        last_seq = get_last_change(orthanc_url)
+        new_uuids = list(get_unprocessed_uuids(all_study_uuids(orthanc_url)))
+
+        # There is no guarantee that these UUIDs will be in any particular order,
+        # only that they are unprocessed.
+        if args.limit and len(new_uuids) > args.limit:
+            new_uuids = new_uuids[: args.limit]
+            # Leave the cursor alone so that the remainder is found again.
+            last_seq = cursor
+    else:
+        # Incremental discovery: only studies that became stable since the last
+        # change we consumed.
+        changed, last_seq = get_stable_study_changes(orthanc_url, cursor)
+        unprocessed = set(get_unprocessed_uuids(changed))
+        candidates = sorted(
+            (seq, uuid) for uuid, seq in changed.items() if uuid in unprocessed
+        )
+        new_uuids = [uuid for _, uuid in candidates]
+
+        # Oldest changes first. Only advance the cursor past what is returned.
+        if args.limit and len(new_uuids) > args.limit:
+            last_seq = candidates[args.limit - 1][0]
+            new_uuids = new_uuids[: args.limit]
 
-    # There is no guarantee that these UUIDs will be in any particular order,
-    # only that they are unprocessed.
-    if args.limit:
-        new_uuids = new_uuids[: args.limit]
+    # Queue what was found, so workers can claim it, and surface studies whose
+    # worker died on their last attempt.
+    enqueue_studies(new_uuids)
+    fail_abandoned_studies()
+    if last_seq is not None:
+        set_changes_cursor(last_seq)
 
     if args.raw:
         print(*new_uuids, sep="\n")
@@ -135,11 +209,13 @@ def check(args) -> int:
             # Useful for local development. Allows you to mark all new studies as
             # processed, so the ETL doesn't try to process anything.
             if args.mark_processed:
-                import_uuids_from_set(set(new_uuids))
-                logger.info('Marked %d new studies as "processed."', len(new_uuids))
+                inserted, _ = import_uuids_from_set(new_uuids)
+                logger.info('Marked %d new studies as "processed."', inserted)
         else:
             logger.info("No new UUIDs found on Orthanc.")
 
+    log_latency_reports()
+
     return 0
 
 
@@ -194,25 +270,171 @@ def run(args) -> int:
 
         rollbar.events.add_payload_handler(payload_handler)
 
+    # Claim each study, so that a second job launched on the same UUID backs
+    # off instead of processing it again.
+    owner = get_worker_id()
+    uuids = []
+    for uuid in args.uuid:
+        if claim_study(uuid, owner, force=args.force):
+            uuids.append(uuid)
+        else:
+            logger.warning(
+                "Skipping study %s: it is claimed by another worker, already processed, "
+                "or out of attempts. Use --force to reprocess it.",
+                uuid,
+            )
+    if not uuids:
+        return 0
+
+    try:
+        with LeaseHeartbeat(uuids, owner):
+            process_studies(args, uuids, owner)
+    except BaseException as error:
+        update_study_jobs(uuids, owner, "failed", error=repr(error))
+        raise
+
+    log_latency_reports()
+
+    return 0
+
+
+# Per-study outputs under {program}/{site}/ that are reviewed after the run
+# (quarantined acquisitions and the missing-ID/-session reports), so they
+# outlive a worker's temporary workspace.
+KEPT_OUTPUT_DIRS = ("NIfTIs_short_json", "NIfTIs_to_check", "files")
+
+
+def _keep_outputs(workspace_site: str, site: str) -> None:
+    """
+    Move KEPT_OUTPUT_DIRS from a study's workspace into the persistent site
+    directory, renaming (not overwriting) files that are already there.
+    """
+    for name in KEPT_OUTPUT_DIRS:
+        source_dir = os.path.join(workspace_site, name)
+        kept = 0
+        for root, _, files in os.walk(source_dir):
+            for file_name in files:
+                target = os.path.normpath(os.path.join(site, name, os.path.relpath(root, source_dir), file_name))
+                stem, ext = os.path.splitext(target)
+                if target.endswith(".nii.gz"):
+                    stem, ext = target[: -len(".nii.gz")], ".nii.gz"
+                copy_num = 1
+                while os.path.exists(target):
+                    target = f"{stem}_{copy_num}{ext}"
+                    copy_num += 1
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(os.path.join(root, file_name), target)
+                kept += 1
+        if kept:
+            logger.info("Kept %d files to check in: %s", kept, os.path.join(site, name))
+
+
+def worker(args) -> int:
+    """
+    Repeatedly claim the next queued study and run the pipeline on it, in one
+    long-lived process that keeps its imports, database and HTTP connection
+    pools, and caches warm between studies.
+
+    SIGTERM or SIGINT let the current study finish before exiting. The worker
+    also exits after --max-studies studies or --max-runtime seconds, so that
+    it can be recycled.
+
+    Each study runs in a temporary workspace under --workspace-root, which is
+    removed afterwards except for the outputs in KEPT_OUTPUT_DIRS; those are
+    moved to {program}/{site}/ under --workspace-root.
+    """
+    owner = get_worker_id()
+    workspace_root = os.path.abspath(args.workspace_root)
+    site = os.path.join(workspace_root, args.program, args.site)
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Received signal %d; stopping after the current study.", signum)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    current = {"uuid": None}
+    if not DEBUG:
+        # Include the UUID currently being processed in the Rollbar payload.
+        def payload_handler(payload):
+            payload["data"]["custom"] = {"uuid": current["uuid"]}
+            return payload
+
+        rollbar.events.add_payload_handler(payload_handler)
+
+    started = time.monotonic()
+    processed = 0
+    logger.info("Worker %s started.", owner)
+    while not stop.is_set():
+        if args.max_studies and processed >= args.max_studies:
+            logger.info("Processed %d studies; recycling worker.", processed)
+            break
+        if args.max_runtime and time.monotonic() - started >= args.max_runtime:
+            logger.info("Ran for %d seconds; recycling worker.", args.max_runtime)
+            break
+
+        uuid = claim_next_study(owner)
+        if uuid is None:
+            if args.exit_when_idle:
+                logger.info("No studies left to claim.")
+                break
+            stop.wait(args.poll_interval)
+            continue
+
+        current["uuid"] = uuid
+        logger.info("Claimed study %s.", uuid)
+        # Every study gets a fresh workspace; the pipeline assumes it is the
+        # only study under {program}/{site}/. It is created under the root
+        # (rather than in /tmp) so that kept outputs are moved, not copied.
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(prefix=".image-deid-etl-", dir=workspace_root) as workspace:
+            os.chdir(workspace)
+            try:
+                with LeaseHeartbeat([uuid], owner):
+                    process_studies(args, [uuid], owner)
+            except (Exception, SystemExit) as error:
+                # Parts of the pipeline call sys.exit() on bad input; that
+                # should fail the study, not the worker.
+                logger.exception("Failed to process study %s.", uuid)
+                update_study_jobs([uuid], owner, "failed", error=repr(error))
+            finally:
+                os.chdir(cwd)
+                _keep_outputs(os.path.join(workspace, args.program, args.site), site)
+        processed += 1
+        current["uuid"] = None
+
+    log_latency_reports()
+    logger.info("Worker %s exiting after %d studies.", owner, processed)
+
+    return 0
+
+
+def process_studies(args, uuids, owner) -> None:
+    """Run the ETL on studies claimed by owner, recording each stage in study_jobs."""
     local_path = f"{args.program}/{args.site}/"
+    # Sidecars cached for an earlier study are never read again.
+    SIDECAR_CACHE.clear()
 
-    for uuid in args.uuid:
+    update_study_jobs(uuids, owner, "downloading")
+    for uuid in uuids:
         download_unpack_copy(
             get_orthanc_url(),
             uuid,
             local_path + "DICOMs/",
             args.skip_modalities,
+            stream=not args.download_to_disk,
+            series_workers=args.series_workers,
         )
 
-    # Remove any acquisitions/sessions that we don't want to process.
-    delete_acquisitions_by_modality(local_path + "DICOMs/", "OT") # other
-    delete_acquisitions_by_modality(local_path + "DICOMs/", "SR") # SR Document
-    delete_acquisitions_by_modality(local_path + "DICOMs/", "XA") # X-Ray Angiography
-    delete_acquisitions_by_modality(local_path + "DICOMs/", "US") # ultrasound
+    # Read every DICOM header once; later stages query the index instead of
+    # re-reading the files.
+    build_header_index(local_path + "DICOMs/", args.scan_workers).close()
 
-    # Delete any "script" sessions
-    delete_sessions(local_path + "DICOMs/", "script")
-    delete_sessions(local_path + "DICOMs/", "Bone Scan")
+    # Remove any acquisitions/sessions that we don't want to process, but that
+    # slipped through the pre-download filter (e.g., a mislabeled series).
+    delete_excluded_acquisitions(local_path + "DICOMs/")
 
     # if there are no DICOMs to process, then exit
     if len(glob(local_path + "DICOMs/*/*/*")) == 0: # checks if there are any acquisition dir's
@@ -220,7 +442,10 @@ def run(args) -> int:
     else:
         # Run conversion, de-id, quarantine suspicious files, and restructure output for upload.
         logger.info("Commencing de-identification process...")
-        missing_ses_flag, missing_subj_id_flag = run_deid(local_path, args.program)
+        update_study_jobs(uuids, owner, "converting")
+        missing_ses_flag, missing_subj_id_flag = run_deid(
+            local_path, args.program, args.convert_workers
+        )
 
         if missing_ses_flag:
             raise AttributeError(
@@ -233,6 +458,7 @@ def run(args) -> int:
             )
             sys.exit(1)
         else:
+            update_study_jobs(uuids, owner, "uploading")
             logger.info('Updating target Flywheel project with version info...')
             change_fw_proj_version(args, 'v2')
 
@@ -248,17 +474,15 @@ def run(args) -> int:
             if os.path.exists(local_path + "NIfTIs_short_json/"):
                 logger.info("There are files to check in: " + local_path + "NIfTIs_short_json/")
 
-    try:
-        logger.info("Updating list of UUIDs...")
-        import_uuids_from_set(args.uuid)
-    except IntegrityError as error:
-        logger.error(
-            "Unable to mark %d UUID(s) as processed. The UUID(s) already exist in the database: %r",
-            len(args.uuid),
-            error,
+    logger.info("Updating list of UUIDs...")
+    finished = update_study_jobs(uuids, owner, "done")
+    if finished != len(uuids):
+        logger.warning(
+            "Lost the claim on %d of %d UUID(s) before finishing; another worker may have taken over.",
+            len(uuids) - finished,
+            len(uuids),
         )
 
-    return 0
 
 def change_fw_proj_version(args, ver_label) -> int:
     from image_deid_etl.custom_flywheel import confirm_proj_exists
@@ -269,18 +493,17 @@ def change_fw_proj_version(args, ver_label) -> int:
             f"ERROR AT change_fw_proj_version: {source_path} directory does not exist. Is sub_mapping empty?"
         )
 
-    # change local directory names appropriately
+    # change local directory names appropriately (& in the restructuring manifest, which the upload reads)
     logger.info('Appending version number to target Flywheel project label')
-    fw_proj_dirs = glob(source_path+'*')
-    for proj_path in fw_proj_dirs:
-        fw_proj_label = proj_path.split('/')[-1]
-        new_label = fw_proj_label+'_'+ver_label
-        new_path = os.path.join(source_path, new_label)
-        os.rename(proj_path, new_path)
+    fw_proj_labels = manifest_projects(source_path)
+    if fw_proj_labels is None:
+        fw_proj_labels = [proj_path.split('/')[-1] for proj_path in glob(source_path+'*')]
+    for fw_proj_label in fw_proj_labels:
+        if os.path.isdir(os.path.join(source_path, fw_proj_label)):
+            rename_project(source_path, fw_proj_label, fw_proj_label+'_'+ver_label)
 
     # make sure the project exists on the Flywheel instance (if not, create a new project)
-    fw_client = flywheel.Client(api_key=FLYWHEEL_API_KEY)
-    confirm_proj_exists(fw_client, FLYWHEEL_GROUP, source_path)
+    confirm_proj_exists(get_flywheel_client(), FLYWHEEL_GROUP, source_path)
 
 def upload2fw(args) -> int:
     # This is a hack so that the Flywheel CLI can consume credentials from the
@@ -302,8 +525,16 @@ def upload2fw(args) -> int:
                 f"ERROR AT upload2fw: {source_path} directory does not exist. Is sub_mapping empty?"
             )
 
-        for fw_project in next(os.walk(source_path))[1]:  # for each project dir
+        # Upload the projects the restructuring manifest moved acquisitions into;
+        # without one (e.g., a tree structured by an older version), every project dir.
+        fw_projects = manifest_projects(source_path)
+        if fw_projects is None:
+            logger.warning("No restructuring manifest for %s; uploading every project directory.", source_path)
+            fw_projects = next(os.walk(source_path))[1]
+        for fw_project in fw_projects:  # for each project dir
             proj_path = os.path.join(source_path, fw_project)
+            if not os.path.isdir(proj_path):  # e.g., every acquisition was moved to NIfTIs_to_check/
+                continue
             os.system(
                 f"fw ingest folder --no-audit-log --group {FLYWHEEL_GROUP} --project {fw_project} --skip-existing -y --quiet {proj_path}"
             )
@@ -313,9 +544,7 @@ def upload2fw(args) -> int:
 def add_fw_metadata(args) -> int:
     local_path = f"{args.program}/{args.site}/"
 
-    fw_client = flywheel.Client(FLYWHEEL_API_KEY)
-
-    inject_sidecar_metadata(fw_client, FLYWHEEL_GROUP, local_path + "NIfTIs/")
+    inject_sidecar_metadata(get_flywheel_client(), FLYWHEEL_GROUP, local_path + "NIfTIs/")
 
     return 0
 
@@ -329,6 +558,46 @@ def s3_backup_niftis(args) -> int:
     return os.system("aws s3 sync " + local_path + "NIfTIs/ " + s3_path + "NIfTIs/")
 
 
+def benchmark_fetch(args) -> int:
+    from image_deid_etl.benchmarks import benchmark_fetch
+
+    benchmark_fetch(get_orthanc_url(), args.uuid, args.workers)
+
+    return 0
+
+
+def benchmark_scan(args) -> int:
+    from image_deid_etl.benchmarks import benchmark_scan
+
+    benchmark_scan(args.data_dir, args.workers)
+
+    return 0
+
+
+def benchmark_sniff(args) -> int:
+    from image_deid_etl.benchmarks import benchmark_sniff
+
+    benchmark_sniff(args.data_dir, args.workers)
+
+    return 0
+
+
+def benchmark_montage(args) -> int:
+    from image_deid_etl.benchmarks import benchmark_montage
+
+    benchmark_montage(args.data_dir)
+
+    return 0
+
+
+def benchmark_session_labels(args) -> int:
+    from image_deid_etl.benchmarks import benchmark_session_labels
+
+    benchmark_session_labels(args.rows)
+
+    return 0
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="A WIP tool to assist with reading DICOM images from Orthanc, conversion to anonymized NIfTI "
@@ -361,6 +630,12 @@ def main() -> int:
         type=argparse.FileType("r"),
         help="JSON file containing Orthanc UUIDs to process",
     )
+    parser_import_uuids.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="number of UUIDs to insert per statement",
+    )
     parser_import_uuids.set_defaults(func=import_uuids)
 
     parser_check = subparsers.add_parser("check")
@@ -370,6 +645,11 @@ def main() -> int:
         type=int,
         help="only use the last NUM UUIDs, instead of all UUIDs",
     )
+    parser_check.add_argument(
+        "--full",
+        action="store_true",
+        help="reconcile every study on Orthanc instead of reading new changes since the last check",
+    )
     parser_check.add_argument(
         "--mark-processed",
         action="store_true",
@@ -386,9 +666,42 @@ def main() -> int:
     parser_validate = subparsers.add_parser("validate", help="check sub/ses mapping")
     parser_validate.set_defaults(func=validate)
 
+    # Options shared by every command that runs the ETL pipeline.
+    pipeline_options = argparse.ArgumentParser(add_help=False)
+    pipeline_options.add_argument(
+        "--skip-modalities",
+        nargs="*",
+        default=["DX", "US"],
+        help="space-delimited list of modalities to skip",
+    )
+    pipeline_options.add_argument(
+        "--download-to-disk",
+        action="store_true",
+        help="save each study archive to disk before extracting it, resuming partial downloads, instead of extracting while streaming",
+    )
+    pipeline_options.add_argument(
+        "--series-workers",
+        type=int,
+        default=0,
+        help="fetch each study's series concurrently with this many threads (0 downloads a single study archive)",
+    )
+    pipeline_options.add_argument(
+        "--scan-workers",
+        type=int,
+        default=0,
+        help="read DICOM headers with this many processes (0 sizes the pool to the CPU quota)",
+    )
+    pipeline_options.add_argument(
+        "--convert-workers",
+        type=int,
+        default=0,
+        help="run this many dcm2niix conversions at a time (0 sizes the pool to the CPU quota)",
+    )
+
     parser_run = subparsers.add_parser(
         "run",
         help="download images and run deidentification",
+        parents=[pipeline_options],
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser_run.add_argument(
@@ -397,16 +710,52 @@ def main() -> int:
         help="skip local processing and submit job(s) to AWS Batch",
     )
     parser_run.add_argument(
-        "--skip-modalities",
-        nargs="*",
-        default=["DX", "US"],
-        help="space-delimited list of modalities to skip",
+        "--force",
+        action="store_true",
+        help="reprocess studies that are already processed or out of attempts",
     )
     parser_run.add_argument(
         "uuid", nargs="+", help="space-delimited list of UUIDs to process"
     )
     parser_run.set_defaults(func=run)
 
+    parser_worker = subparsers.add_parser(
+        "worker",
+        help="stay resident and process studies claimed from the database queue",
+        parents=[pipeline_options],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_worker.add_argument(
+        "--max-studies",
+        type=int,
+        default=0,
+        help="exit after processing this many studies (0 for no limit)",
+    )
+    parser_worker.add_argument(
+        "--max-runtime",
+        type=int,
+        default=0,
+        help="stop claiming new studies after this many seconds (0 for no limit)",
+    )
+    parser_worker.add_argument(
+        "--poll-interval",
+        type=int,
+        default=60,
+        help="seconds to wait before polling an empty queue again",
+    )
+    parser_worker.add_argument(
+        "--workspace-root",
+        default=os.getcwd(),
+        help="directory for per-study workspaces; quarantined files and reports are kept "
+        "under {program}/{site}/ here",
+    )
+    parser_worker.add_argument(
+        "--exit-when-idle",
+        action="store_true",
+        help="exit instead of polling when the queue is empty",
+    )
+    parser_worker.set_defaults(func=worker)
+
     parser_upload2fw = subparsers.add_parser(
         "upload2fw",
         help="upload results to Flywheel, when complete",
@@ -423,6 +772,81 @@ def main() -> int:
     )
     parser_s3_backup_niftis.set_defaults(func=s3_backup_niftis)
 
+    parser_benchmark = subparsers.add_parser(
+        "benchmark", help="compare the performance of alternative engines"
+    )
+    parser_benchmark.set_defaults(func=lambda x: parser_benchmark.print_usage())
+    benchmark_subparsers = parser_benchmark.add_subparsers()
+
+    parser_benchmark_fetch = benchmark_subparsers.add_parser(
+        "fetch",
+        help="time single-archive against series-parallel study downloads",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_benchmark_fetch.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        help="space-delimited list of series worker counts to try",
+    )
+    parser_benchmark_fetch.add_argument("uuid", help="Orthanc UUID of the study to fetch")
+    parser_benchmark_fetch.set_defaults(func=benchmark_fetch)
+
+    parser_benchmark_scan = benchmark_subparsers.add_parser(
+        "scan",
+        help="time serial against process-pool DICOM header scans",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_benchmark_scan.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        help="space-delimited list of scan worker counts to try",
+    )
+    parser_benchmark_scan.add_argument(
+        "data_dir", help="directory of DICOM files (e.g., cbtn/site/DICOMs/)"
+    )
+    parser_benchmark_scan.set_defaults(func=benchmark_scan)
+
+    parser_benchmark_sniff = benchmark_subparsers.add_parser(
+        "sniff",
+        help="time libmagic against the built-in DICOM sniffer on an external site's files",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_benchmark_sniff.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[2, 4, 8],
+        help="space-delimited list of sniffer worker counts to try",
+    )
+    parser_benchmark_sniff.add_argument(
+        "data_dir", help="directory of files received from a site (e.g., cbtn/site/)"
+    )
+    parser_benchmark_sniff.set_defaults(func=benchmark_sniff)
+
+    parser_benchmark_montage = benchmark_subparsers.add_parser(
+        "montage",
+        help="compare the peak memory of whole-volume and sliced NIfTI montage rendering",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_benchmark_montage.add_argument(
+        "data_dir", help="directory of NIfTI files (e.g., cbtn/site/NIfTIs/)"
+    )
+    parser_benchmark_montage.set_defaults(func=benchmark_montage)
+
+    parser_benchmark_session_labels = benchmark_subparsers.add_parser(
+        "session-labels",
+        help="time vectorized session labeling on synthetic sessions",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_benchmark_session_labels.add_argument(
+        "--rows", type=int, default=100000, help="number of synthetic sessions to label"
+    )
+    parser_benchmark_session_labels.set_defaults(func=benchmark_session_labels)
+
     args = parser.parse_args()
     return args.func(args)
 
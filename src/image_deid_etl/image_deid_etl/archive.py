@@ -0,0 +1,248 @@
+import os
+import struct
+import zipfile
+import zlib
+from typing import Iterable
+
+# Size of the pieces read from the network and fed to the decompressor.
+CHUNK_SIZE = 1024 * 1024
+
+LOCAL_FILE_HEADER = b"PK\x03\x04"
+CENTRAL_DIRECTORY_HEADER = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = b"PK\x05\x06"
+ZIP64_END_OF_CENTRAL_DIRECTORY = b"PK\x06\x06"
+DATA_DESCRIPTOR = b"PK\x07\x08"
+
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT (section 4.3.7)
+LOCAL_FILE_HEADER_FORMAT = "<HHHHHIIIHH"
+LOCAL_FILE_HEADER_SIZE = struct.calcsize(LOCAL_FILE_HEADER_FORMAT)
+
+FLAG_DATA_DESCRIPTOR = 0x08
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_SENTINEL = 0xFFFFFFFF
+
+
+class ChunkReader:
+    """
+    Exposes an iterable of byte chunks (e.g., requests' iter_content) as a
+    forward-only reader, counting every byte that passes through it.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+        self.bytes_received = 0
+
+    def _fill(self, size: int) -> None:
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return
+            self.bytes_received += len(chunk)
+            self._buffer += chunk
+
+    def read(self, size: int) -> bytes:
+        """Return up to size bytes; fewer only at the end of the stream."""
+        self._fill(size)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exact(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) != size:
+            raise zipfile.BadZipFile(
+                f"Archive ended early: expected {size} bytes, got {len(data)}."
+            )
+        return data
+
+    def unread(self, data: bytes) -> None:
+        """Push bytes consumed past the end of a member back onto the stream."""
+        self._buffer[:0] = data
+
+    def drain(self) -> None:
+        """Consume the rest of the stream (e.g., the central directory)."""
+        self._buffer.clear()
+        for chunk in self._chunks:
+            self.bytes_received += len(chunk)
+
+
+def _safe_path(data_dir: str, name: str) -> str:
+    path = os.path.normpath(os.path.join(data_dir, name))
+    if os.path.commonpath([os.path.abspath(data_dir), os.path.abspath(path)]) != os.path.abspath(data_dir):
+        raise zipfile.BadZipFile(f"Refusing to extract {name!r} outside of {data_dir}.")
+    return path
+
+
+def _is_zip64(extra: bytes) -> bool:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            return True
+        offset += 4 + size
+    return False
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, uncompressed_size: int) -> tuple[int, int]:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from("<HH", extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            fields = extra[offset + 4:offset + 4 + size]
+            position = 0
+            # Only the sizes that overflowed are present, in this order.
+            if uncompressed_size == ZIP64_SENTINEL:
+                (uncompressed_size,) = struct.unpack_from("<Q", fields, position)
+                position += 8
+            if compressed_size == ZIP64_SENTINEL:
+                (compressed_size,) = struct.unpack_from("<Q", fields, position)
+            break
+        offset += 4 + size
+    return compressed_size, uncompressed_size
+
+
+def _extract_member(reader: ChunkReader, data_dir: str) -> int:
+    """Extract the member whose local header signature was just consumed."""
+    (
+        _version,
+        flags,
+        method,
+        _mtime,
+        _mdate,
+        crc,
+        compressed_size,
+        uncompressed_size,
+        name_length,
+        extra_length,
+    ) = struct.unpack(LOCAL_FILE_HEADER_FORMAT, reader.read_exact(LOCAL_FILE_HEADER_SIZE))
+    name = reader.read_exact(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+    extra = reader.read_exact(extra_length)
+    has_descriptor = bool(flags & FLAG_DATA_DESCRIPTOR)
+    zip64 = _is_zip64(extra)
+    if not has_descriptor:
+        compressed_size, uncompressed_size = _zip64_sizes(
+            extra, compressed_size, uncompressed_size
+        )
+
+    if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipFile(f"Unsupported compression method {method} for {name!r}.")
+    if has_descriptor and method == zipfile.ZIP_STORED:
+        # Without a size up front there is no way to find the end of a stored
+        # member in a stream.
+        raise zipfile.BadZipFile(f"Cannot stream stored member {name!r} with a data descriptor.")
+
+    path = _safe_path(data_dir, name)
+    if name.endswith("/"):
+        # Directory entries carry no data, but may still hold a compressed
+        # empty payload that has to be consumed.
+        os.makedirs(path, exist_ok=True)
+        outfile = None
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        outfile = open(path, "wb")
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else None
+    actual_crc = 0
+    written = 0
+    remaining = compressed_size
+    try:
+        while True:
+            if has_descriptor:
+                data = reader.read(CHUNK_SIZE)
+                if not data:
+                    raise zipfile.BadZipFile(f"Archive ended inside {name!r}.")
+            else:
+                if remaining == 0:
+                    break
+                data = reader.read_exact(min(CHUNK_SIZE, remaining))
+                remaining -= len(data)
+            if decompressor:
+                data_out = decompressor.decompress(data)
+            else:
+                data_out = data
+            if outfile:
+                outfile.write(data_out)
+            actual_crc = zlib.crc32(data_out, actual_crc)
+            written += len(data_out)
+            if decompressor and decompressor.eof:
+                reader.unread(decompressor.unused_data)
+                break
+    finally:
+        if outfile:
+            outfile.close()
+
+    if has_descriptor:
+        descriptor = reader.read_exact(4)
+        if descriptor == DATA_DESCRIPTOR:
+            descriptor = reader.read_exact(4)
+        (crc,) = struct.unpack("<I", descriptor)
+        size_format = "<QQ" if zip64 else "<II"
+        _, uncompressed_size = struct.unpack(
+            size_format, reader.read_exact(struct.calcsize(size_format))
+        )
+
+    if actual_crc != crc:
+        raise zipfile.BadZipFile(f"CRC mismatch for {name!r}.")
+    if written != uncompressed_size:
+        raise zipfile.BadZipFile(
+            f"Size mismatch for {name!r}: expected {uncompressed_size}, wrote {written}."
+        )
+    return written
+
+
+def extract_zip_stream(chunks: Iterable[bytes], data_dir: str) -> dict:
+    """
+    Extract a ZIP archive into data_dir while it is still arriving.
+
+    Walks the local file headers in order, so no copy of the archive is ever
+    written to disk. Every member's CRC-32 and size are verified against its
+    header (or trailing data descriptor). Returns the number of members and
+    the compressed/uncompressed byte counts.
+    """
+    reader = ChunkReader(chunks)
+    members = 0
+    bytes_written = 0
+    while True:
+        signature = reader.read(4)
+        if signature == LOCAL_FILE_HEADER:
+            bytes_written += _extract_member(reader, data_dir)
+            members += 1
+        elif signature in (
+            CENTRAL_DIRECTORY_HEADER,
+            ZIP64_END_OF_CENTRAL_DIRECTORY,
+            END_OF_CENTRAL_DIRECTORY,
+        ):
+            reader.drain()
+            break
+        elif not signature and members:
+            break
+        else:
+            raise zipfile.BadZipFile(f"Unexpected record signature {signature!r}.")
+
+    return {
+        "members": members,
+        "bytes_received": reader.bytes_received,
+        "bytes_written": bytes_written,
+    }
+
+
+def verify_zip_file(path: str, expected_size: int = None) -> bool:
+    """
+    Cheaply check that a ZIP archive on disk is complete.
+
+    Confirms the file has the expected size (when known), that its central
+    directory can be read, and that every member's data fits before the
+    central directory. Member CRCs are checked later, during extraction.
+    """
+    if expected_size is not None and os.path.getsize(path) != expected_size:
+        return False
+    try:
+        with zipfile.ZipFile(path) as zip_ref:
+            return all(
+                member.header_offset + LOCAL_FILE_HEADER_SIZE + 4 + member.compress_size
+                <= zip_ref.start_dir
+                for member in zip_ref.infolist()
+            )
+    except (zipfile.BadZipFile, OSError):
+        return False
@@ -0,0 +1,315 @@
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas
+
+logger = logging.getLogger(__name__)
+
+
+def count_files(data_dir: str) -> int:
+    return sum(len(files) for _, _, files in os.walk(data_dir))
+
+
+def log_results(title: str, results: list[dict]) -> None:
+    logger.info(title)
+    for result in results:
+        logger.info("  %s", ", ".join(f"{key}={value}" for key, value in result.items()))
+
+
+def benchmark_fetch(orthanc_url: str, uuid: str, workers: list[int]) -> list[dict]:
+    """
+    Time the single-archive download of a study against the series-parallel
+    engine at each worker count. Every run extracts into its own scratch
+    directory, which is removed afterwards.
+    """
+    from image_deid_etl.orthanc import (
+        fetch_study_series_parallel,
+        get_series_metadata,
+        stream_unpack_study,
+    )
+
+    series = get_series_metadata(orthanc_url, uuid)
+    results = []
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        run_dir = os.path.join(scratch_dir, "archive") + "/"
+        os.makedirs(run_dir)
+        report = stream_unpack_study(orthanc_url, uuid, run_dir)
+        results.append(
+            {
+                "engine": "study archive",
+                "seconds": round(report["seconds"], 2),
+                "MB/s": round(report["bytes_received"] / 1e6 / report["seconds"], 1),
+                "files": count_files(run_dir),
+            }
+        )
+
+        for worker_count in workers:
+            run_dir = os.path.join(scratch_dir, f"series-{worker_count}") + "/"
+            os.makedirs(run_dir)
+            report = fetch_study_series_parallel(
+                orthanc_url, uuid, run_dir, series, worker_count
+            )
+            results.append(
+                {
+                    "engine": f"series x{worker_count}",
+                    "seconds": round(report["seconds"], 2),
+                    "MB/s": round(report["bytes_received"] / 1e6 / report["seconds"], 1),
+                    "files": count_files(run_dir),
+                }
+            )
+
+    log_results(f"Fetching study {uuid} ({len(series)} series):", results)
+    return results
+
+
+def benchmark_scan(data_dir: str, workers: list[int]) -> list[dict]:
+    """
+    Time reading the header of every file under data_dir serially against the
+    process-pool scanner at each worker count, checking that every scan
+    returns exactly the serial result.
+    """
+    from image_deid_etl.dicom_tags import available_cpus, scan_dicom_headers
+
+    paths = sorted(
+        os.path.join(root, file) for root, _, files in os.walk(data_dir) for file in files
+    )
+    results = []
+    baseline = None
+    for worker_count in [1] + workers:
+        start = time.perf_counter()
+        headers = scan_dicom_headers(paths, worker_count, skip_invalid=True)
+        seconds = time.perf_counter() - start
+        if baseline is None:
+            baseline = headers
+        results.append(
+            {
+                "engine": "serial" if worker_count == 1 else f"processes x{worker_count}",
+                "seconds": round(seconds, 2),
+                "files/s": round(len(paths) / seconds, 1) if seconds else None,
+                "identical": headers == baseline,
+            }
+        )
+
+    log_results(
+        f"Scanning {len(paths)} files under {data_dir} ({available_cpus()} CPUs available):",
+        results,
+    )
+    return results
+
+
+def _libmagic_dicom_header(path: str):
+    # The check structure_dicom_files used before sniff_dicom_header, and the
+    # second open of the file that followed it.
+    import magic
+
+    from image_deid_etl.dicom_tags import read_dicom_header
+
+    if magic.from_file(path) == "DICOM medical imaging data":
+        return read_dicom_header(path)
+    return None
+
+
+def benchmark_sniff(data_dir: str, workers: list[int]) -> list[dict]:
+    """
+    Time detecting the DICOMs among every file under data_dir (e.g., an
+    external site's drop) and reading their headers, with libmagic (when
+    python-magic is installed) against sniff_dicom_header, serially and with
+    the process-pool scanner at each worker count. Each sniffer run is checked
+    against the serial one, and against libmagic on the files libmagic
+    recognizes.
+    """
+    from image_deid_etl.dicom_tags import HeaderScanner, available_cpus
+
+    paths = sorted(
+        os.path.join(root, file) for root, _, files in os.walk(data_dir) for file in files
+    )
+    results = []
+    try:
+        import magic  # noqa: F401
+    except ImportError:
+        logger.warning("python-magic isn't installed; skipping the libmagic baseline.")
+        expected = None
+    else:
+        start = time.perf_counter()
+        expected = [_libmagic_dicom_header(path) for path in paths]
+        seconds = time.perf_counter() - start
+        results.append(
+            {
+                "engine": "libmagic",
+                "seconds": round(seconds, 2),
+                "files/s": round(len(paths) / seconds, 1) if seconds else None,
+                "dicoms": sum(1 for header in expected if header is not None),
+            }
+        )
+
+    baseline = None
+    for worker_count in [1] + workers:
+        start = time.perf_counter()
+        with HeaderScanner(worker_count) as scanner:
+            headers = scanner.sniff(paths)
+        seconds = time.perf_counter() - start
+        if baseline is None:
+            baseline = headers
+        result = {
+            "engine": "sniff" if worker_count == 1 else f"sniff x{worker_count}",
+            "seconds": round(seconds, 2),
+            "files/s": round(len(paths) / seconds, 1) if seconds else None,
+            "dicoms": sum(1 for header in headers if header is not None),
+            "identical": headers == baseline,
+        }
+        if expected is not None:
+            result["agrees with libmagic"] = all(
+                header == magic_header
+                for header, magic_header in zip(headers, expected)
+                if magic_header is not None
+            )
+        results.append(result)
+
+    log_results(
+        f"Sniffing {len(paths)} files under {data_dir} ({available_cpus()} CPUs available):",
+        results,
+    )
+    return results
+
+
+def synthetic_session_fields(rows: int, seed: int = 0) -> pandas.DataFrame:
+    """
+    A get_dicom_fields-like frame of rows sessions, mixing known body parts,
+    unknown descriptions and the ' ' / [] / '' placeholders for missing tags.
+    """
+    rng = random.Random(seed)
+    descriptions = [
+        "MRI BRAIN W/WO CONTRAST",
+        "MR Head and Neck",
+        "CT MAXILLOFACIAL",
+        "MRI C-SPINE",
+        "Stealth Brain",
+        "MR Pituitary",
+        "CT Sinus",
+        "XR Chest",
+        "MRI Knee Left",
+        "PET Skull Base to Mid Thigh",
+        "MR Orbits/Face",
+        "MR IAC",
+        "Outside study",
+        " ",
+        [],
+    ]
+    start = datetime(2000, 1, 1)
+    records = []
+    for row in range(rows):
+        dob = start + timedelta(days=rng.randrange(0, 7000))
+        records.append(
+            {
+                "accession_num": f"A{row:07d}",
+                "DOB": dob if rng.random() > 0.01 else rng.choice([[], "", 19010101]),
+                "ImagingDate": dob + timedelta(days=rng.randrange(0, 7000)) if rng.random() > 0.01 else rng.choice([[], ""]),
+                "ImagingTime": rng.choice(["070907.0705", "1230", "12", []]),
+                "RequestedProcDesc": rng.choice(descriptions),
+                "PerformedProcDesc": rng.choice(descriptions),
+                "StudyDesc": rng.choice(descriptions),
+            }
+        )
+    return pandas.DataFrame(records)
+
+
+def benchmark_session_labels(rows: int, repeats: int = 3) -> list[dict]:
+    """
+    Time make_session_labels on rows synthetic sessions, best of repeats runs.
+    (tests/test_custom_etl.py checks its output against the row-by-row
+    labeler it replaced.)
+    """
+    from image_deid_etl.custom_etl import make_session_labels
+
+    fields = ["PerformedProcDesc", "StudyDesc", "RequestedProcDesc"]
+    input_df = synthetic_session_fields(rows)
+    results = []
+    for run in range(repeats):
+        start = time.perf_counter()
+        labels, missing = make_session_labels(input_df, fields)
+        results.append(
+            {
+                "run": run + 1,
+                "seconds": round(time.perf_counter() - start, 2),
+                "labeled": len(labels),
+                "missing": len(missing),
+            }
+        )
+    best = min(result["seconds"] for result in results)
+    log_results(
+        f"Labeling {rows} sessions ({rows / max(best, 1e-6):,.0f} rows/second at best):", results
+    )
+    return results
+
+
+def _fdata_montage(path: str):
+    # How make_image_montage rendered before it sliced through dataobj: the
+    # whole image, every volume, as float64.
+    import nibabel as nib
+
+    from image_deid_etl.images import split_image, window_image
+
+    img_fdata = nib.load(path).get_fdata()
+    if img_fdata.ndim > 3:
+        img_fdata = img_fdata[:, :, :, 0]
+    (x, y, z) = img_fdata.shape[0:3]
+    return window_image(split_image(img_fdata, x, y, z))
+
+
+def _dataobj_montage(path: str):
+    import nibabel as nib
+
+    from image_deid_etl.images import render_montage
+
+    return render_montage(nib.load(path))
+
+
+def _measure_montage(render, path: str) -> tuple:
+    # Runs in a fresh process, so ru_maxrss only covers this one render.
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    montage = render(path)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, (peak - before) / 1024, montage  # ru_maxrss is in KiB on Linux
+
+
+def benchmark_montage(data_dir: str) -> list[dict]:
+    """
+    Render the montage of every .nii.gz under data_dir the old way (get_fdata)
+    and by slicing dataobj, each in its own process, reporting the time and
+    the peak RSS each render added, and how far apart the two montages are
+    (in gray levels).
+    """
+    import nibabel as nib
+
+    # Imported before the workers fork, so the renders' peaks don't include it.
+    import image_deid_etl.images  # noqa: F401
+
+    paths = sorted(
+        os.path.join(root, file)
+        for root, _, files in os.walk(data_dir)
+        for file in files
+        if file.endswith(".nii.gz")
+    )
+    results = []
+    for path in paths:
+        result = {"file": os.path.relpath(path, data_dir), "shape": nib.load(path).shape}
+        montages = []
+        for engine, render in (("get_fdata", _fdata_montage), ("dataobj", _dataobj_montage)):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                seconds, peak_mb, montage = executor.submit(_measure_montage, render, path).result()
+            result[f"{engine} seconds"] = round(seconds, 2)
+            result[f"{engine} peak MB"] = round(peak_mb, 1)
+            montages.append(montage.astype(int))
+        result["max difference"] = int(abs(montages[0] - montages[1]).max())
+        results.append(result)
+
+    log_results(f"Rendering montages of {len(paths)} NIfTIs under {data_dir}:", results)
+    return results
@@ -0,0 +1,209 @@
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from typing import Iterable, NamedTuple, Optional
+
+from pydicom.uid import UID
+
+from image_deid_etl.dicom_tags import DicomHeader, available_cpus
+from image_deid_etl.intake import link_or_copy
+
+logger = logging.getLogger(__name__)
+
+# dcm2niix options (see convert_dicom2nifti for what they mean).
+DCM2NIIX_OPTIONS = ["-b", "y", "-ba", "y", "-f", "%d", "-p", "y", "-z", "y", "-v", "0"]
+# The same, but writing uncompressed NIfTIs, for callers that gzip them themselves.
+DCM2NIIX_UNCOMPRESSED_OPTIONS = ["-b", "y", "-ba", "y", "-f", "%d", "-p", "y", "-z", "n", "-v", "0"]
+
+
+class ConversionResult(NamedTuple):
+    acquisition: str
+    returncode: int
+    stderr: str
+    seconds: float
+
+
+def _run(command: list[str]) -> tuple[int, str]:
+    try:
+        completed = subprocess.run(
+            command, stdin=subprocess.DEVNULL, capture_output=True, text=True, errors="replace"
+        )
+        return completed.returncode, completed.stderr
+    except OSError as error:  # e.g., the tool isn't installed
+        return 127, str(error)
+
+
+def run_dcm2niix(
+    acquisition: str, overwrite: bool = False, output_dir: str = None, pigz_threads: int = 0
+) -> ConversionResult:
+    """
+    Convert one acquisition directory, returning dcm2niix's real exit status
+    and stderr. Output goes next to the DICOMs unless output_dir is given;
+    overwrite replaces NIfTIs left by an earlier attempt instead of adding a
+    suffix.
+
+    dcm2niix gzips its NIfTIs with a pigz that uses every CPU. With
+    pigz_threads (and pigz installed), it writes them uncompressed instead
+    and they are gzipped by a pigz limited to that many threads, so that
+    concurrent conversions don't each start one thread per CPU.
+    """
+    pigz = shutil.which("pigz") if pigz_threads else None
+    command = ["dcm2niix"]
+    if overwrite:
+        command += ["-w", "1"]
+    if output_dir is not None:
+        command += ["-o", output_dir]
+    command += (DCM2NIIX_OPTIONS if pigz is None else DCM2NIIX_UNCOMPRESSED_OPTIONS) + [acquisition]
+
+    start = time.perf_counter()
+    returncode, stderr = _run(command)
+    if returncode == 0 and pigz is not None:
+        uncompressed = sorted(glob(os.path.join(output_dir or acquisition, "*.nii")))
+        if uncompressed:
+            returncode, stderr = _run([pigz, "-p", str(pigz_threads), "-n", "-f"] + uncompressed)
+            if returncode != 0:
+                stderr = "pigz: " + stderr
+    result = ConversionResult(acquisition, returncode, stderr, time.perf_counter() - start)
+
+    if returncode != 0:
+        logger.warning(
+            "dcm2niix exited with status %d for %s: %s", returncode, acquisition, stderr.strip()
+        )
+    return result
+
+
+def acquisition_size(acquisition: str) -> int:
+    """Total size in bytes of the files directly inside an acquisition directory."""
+    with os.scandir(acquisition) as entries:
+        return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+def convert_acquisitions(acquisitions: Iterable[str], workers: int = 0) -> dict[str, ConversionResult]:
+    """
+    Run dcm2niix on every acquisition directory, with up to workers processes
+    at a time (0 sizes the pool to the CPU quota). The CPUs are shared out
+    between them for gzipping, rather than every conversion's pigz using all
+    of them.
+
+    The largest acquisitions are started first, so that one big series doesn't
+    start last and leave the other workers idle while it finishes.
+    """
+    ordered = sorted(acquisitions, key=acquisition_size, reverse=True)
+    if not ordered:
+        return {}
+
+    start = time.perf_counter()
+    workers = workers or available_cpus()
+    pigz_threads = max(1, available_cpus() // workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = dict(
+            zip(
+                ordered,
+                executor.map(
+                    lambda acquisition: run_dcm2niix(acquisition, pigz_threads=pigz_threads), ordered
+                ),
+            )
+        )
+
+    failed = sum(1 for result in results.values() if result.returncode != 0)
+    logger.info(
+        "Converted %d acquisitions (%d failed) with %d workers (%d pigz threads each) in %.1f seconds.",
+        len(results),
+        failed,
+        workers,
+        pigz_threads,
+        time.perf_counter() - start,
+    )
+    return results
+
+
+def _decompress(source: str, target: str) -> int:
+    """Write an uncompressed copy of source to target with gdcmconv."""
+    try:
+        completed = subprocess.run(
+            ["gdcmconv", "-w", source, target],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            errors="replace",
+        )
+        returncode, stderr = completed.returncode, completed.stderr
+    except OSError as error:  # e.g., gdcmconv isn't installed
+        returncode, stderr = 127, str(error)
+
+    if returncode != 0:
+        # Hand dcm2niix the original rather than leaving a hole in the series.
+        logger.warning("gdcmconv exited with status %d for %s: %s", returncode, source, stderr.strip())
+        if os.path.exists(target):
+            os.remove(target)
+        link_or_copy(source, target)
+    return returncode
+
+
+def is_compressed_syntax(transfer_syntax_uid: str) -> bool:
+    """
+    Whether a transfer syntax compresses the pixel data. Syntaxes pydicom
+    doesn't know (e.g., private ones) are assumed to, so that gdcmconv gets a
+    chance to decode them; a file it can't convert is passed on as it is.
+    """
+    try:
+        return UID(transfer_syntax_uid).is_compressed
+    except ValueError:
+        return True
+
+
+def convert_decompressed(
+    acquisition: str, headers: Iterable[DicomHeader], workers: int = 0
+) -> Optional[ConversionResult]:
+    """
+    Retry a failed conversion on an uncompressed copy of an acquisition.
+
+    Only DICOMs whose transfer syntax is compressed (e.g., JPEG2000, which
+    OpenJPEG in dcm2niix sometimes fails on) are decompressed, by up to
+    workers gdcmconv processes at a time; the rest are hard-linked. The copy
+    is a scratch directory next to the acquisition, so the originals are never
+    modified, and dcm2niix writes its output into the acquisition directory.
+
+    Returns None, without retrying, when no DICOM needs decompressing.
+    """
+    compressed = {
+        os.path.basename(header.path)
+        for header in headers
+        if header.transfer_syntax_uid and is_compressed_syntax(header.transfer_syntax_uid)
+    }
+    if not compressed:
+        logger.info("No compressed DICOMs in %s; not retrying the conversion.", acquisition)
+        return None
+
+    start = time.perf_counter()
+    # A dot-directory, so globs over the DICOMs tree never see it.
+    scratch_parent = os.path.dirname(os.path.normpath(acquisition))
+    with tempfile.TemporaryDirectory(prefix=".decompressed-", dir=scratch_parent) as scratch_dir:
+        to_decompress = []
+        with os.scandir(acquisition) as entries:
+            for entry in entries:
+                if not (entry.is_file() and entry.name.endswith(".dcm")):
+                    continue
+                target = os.path.join(scratch_dir, entry.name)
+                if entry.name in compressed:
+                    to_decompress.append((entry.path, target))
+                else:
+                    link_or_copy(entry.path, target)
+
+        with ThreadPoolExecutor(max_workers=workers or available_cpus()) as executor:
+            returncodes = list(executor.map(lambda paths: _decompress(*paths), to_decompress))
+        logger.info(
+            "Decompressed %d DICOMs (%d failed) from %s in %.1f seconds.",
+            len(to_decompress),
+            sum(1 for returncode in returncodes if returncode != 0),
+            acquisition,
+            time.perf_counter() - start,
+        )
+
+        result = run_dcm2niix(scratch_dir, overwrite=True, output_dir=acquisition)
+    return result._replace(acquisition=acquisition)
@@ -1,14 +1,32 @@
 import importlib.resources as pkg_resources
 import json
 import os
+import re
 import shutil
 from datetime import datetime
+from functools import lru_cache
 from glob import glob
 
 import pandas as pd
-import pydicom
 from dateutil.parser import parse
 
+from image_deid_etl.conversion import convert_acquisitions, convert_decompressed
+from image_deid_etl.dicom_tags import missing_as_list
+from image_deid_etl.header_index import open_header_index, read_headers
+from image_deid_etl.pruning import (
+    acquisitions_with_modality,
+    files_with_suffix,
+    prune_tree,
+    sessions_matching,
+    sessions_with_accessions,
+)
+from image_deid_etl.restructure import (
+    apply_nifti_structure,
+    plan_nifti_structure,
+    write_structure_manifest,
+)
+from image_deid_etl.sidecars import load_sidecar, scrub_sidecars, write_sidecar
+
 
 def move_suspicious_files(file_list,out_dir):
 # move files that don't match the expected data type for images
@@ -39,10 +57,12 @@ def mrn_append_zeros(mrn_list):
     return out
 
 def delete_acquisitions_by_modality(data_dir,modality):
-    acq_list = glob(data_dir+'*/*/*') # directories
-    for acq in acq_list:
-        if acq.split('/')[-1][0:2] == modality:
-            shutil.rmtree(acq)
+    index = open_header_index(data_dir) # DICOM header index, if one was built
+    try:
+        return prune_tree(data_dir,[acquisitions_with_modality([modality],index)])
+    finally:
+        if index:
+            index.close()
 
 def delete_sessions_by_modality(data_dir,modality):
     ses_list = glob(data_dir+'*/*') # directories
@@ -53,11 +73,7 @@ def delete_sessions_by_modality(data_dir,modality):
             shutil.rmtree(ses_path)
 
 def delete_sessions(data_dir,string_match):
-    ses_list = glob(data_dir+'*/*') # directories
-    for ses_path in ses_list:
-        ses = ses_path.split('/')[-1] # session label
-        if string_match.lower() in ses.lower():
-            shutil.rmtree(ses_path)
+    return prune_tree(data_dir,[sessions_matching([string_match])])
 
 def get_subject_info_dir(data_dir):
 # uses local directory structure to return a list of MRNs & accessions (as a pandas df)
@@ -71,110 +87,90 @@ def get_subject_info_dir(data_dir):
     accessions = [x.split('/')[1].split(' ')[0] for x in dir_list]
     return pd.DataFrame({'mrn': mrns, 'accession_num': accessions, 'first_name':first_names, 'last_name':last_names})
 
-def get_body_part_examined(desc):
-    abbrv=[]
-    parts=[]
-    if ('brain' in desc.lower()) \
-    or ('head' in desc.lower()) \
-    or ('stealth' in desc.lower()) \
-    or ('neuro' in desc.lower()) \
-    or ('orbits' in desc.lower()) \
-    or ('spectroscopy' in desc.lower()):
-        abbrv.append('B')
-        parts.append('brain')
-    if ('face' in desc.lower()) or \
-        ('maxillofacial' in desc.lower()):
-        abbrv.append('F')
-        parts.append('face')
-    if 'spine' in desc.lower():
-        abbrv.append('S')
-        parts.append('spine')
-    if 'neck' in desc.lower():
-        abbrv.append('N')
-        parts.append('neck')
-    if 'pituitary' in desc.lower():
-        abbrv.append('P')
-        parts.append('pituitary')
-    if ('sinuses' in desc.lower()) or \
-        ('sinus' in desc.lower()):
-        abbrv.append('Si')
-        parts.append('sinuses')
-    if 'chest' in desc.lower():
-        abbrv.append('C')
-        parts.append('chest')
-    if 'finger' in desc.lower():
-        abbrv.append('Fi')
-        parts.append('finger')
-    if 'iac' in desc.lower():
-        abbrv.append('IAC')
-        parts.append('iac')
-    if 'shoulder' in desc.lower():
-        abbrv.append('Sh')
-        parts.append('shoulder')
-    if 'knee' in desc.lower():
-        abbrv.append('K')
-        parts.append('knee')
-    if ('skull base to mid thigh' in desc.lower()) or \
-        ('hip' in desc.lower()):
-        abbrv.append('Bo')
-        parts.append('Body')
-    if abbrv==[]:
+# body parts recognized in study/procedure descriptions, in label order:
+#   (abbreviation, part, lower-case keywords that indicate it)
+BODY_PARTS = [
+    ('B', 'brain', ['brain','head','stealth','neuro','orbits','spectroscopy']),
+    ('F', 'face', ['face','maxillofacial']),
+    ('S', 'spine', ['spine']),
+    ('N', 'neck', ['neck']),
+    ('P', 'pituitary', ['pituitary']),
+    ('Si', 'sinuses', ['sinuses','sinus']),
+    ('C', 'chest', ['chest']),
+    ('Fi', 'finger', ['finger']),
+    ('IAC', 'iac', ['iac']),
+    ('Sh', 'shoulder', ['shoulder']),
+    ('K', 'knee', ['knee']),
+    ('Bo', 'Body', ['skull base to mid thigh','hip']),
+]
+BODY_PART_KEYWORDS = {keyword: ind for ind,(abbrv,part,keywords) in enumerate(BODY_PARTS) for keyword in keywords}
+# one pattern for the whole vocabulary; the lookahead finds overlapping keywords
+# too (e.g., 'iac' inside 'maxillofacial')
+BODY_PART_PATTERN = re.compile('(?=('+'|'.join(re.escape(keyword) for keyword in sorted(BODY_PART_KEYWORDS, key=len, reverse=True))+'))')
+
+def body_part_label(desc_lower):
+# body part label (e.g., 'BN_brain_neck') for a lower-case description, [] if none found
+    found = sorted({BODY_PART_KEYWORDS[keyword] for keyword in BODY_PART_PATTERN.findall(desc_lower)})
+    if found==[]:
         return []
-    else:
-        abbrv=''.join(abbrv)
-        parts='_'.join(parts)
-        return abbrv+'_'+parts
+    abbrv=''.join(BODY_PARTS[ind][0] for ind in found)
+    parts='_'.join(BODY_PARTS[ind][1] for ind in found)
+    return abbrv+'_'+parts
+
+def get_body_part_examined(desc):
+    return body_part_label(desc.lower())
+
+def get_body_parts_examined(descs):
+# get_body_part_examined for a whole pandas Series of descriptions
+#   each distinct description is only matched once
+    codes,uniques = pd.factorize(descs.str.lower())
+    labels = pd.Series([body_part_label(desc) for desc in uniques], dtype=object)
+    return pd.Series(labels.take(codes).to_numpy(), index=descs.index, dtype=object)
+
+def is_empty_list(values):
+# elementwise "value == []" (the placeholder for a missing DICOM tag)
+    return values.map(lambda value: isinstance(value,list) and len(value)==0).astype(bool)
+
+def to_timestamp(value):
+# a date as a datetime or pandas Timestamp, NaT if it is missing ([], '' or blank) or can't be parsed
+    if isinstance(value,datetime): # the usual case; the caller converts these all at once
+        return value
+    if (isinstance(value,list) and len(value)==0) or (isinstance(value,str) and not value.strip()):
+        return pd.NaT
+    return pd.to_datetime(value, errors='coerce')
 
 def make_session_labels(input_df,fields_to_use):
 # construct session label based on DICOM metadata
 #   assumes directory structure: {data_dir}/{sub}/{ses}/{acq}/*.dcm
-    session_labels=[]
-    accession_numbers=[]
-    missing_sessions=[]
-    req_descs=[]
-    perf_descs=[]
-    study_descs=[]
-    # for each subject, loop through acquisitions/DICOMs until find desired info & construct session label
-    for ind,row in input_df.iterrows(): # for each session
-        subject_dob=row['DOB']
-        date_of_imaging = row['ImagingDate']
-        time_of_imaging = row['ImagingTime']
-        accession = row['accession_num']
-        req_desc = row['RequestedProcDesc']
-        perf_desc = row['PerformedProcDesc']
-        study_desc = row['StudyDesc']
-        body_part_examined=[]
-        desc=[]
-        body_part_examined=[]
-        for i in range(len(fields_to_use)): # loop through input fields, in order, until a description is found
-            if (desc==[]) or (body_part_examined==[]):
-                this_field = fields_to_use[i]
-                if (row[this_field] != ' ') and (row[this_field] != []):
-                    desc = row[this_field]
-                    # print(row['Last Name'])
-                    body_part_examined = get_body_part_examined(desc)
-        if len(time_of_imaging)<4:
-            study_time=''
-        else:
-            study_time='_'+time_of_imaging[0:2]+'h'+time_of_imaging[2:4]+'m'
-        if (subject_dob == 19010101) or (subject_dob == []) or (date_of_imaging == []) or (body_part_examined == []):
-            # print('Not enough info in DICOM header to create session labels for '+ses)
-            missing_sessions.append(accession)
-        else:
-            age_in_days_at_imaging = abs((date_of_imaging - subject_dob).days)
-            session_labels.append(str(age_in_days_at_imaging)+'d_'+body_part_examined+study_time)
-            accession_numbers.append(accession)
-            req_descs.append(req_desc)
-            perf_descs.append(perf_desc)
-            study_descs.append(study_desc)
-    out_df = pd.DataFrame({'accession_num': accession_numbers, \
-                            'session_label': session_labels , \
-                            'RequestedProcDesc': req_descs , \
-                            'PerformedProcDesc': perf_descs , \
-                            'StudyDesc': study_descs })
-    return out_df,pd.DataFrame(missing_sessions,columns=['accession_num'])
+#   for each session, the description used is the first of fields_to_use (in order)
+#   that isn't blank and names a known body part
+    body_part_examined = pd.Series([None]*len(input_df), index=input_df.index, dtype=object)
+    for this_field in fields_to_use: # loop through input fields, in order, until a body part is found
+        values = input_df[this_field]
+        usable = values.map(lambda value: isinstance(value,str) and value!=' ').astype(bool) & body_part_examined.isna()
+        if usable.any():
+            parts = get_body_parts_examined(values[usable])
+            body_part_examined[usable] = parts.where(~is_empty_list(parts), None)
+    times = input_df['ImagingTime']
+    times = times.where(times.map(lambda value: isinstance(value,str)).astype(bool), '').astype(object) # [] when missing
+    study_time = ('_'+times.str[0:2]+'h'+times.str[2:4]+'m').where(times.str.len()>=4, '')
+    subject_dob = input_df['DOB']
+    dob_dates = pd.to_datetime(subject_dob.map(to_timestamp))
+    imaging_dates = pd.to_datetime(input_df['ImagingDate'].map(to_timestamp))
+    missing = (subject_dob.astype(object) == 19010101) | dob_dates.isna() | imaging_dates.isna() | body_part_examined.isna()
+    # print('Not enough info in DICOM header to create session labels for '+ses)
+    labeled = input_df[~missing]
+    age_in_days_at_imaging = (imaging_dates[~missing] - dob_dates[~missing]).dt.days.abs()
+    session_labels = age_in_days_at_imaging.astype(str)+'d_'+body_part_examined[~missing].astype(str)+study_time[~missing]
+    out_df = pd.DataFrame({'accession_num': labeled['accession_num'].tolist(), \
+                            'session_label': session_labels.tolist() , \
+                            'RequestedProcDesc': labeled['RequestedProcDesc'].tolist() , \
+                            'PerformedProcDesc': labeled['PerformedProcDesc'].tolist() , \
+                            'StudyDesc': labeled['StudyDesc'].tolist() })
+    return out_df,pd.DataFrame(input_df.loc[missing,'accession_num'].tolist(),columns=['accession_num'])
 
 def get_dicom_fields(data_dir):
+    index = open_header_index(data_dir) # DICOM header index, if one was built
     sub_list = glob(data_dir+'/*')
     accession_numbers=[]
     dobs=[]
@@ -196,45 +192,23 @@ def get_dicom_fields(data_dir):
                 req_proc_desc=[]
                 perf_proc_desc=[]
                 # loop through all DICOMs in a session until found necessary fields
-                for file in glob(ses+'/*/*.dcm'):
-                    ds = pydicom.read_file(file) # os.path.join(root, file)
+                for header in read_headers(ses, '*/*.dcm', index):
                     if subject_dob == []:
-                        try:
-                            subject_dob = ds[0x10,0x30].value # date of birth
-                        except:
-                            subject_dob = []
+                        subject_dob = missing_as_list(header.patient_birth_date) # date of birth
                     if date_of_imaging == []:
-                        try:
-                            date_of_imaging = ds[0x08,0x20].value # study date
-                            # date_of_imaging = ds[0x08,0x22].value # acquisition date
-                        except:
-                            date_of_imaging = []
+                        date_of_imaging = missing_as_list(header.study_date) # study date
+                        # date_of_imaging = header.acquisition_date # acquisition date
                     if time_of_imaging == []:
-                        try:
-                            # 070907.0705 represents a time of 7 hours, 9 minutes and 7.0705 seconds.
-                            time_of_imaging = ds[0x08,0x30].value # study time (0008,0030)
-                        except:
-                            time_of_imaging = []
+                        # 070907.0705 represents a time of 7 hours, 9 minutes and 7.0705 seconds.
+                        time_of_imaging = missing_as_list(header.study_time) # study time (0008,0030)
                     if accession == []:
-                        try:
-                            accession = ds[0x08,0x50].value
-                        except:
-                            accession=[]
+                        accession = missing_as_list(header.accession_number)
                     if study_desc == []:
-                        try:
-                            study_desc = ds[0x08,0x1030].value # Study Description (0008,1030)
-                        except:
-                            study_desc=[]
+                        study_desc = missing_as_list(header.study_description) # Study Description (0008,1030)
                     if req_proc_desc == []:
-                        try:
-                            req_proc_desc = ds[0x32,0x1060].value # requested procedure description
-                        except:
-                            req_proc_desc=[]
+                        req_proc_desc = missing_as_list(header.requested_procedure_description) # requested procedure description
                     if perf_proc_desc == []:
-                        try:
-                            perf_proc_desc = ds[0x40,0x254].value # performed procedure description (0040,0254)
-                        except:
-                            perf_proc_desc=[]
+                        perf_proc_desc = missing_as_list(header.performed_procedure_description) # performed procedure description (0040,0254)
                     if subject_dob and date_of_imaging and accession and study_desc: # if these are found, break out of for loop
                         break
                 if subject_dob:
@@ -248,6 +222,8 @@ def get_dicom_fields(data_dir):
                 req_proc.append(req_proc_desc)
                 perf_proc.append(perf_proc_desc)
                 study.append(study_desc)
+    if index:
+        index.close()
     # fix any empty lists of lists that can happen when processing 1 study
     if (len(accession_numbers)==1) and (accession_numbers[0]==[]):
         accession_numbers=''
@@ -337,28 +313,11 @@ def get_subject_mapping_cbtn(cbtn_df,sub_info,data_dir):
     sub_df = sub_df.rename(columns={'CBTN Subject ID': 'C_ID'})
     return sub_df,missing_c_ids,missing_ses
 
-def delete_json_field(json_obj,field):
-    try:
-        del json_obj[field]
-    except:
-        pass
-
 def filter_sidecars(data_dir):
-    ## remove remaining known PHI-containing fields from the sidecars
-    fields_to_remove = ['DeviceSerialNumber','ImageComments','InstitutionAddress','InstitutionalDepartmentName','InstitutionName',\
-                        'ProcedureStepDescription','ProtocolName','StationName']
-    for root,dirs,files in os.walk(data_dir):
-        matches = [match for match in files if ".json" in match] # grab only '.json' files
-        for file in matches:
-            file_path=os.path.join(root,file)
-            print(file_path)
-            json_file = json.load(open(file_path,'r'), strict=False)
-            for field in fields_to_remove:
-                delete_json_field(json_file,field)
-            with open(file_path, 'w') as outfile:
-                json.dump(json_file, outfile)
-
-def convert_dicom2nifti(data_dir):
+    ## remove remaining known PHI-containing fields (listed in sidecar_policy.json) from the sidecars
+    scrub_sidecars(data_dir)
+
+def convert_dicom2nifti(data_dir,workers=0):
 # dcm2niix options:
 #   -b : BIDS sidecar (y/n/o [o=only: no NIfTI], default y)
 #       -ba: anonymize BIDS (y/n, default y)
@@ -367,246 +326,97 @@ def convert_dicom2nifti(data_dir):
 #   -z : gz compress images (y/o/i/n/3, default n)
 #   -v : verbose (n/y or 0/1/2, default 0)
 #   -w : write behavior for name conflicts (0,1,2, default 2: 0=skip duplicates, 1=overwrite, 2=add suffix)
+# acquisitions are converted concurrently by up to workers dcm2niix processes (0 = CPU quota)
+    index = open_header_index(data_dir) # DICOM header index, if one was built
     acq_list = glob(data_dir+'/*/*/*')
+    acq_list = [acquisition for acquisition in acq_list if glob(acquisition+'/*.nii.gz')==[]] # skip directories w/niftis already in them
     ## convert all acquisitions using Chris Rorden's dcm2niix with anon BIDS sidecar enabled
+    results = convert_acquisitions(acq_list, workers)
     for acquisition in acq_list:
-        # print(acquisition)
-        if glob(acquisition+'/*.nii.gz')==[]: # if there are no niftis already in the directory
-            os.system('dcm2niix -b y -ba y -f ''"%d"'' -p y -z y -v 0 ''"'+acquisition+'"'' ')
-            # if there are STILL no niftis or if dcm2niix returns an error code,
-            # try decompressing the DICOMs first with the GDCM tool gdcmconv
-            # (this should handle errors with JPEG2000 compression in OpenJPEG within dcm2niix)
-            exit_code = os.popen('echo $?').readlines()[0].strip('\n')
-            if (glob(acquisition+'/*.nii.gz')==[]) or (exit_code != '0'): 
-                for file_path in glob(acquisition+'/*.dcm'): # for each DICOM file
-                    os.system(f'gdcmconv -w "{file_path}" "{file_path}"  ') # -w flag for decompression
-                os.system('dcm2niix -w 1 -b y -ba y -f ''"%d"'' -p y -z y -v 0 ''"'+acquisition+'"'' ') # now re-try the conversion
-            # add voxel dimensions to sidecar
-            if glob(acquisition+'/*.nii.gz'): # if there are NIfTIs for this acquisition
-                sidecars = glob(acquisition+'/*.json')
-                for json_path in sidecars: # loop through sidecars & add in voxel dim's
-                    try:
-                        json_file = json.load(open(json_path,'r'))
-                        for file in glob(acquisition+'/*.dcm'): # loop through DICOMs until find necessary tags
-                            ds = pydicom.read_file(file) # os.path.join(root, file)
-                            try:
-                                pix_spacing = ds[0x28,0x30].value # Pixel Spacing Description (0028,0030)
-                            except:
-                                pix_spacing=[]
-                            try:
-                                # slice_thick = ds[0x18,0x50].value # Slice Thickness (0018,0050)
-                                slice_thick = ds[0x18,0x88].value # Spacing Between Slices (0018,0088)
-                            except:
-                                slice_thick=[]
-                            if (pix_spacing!=[]) and (slice_thick!=[]):
-                                json_file['dim1']=pix_spacing[0]
-                                json_file['dim2']=pix_spacing[1]
-                                json_file['dim3']=slice_thick
-                                with open(json_path, 'w') as outfile:
-                                    json.dump(json_file, outfile)
-                                break
-                    except:
-                        continue
+        # if there are STILL no niftis or if dcm2niix returns an error code,
+        # try decompressing the DICOMs first with the GDCM tool gdcmconv
+        # (this should handle errors with JPEG2000 compression in OpenJPEG within dcm2niix)
+        if (glob(acquisition+'/*.nii.gz')==[]) or (results[acquisition].returncode != 0):
+            # decompresses a scratch copy of the compressed DICOMs; originals are left untouched
+            convert_decompressed(acquisition, read_headers(acquisition, '*.dcm', index), workers) # now re-try the conversion
+    if index:
+        index.close()
 
 
 def closest(lst, K):
 # get the closest (min) value in list (lst) to an integer (K)
     return lst[min(range(len(lst)), key = lambda i: abs(lst[i]-K))]
 
+@lru_cache(maxsize=None)
+def load_diagnosis_mapping():
+# CBTN diagnosis -> Flywheel project label, read once per process
+    return json.load(pkg_resources.open_text(__package__, 'diagnosis_mapping.json'))
+
 def get_fw_proj_cbtn(cbtn_df,sub_mapping):
 # using the C-ID and age-at-imaging, extract the target project for each session
 #   based on the CBTN-all spreadsheet. Uses age-at-imaging to find the closest event
 #   in time in CBTN-all & then uses the Diagnosis category to derive a Flywheel project label
 #   (based on a mapping dictionary).
-    cbtn_df = cbtn_df[['CBTN Subject ID','Age at Diagnosis','Diagnosis']]
-    proj_mapping = json.load(pkg_resources.open_text(__package__, 'diagnosis_mapping.json'))
-    sub_list = sub_mapping['C_ID'].values.tolist()
-    session_list = sub_mapping['session_label'].values.tolist()
-    age_at_imaging = [i.split('d_')[0] for i in session_list] # extract age-at-imaging from session label for *all* subjects
-    ind=0
-    fw_projects = []
+#   CBTN-all is filtered once for all subjects, rather than once per session
+    pnet = 'Supratentorial or Spinal Cord PNET'
     missing_tag = 'subject missing in cbtn-all'
-    for sub in sub_list:
-        # get all the data from CBTN-all for this subject
-        sub_rows = cbtn_df[(cbtn_df['CBTN Subject ID'] == sub)]
-        if sub_rows.empty:
-            fw_projects.append(missing_tag)
-        else:
-            sub_rows = sub_rows[sub_rows['Diagnosis']!='Not Reported'] # remove 'not reported' rows
-            sub_rows = sub_rows[sub_rows['Diagnosis']!='Other'] # remove 'other' rows
-            if (not sub_rows.empty) and (not sub_rows[sub_rows['Diagnosis']=="Supratentorial or Spinal Cord PNET"].empty): # if there is a PNET diagnosis
-                if len(sub_rows['Diagnosis'].unique()) > 1: # if there are additional diagnoses available
-                    sub_rows = sub_rows[sub_rows['Diagnosis']!='Supratentorial or Spinal Cord PNET']     # remove "PNET" rows                
-            if sub_rows.empty:
-                diagnosis_to_use='Not Reported'
-                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label
-            elif (len(sub_rows['Diagnosis'].unique()) == 1):
-                diagnosis_to_use=sub_rows['Diagnosis'].unique().tolist()[0]
-                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label                
-            else:
-                # use the age-in-days at imaging (from the session labels) to find the row with the closest age-at-diagnosis value
-                closest_diagnosis = closest(sub_rows['Age at Diagnosis'].values.astype(int).tolist(), int(age_at_imaging[ind])) # closest age row
-                # grab the diagnosis label for that row
-                diagnosis_to_use = sub_rows[sub_rows['Age at Diagnosis']==str(closest_diagnosis)]['Diagnosis'].tolist()[0]
-                # map to the FW-project labels
-                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label
-        ind+=1
-    sub_mapping['fw_proj'] = fw_projects # add column to output
+    proj_mapping = load_diagnosis_mapping()
+    cbtn_df = cbtn_df[['CBTN Subject ID','Age at Diagnosis','Diagnosis']].reset_index(drop=True)
+    sessions = pd.DataFrame({'C_ID': sub_mapping['C_ID'].to_numpy(),
+                             'age_at_imaging': sub_mapping['session_label'].str.split('d_').str[0].to_numpy()}) # extract age-at-imaging from session label for *all* subjects
+    # drop 'not reported' & 'other' rows, then "PNET" rows for subjects with additional diagnoses available
+    sub_rows = cbtn_df[~cbtn_df['Diagnosis'].isin(['Not Reported','Other'])]
+    n_diagnoses = sub_rows.groupby('CBTN Subject ID')['Diagnosis'].transform('nunique', dropna=False)
+    sub_rows = sub_rows[~((sub_rows['Diagnosis']==pnet) & (n_diagnoses>1))]
+    n_diagnoses = sub_rows.groupby('CBTN Subject ID')['Diagnosis'].nunique(dropna=False)
+    # subjects with a single diagnosis (or none left: 'Not Reported')
+    diagnoses = pd.Series(None, index=sessions.index, dtype=object)
+    diagnoses[sessions['C_ID'].isin(cbtn_df['CBTN Subject ID'])] = 'Not Reported'
+    single = sub_rows[sub_rows['CBTN Subject ID'].isin(n_diagnoses.index[n_diagnoses==1])].drop_duplicates('CBTN Subject ID')
+    diagnoses.update(sessions['C_ID'].map(single.set_index('CBTN Subject ID')['Diagnosis']))
+    # subjects with several diagnoses: use the age-in-days at imaging to find the row with the closest
+    # age-at-diagnosis value (the first such row on ties)
+    several = sessions[sessions['C_ID'].isin(n_diagnoses.index[n_diagnoses>1])]
+    if not several.empty:
+        candidates = several.reset_index().merge(sub_rows.rename_axis('row').reset_index(), left_on='C_ID', right_on='CBTN Subject ID')
+        candidates['distance'] = (candidates['Age at Diagnosis'].astype(int) - candidates['age_at_imaging'].astype(int)).abs()
+        candidates = candidates.sort_values(['index','distance','row']).drop_duplicates('index')
+        diagnoses.update(candidates.set_index('index')['Diagnosis'])
+    # map to the FW-project labels
+    unknown = diagnoses[diagnoses.notna() & ~diagnoses.isin(list(proj_mapping))]
+    if not unknown.empty:
+        raise KeyError(unknown.iloc[0])
+    fw_projects = diagnoses.map(proj_mapping).where(diagnoses.notna(), missing_tag)
+    sub_mapping['fw_proj'] = fw_projects.tolist() # add column to output
     subs_no_proj = sub_mapping[sub_mapping['fw_proj']==missing_tag].reset_index(drop=True)
     subs_with_proj = sub_mapping[sub_mapping['fw_proj']!=missing_tag].reset_index(drop=True)
     return subs_with_proj,subs_no_proj
 
 def delete_local_data(data_dir,list_2_delete):
-# deletes sessions based on accession #s in input df
-    session_list = glob(data_dir+'*/*')
-    for index,row in list_2_delete.iterrows():
-        accession_number = row['accession_num']
-        data_path = [i for i in session_list if accession_number in i][0]
-        shutil.rmtree(data_path, ignore_errors=True)
-    # check & remove any empty sub dir's
-    delete_empty_dirs(data_dir)
+# deletes sessions based on accession #s in input df, then any sub dir's left empty
+    return prune_tree(data_dir,[sessions_with_accessions(list_2_delete['accession_num'])],remove_empty=True)
 
 def delete_empty_dirs(data_dir):
-# deletes empty sub/session/acq dir's
-    parent_list = glob(data_dir+'*')
-    for top_dir in parent_list:
+# deletes empty sub/session/acq dir's (leaving the pipeline's own top-level dir's alone)
+    with os.scandir(data_dir) as entries:
+        top_dirs = [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
+    for top_dir in top_dirs:
         if ('files' not in top_dir) and ('NIfTIs' not in top_dir) and ('DICOMs' not in top_dir) and ('JPGs' not in top_dir):
-            sub_list=glob(top_dir+'/*')
-            for sub in sub_list:
-                sub_sessions=glob(sub+'/*')
-                if sub_sessions!=[]:
-                    for session in sub_sessions:
-                        acq_dirs = glob(session+'/*')
-                        for acq in acq_dirs: # remove empty acq dir's
-                            if os.listdir(acq) == []: # if no files in acq dir
-                                os.rmdir(acq)
-                        try:
-                            os.rmdir(session) # remove empty session dir's
-                        except:
-                            continue
-                try:
-                    os.rmdir(sub) # remove empty subject dir's
-                except:
-                    continue
+            prune_tree(top_dir,[],remove_empty=True)
 
 def delete_files(data_dir,file_ending):
 # deletes any files ending in file_ending within data_dir/
-    for root,dirs,files in os.walk(data_dir):
-        matches = [match for match in files if file_ending in match] # grab only '.json' files
-        for file in matches:
-            file_path=os.path.join(root,file)
-            os.remove(file_path)
+    return prune_tree(data_dir,[files_with_suffix([file_ending])])
 
 def structure_nifti_files(data_dir,sub_mapping,output_dir,program):
 # intended for use on output files from the processing pipeline
 # use input df & info in JSON sidecars to create output directories
 #   move nifti, json, bval/bvec files to output dir's (leaving DICOMs in place)
-    ## make target directories & move output files there
-    data_path = glob(data_dir+'*/*')[0] # assumes only 1 session (1 study being processed)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir) # parent directory
-    for index,row in sub_mapping.iterrows():
-        if program == 'cbtn':
-            c_id = row['C_ID']
-        else:
-            c_id = row['Subject ID']
-        session = row['session_label']
-        fw_proj = row['fw_proj']
-        session_dir_in = os.path.join(output_dir,fw_proj,c_id,session)
-        if not os.path.exists(session_dir_in):
-            os.makedirs(session_dir_in)
-        # move the files
-        acq_list = glob(data_path+'/*')
-        # for each acquisition, construct the acquisition label based on sidecar info
-        # print(acq_list)
-        for acq in acq_list:
-            sidecar_fn = glob(acq+'/*.json')
-            if (sidecar_fn) and ('dcm2nii_invalidName' not in sidecar_fn[0]):
-                sidecar_fn=sidecar_fn[0]
-                sidecar = json.load(open(sidecar_fn))
-                print(sidecar_fn)
-                try:
-                    if sidecar['Modality']!='CT':
-                        notCT=1
-                    else:
-                        notCT=0
-                except:
-                    notCT=1
-                if (len(sidecar)<20) and \
-                (not (any(x in sidecar_fn for x in ['ep2d_diff_mddw_','Diffusion_Series_Texture','RGB','ColFA','DTI_Fibers','Perfusion_Weighted','RGB','Color_Map','Vessels_3D']))) and \
-                (notCT) : 
-                    purgatory='/'.join(output_dir.split('/')[0:2])+'/NIfTIs_short_json/' # output should go to '<program>/<site>/NIfTIs_to_check/'
-                    session_dir=os.path.join(purgatory,fw_proj,c_id,session)
-                    if not os.path.exists(session_dir):
-                        os.makedirs(session_dir)
-                else:
-                    session_dir=session_dir_in
-                acq_label = str(sidecar['SeriesDescription'])
-                # avoid moving files for known PHI-containing acqusitions based on hard-coded strings
-                if ('Study_acquired_outside_hospital' not in acq_label) and \
-                    (not (any(x in acq_label.lower() for x in ['screensave','screen save','screen_save']))) and \
-                    (not (any(x in acq_label.lower() for x in ['cover image','cover_image']))) and \
-                    ('documents' not in acq_label.lower()) and \
-                    (not (any(x in acq_label.lower() for x in ['dose_report','dose report','dosereport']))) and \
-                    ('protocol' not in acq_label.lower()) and \
-                    ('capture' not in acq_label.lower()):
-                    series_num = str(sidecar['SeriesNumber'])
-                    if len(series_num) == 1:
-                        series_num = '0'+series_num
-                    # replace any single quotation marks with underscore in acquisition labels (a rare case but has been found)
-                    acq_label = acq_label.replace("'",'_')
-                    acq_target_dir = session_dir+'/'+series_num+' - '+acq_label
-                    # if it doesn't already exist, create it
-                    if not os.path.exists(acq_target_dir):
-                        os.makedirs(acq_target_dir)
-                    else:
-                    # if it already exists, append a copy number
-                        copy_num=1
-                        dir_created=0
-                        while dir_created==0:
-                            acq_target_dir = acq_target_dir+' ('+str(copy_num)+')'
-                            if not os.path.exists(acq_target_dir):
-                                os.makedirs(acq_target_dir)
-                                dir_created=1
-                            else:
-                                copy_num+=1
-                    # now move all the files for this acquisition
-                    nifti_files=glob(acq+'/*.nii.gz')
-                    for file in nifti_files:
-                        # replace any single quotation marks with underscore
-                        new_fn = file.replace("'",'_')
-                        os.rename(file, new_fn)
-                        shutil.move(new_fn, acq_target_dir)
-                    json_files=glob(acq+'/*.json')
-                    for file in json_files:
-                        # replace any single quotation marks with underscore
-                        new_fn = file.replace("'",'_')
-                        os.rename(file, new_fn)
-                        shutil.move(new_fn, acq_target_dir)
-                    bval_files=glob(acq+'/*.bval')
-                    for file in bval_files:
-                        # replace any single quotation marks with underscore
-                        new_fn = file.replace("'",'_')
-                        os.rename(file, new_fn)
-                        shutil.move(new_fn, acq_target_dir)
-                    bvec_files=glob(acq+'/*.bvec')
-                    for file in bvec_files:
-                        # replace any single quotation marks with underscore
-                        new_fn = file.replace("'",'_')
-                        os.rename(file, new_fn)
-                        shutil.move(new_fn, acq_target_dir)
-                else:
-                    shutil.rmtree(acq) # deletes directories & all files
-                if not os.listdir(acq_target_dir): # if no contents
-                    os.rmdir(acq_target_dir) # only deletes empty directories
-                if not os.listdir(session_dir):
-                    os.rmdir(session_dir)
-                sub_dir = '/'.join(session_dir.split('/')[0:5])
-                if not os.listdir(sub_dir):
-                    os.rmdir(sub_dir)
-                proj_dir = '/'.join(sub_dir.split('/')[0:4])
-                if not os.listdir(proj_dir):
-                    os.rmdir(proj_dir)
+#   every move is planned (& recorded in a manifest next to output_dir) before any file is touched
+    plan = plan_nifti_structure(data_dir,sub_mapping,output_dir,program)
+    write_structure_manifest(output_dir,plan)
+    apply_nifti_structure(output_dir,plan)
+    return plan
 
 def is_date(string, fuzzy=False):
 # https://stackoverflow.com/questions/25341945/check-if-string-has-date-any-format
@@ -666,11 +476,9 @@ def strip_diffusion_fn_dates(data_dir):
                     str_end='.json'
                     # ======== edit SeriesDescription tag in JSON sidecars
                     source_filepath = os.path.join(out_dir,file)
-                    with open(source_filepath, 'r') as data_file: # read the json
-                        data = json.load(data_file)
+                    data = load_sidecar(source_filepath) # read the json
                     data["SeriesDescription"] = series_desc # modify the field
-                    with open(source_filepath, 'w') as data_file: # overwrite the json
-                        data = json.dump(data, data_file)
+                    write_sidecar(source_filepath, data) # overwrite the json
                 elif file.endswith('.nii.gz'):
                     str_end='.nii.gz'
                 elif file.endswith('.bval'):
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 from glob import glob
@@ -6,6 +5,8 @@ import pandas as pd
 from fuzzywuzzy import process
 import flywheel
 
+from image_deid_etl.sidecars import load_sidecar
+
 logger = logging.getLogger(__name__)
 
 def confirm_proj_exists(fw_client: flywheel.Client, flywheel_group: str, data_dir: str):
@@ -59,7 +60,7 @@ def inject_sidecar_metadata(fw_client: flywheel.Client, flywheel_group: str, dat
 
     # match local JSON files to acquisitions in the given session based on matching SeriesNumber + SeriesDesc
     for file in json_files:
-        metadata = json.load(open(file,'r'), strict=False)
+        metadata = load_sidecar(file)
         series_num = str(metadata['SeriesNumber'])
         if len(series_num) == 1:
             series_num = '0'+series_num
@@ -1,11 +1,15 @@
+import io
 import logging
 import os
+import threading
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 
-from sqlalchemy import text
+from sqlalchemy import func, text
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm import Session
-from sqlalchemy.sql.schema import Column, MetaData, Table
-from sqlalchemy.types import CHAR
+from sqlalchemy.sql.schema import CheckConstraint, Column, Index, MetaData, Table
+from sqlalchemy.types import BigInteger, DateTime, Integer, String, Text
 
 from image_deid_etl.exceptions import ImproperlyConfigured
 
@@ -20,34 +24,364 @@ engine = create_engine(DATABASE_URL)
 logger = logging.getLogger(__name__)
 
 
+# Lifecycle of a study in study_jobs. A study moves from queued to claimed,
+# then through the pipeline stages while its lease is held, and ends up done
+# or failed. Failed studies are retried until they run out of attempts.
+STUDY_JOB_STATES = (
+    "queued",
+    "claimed",
+    "downloading",
+    "converting",
+    "uploading",
+    "done",
+    "failed",
+)
+ACTIVE_STUDY_JOB_STATES = ("claimed", "downloading", "converting", "uploading")
+
+# How long a claim lasts without being renewed by a stage transition.
+STUDY_JOB_LEASE_SECONDS = int(os.getenv("STUDY_JOB_LEASE_SECONDS", 2 * 60 * 60))
+STUDY_JOB_MAX_ATTEMPTS = int(os.getenv("STUDY_JOB_MAX_ATTEMPTS", 3))
+
+# SQL conditions for rows that a worker may claim: new or failed studies
+# with attempts left, or active ones whose owner let the lease lapse. Forced
+# claims also take finished studies, but never one under a live lease.
+CLAIMABLE = (
+    "((state IN ('queued', 'failed') "
+    f"OR (state IN {ACTIVE_STUDY_JOB_STATES} AND lease_expires_at < now())) "
+    "AND attempts < :max_attempts)"
+)
+FORCE_CLAIMABLE = (
+    f"(state NOT IN {ACTIVE_STUDY_JOB_STATES} OR lease_expires_at < now())"
+)
+
+
 def create_schema() -> None:
-    """Create the database schema."""
+    """
+    Create the database schema.
+
+    processed_uuids used to be a table. It is now a view of the done rows in
+    study_jobs; an existing table is migrated into study_jobs and replaced.
+    """
     metadata_obj = MetaData()
 
-    processed_uuids = Table(
-        "processed_uuids",
+    study_jobs = Table(
+        "study_jobs",
         metadata_obj,
         # Orthanc uses the term "UUID" when referring to a study, but this is
         # misleading. Orthanc actually derives identifiers from an SHA-1 hash.
         # https://github.com/jodogne/OrthancMirror/blob/305b1798a9c90adc128fcbcdd6a357fa9a547498/OrthancFramework/Sources/Toolbox.cpp#L750-L775
-        Column("uuid", CHAR(45), primary_key=True),
+        Column("uuid", String(45), primary_key=True),
+        Column("state", String(16), nullable=False, server_default="queued"),
+        Column("attempts", Integer, nullable=False, server_default="0"),
+        Column("lease_owner", String(255)),
+        Column("lease_expires_at", DateTime(timezone=True)),
+        Column("last_error", Text),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Column("claimed_at", DateTime(timezone=True)),
+        Column("finished_at", DateTime(timezone=True)),
+        CheckConstraint(f"state IN {STUDY_JOB_STATES}", name="study_jobs_state_check"),
+        Index("study_jobs_state_created_at_idx", "state", "created_at"),
+    )
+
+    orthanc_changes_cursor = Table(
+        "orthanc_changes_cursor",
+        metadata_obj,
+        # A single row holding the sequence number of the last Orthanc change
+        # that incremental discovery has consumed.
+        Column("id", Integer, primary_key=True),
+        Column("last_seq", BigInteger, nullable=False),
+        Column("updated_at", DateTime(timezone=True), server_default=func.now()),
     )
 
     metadata_obj.create_all(engine)
 
+    with engine.begin() as connection:
+        relkind = connection.execute(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass('processed_uuids')")
+        ).scalar()
+        if relkind == "r":
+            logger.info("Migrating processed_uuids table into study_jobs...")
+            connection.execute(
+                text(
+                    "INSERT INTO study_jobs (uuid, state, finished_at) "
+                    "SELECT rtrim(uuid), 'done', now() FROM processed_uuids "
+                    "ON CONFLICT (uuid) DO UPDATE SET state = 'done'"
+                )
+            )
+            connection.execute(text("DROP TABLE processed_uuids"))
+        connection.execute(
+            text(
+                "CREATE OR REPLACE VIEW processed_uuids AS "
+                "SELECT uuid FROM study_jobs WHERE state = 'done'"
+            )
+        )
+
 
-def import_uuids_from_set(uuids: set[str]) -> None:
-    """Import processed UUIDs into the database."""
+def import_uuids_from_set(uuids: Iterable[str], chunk_size: int = 10000) -> tuple[int, int]:
+    """
+    Import processed UUIDs into the database.
+
+    UUIDs are marked done in study_jobs chunk_size at a time, one statement
+    and commit per chunk, and ones that are already done are skipped rather
+    than aborting the import, so it is safe to re-run. Returns (inserted,
+    skipped) counts.
+    """
+    uuids = iter(uuids)
+    inserted = 0
+    skipped = 0
     with Session(engine) as session:
-        session.execute(
-            text("INSERT INTO processed_uuids (uuid) VALUES (:uuid)"),
-            [{"uuid": uuid} for uuid in uuids],
+        while chunk := list(islice(uuids, chunk_size)):
+            result = session.execute(
+                text(
+                    "INSERT INTO study_jobs (uuid, state, finished_at) "
+                    "SELECT DISTINCT unnest(CAST(:uuids AS TEXT[])), 'done', now() "
+                    "ON CONFLICT (uuid) DO UPDATE "
+                    "SET state = 'done', finished_at = now(), updated_at = now(), "
+                    "lease_owner = NULL, lease_expires_at = NULL "
+                    "WHERE study_jobs.state <> 'done'"
+                ),
+                {"uuids": chunk},
+            )
+            session.commit()
+            inserted += result.rowcount
+            skipped += len(chunk) - result.rowcount
+    return inserted, skipped
+
+
+def enqueue_studies(uuids: Iterable[str]) -> int:
+    """Queue studies for processing. Returns how many were newly queued."""
+    with Session(engine) as session:
+        result = session.execute(
+            text(
+                "INSERT INTO study_jobs (uuid) "
+                "SELECT DISTINCT unnest(CAST(:uuids AS TEXT[])) "
+                "ON CONFLICT (uuid) DO NOTHING"
+            ),
+            {"uuids": list(uuids)},
         )
         session.commit()
+        return result.rowcount
 
 
-def get_all_processed_uuids() -> list[str]:
-    """Get a list of all processed UUIDs."""
+def _claim(condition: str, owner: str, params: dict) -> Optional[str]:
     with Session(engine) as session:
-        result = session.execute(text("SELECT uuid FROM processed_uuids"))
-        return result.scalars().all()
+        uuid = session.execute(
+            text(
+                "UPDATE study_jobs SET state = 'claimed', lease_owner = :owner, "
+                "lease_expires_at = now() + make_interval(secs => :lease_seconds), "
+                "attempts = attempts + 1, claimed_at = now(), updated_at = now(), "
+                "finished_at = NULL "
+                "WHERE uuid = ("
+                f"SELECT uuid FROM study_jobs WHERE {condition} "
+                "ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                "RETURNING uuid"
+            ),
+            {
+                "owner": owner,
+                "lease_seconds": STUDY_JOB_LEASE_SECONDS,
+                "max_attempts": STUDY_JOB_MAX_ATTEMPTS,
+                **params,
+            },
+        ).scalar()
+        session.commit()
+        return uuid
+
+
+def claim_next_study(owner: str) -> Optional[str]:
+    """
+    Atomically claim the oldest claimable study for owner and return its
+    UUID, or None if there is nothing to do. Concurrent workers skip rows
+    locked by each other, so no study is handed out twice.
+    """
+    fail_abandoned_studies()
+    return _claim(CLAIMABLE, owner, {})
+
+
+def fail_abandoned_studies() -> int:
+    """
+    Mark failed the active studies whose lease lapsed on their last attempt
+    (e.g., their worker crashed). No worker may claim them again, so they
+    would otherwise stay active forever. Returns how many were failed.
+    """
+    with Session(engine) as session:
+        result = session.execute(
+            text(
+                "UPDATE study_jobs SET state = 'failed', "
+                "last_error = 'Lease held by ' || coalesce(lease_owner, 'unknown worker') "
+                "|| ' expired while ' || state || ' on the last attempt.', "
+                "lease_owner = NULL, lease_expires_at = NULL, finished_at = now(), updated_at = now() "
+                f"WHERE state IN {ACTIVE_STUDY_JOB_STATES} AND lease_expires_at < now() "
+                "AND attempts >= :max_attempts"
+            ),
+            {"max_attempts": STUDY_JOB_MAX_ATTEMPTS},
+        )
+        session.commit()
+        if result.rowcount:
+            logger.warning("Failed %d studies abandoned on their last attempt.", result.rowcount)
+        return result.rowcount
+
+
+def claim_study(uuid: str, owner: str, force: bool = False) -> bool:
+    """
+    Claim a specific study for owner, queueing it first if it is new.
+    Returns False if another worker holds it, it is already done, or it has
+    used up its attempts. With force, done and exhausted studies are
+    reclaimed too.
+    """
+    enqueue_studies([uuid])
+    condition = FORCE_CLAIMABLE if force else CLAIMABLE
+    return _claim(f"uuid = :uuid AND {condition}", owner, {"uuid": uuid}) is not None
+
+
+def update_study_jobs(uuids: Iterable[str], owner: str, state: str, error: str = None) -> int:
+    """
+    Move studies held by owner to state, renewing their lease. Finishing
+    (done or failed) releases the lease. Returns how many rows owner still
+    held.
+    """
+    if state not in STUDY_JOB_STATES:
+        raise ValueError(f"Invalid study job state {state!r}.")
+    finished = state in ("done", "failed")
+    with Session(engine) as session:
+        result = session.execute(
+            text(
+                "UPDATE study_jobs SET state = :state, updated_at = now(), "
+                "last_error = :error, "
+                + (
+                    "lease_owner = NULL, lease_expires_at = NULL, finished_at = now() "
+                    if finished
+                    else "lease_expires_at = now() + make_interval(secs => :lease_seconds) "
+                )
+                + "WHERE uuid = ANY(CAST(:uuids AS TEXT[])) AND lease_owner = :owner"
+            ),
+            {
+                "state": state,
+                "error": error,
+                "owner": owner,
+                "uuids": list(uuids),
+                "lease_seconds": STUDY_JOB_LEASE_SECONDS,
+            },
+        )
+        session.commit()
+        return result.rowcount
+
+
+def renew_study_leases(uuids: Iterable[str], owner: str) -> int:
+    """
+    Extend owner's lease on active studies without changing their state.
+    Returns how many rows owner still held.
+    """
+    with Session(engine) as session:
+        result = session.execute(
+            text(
+                "UPDATE study_jobs SET updated_at = now(), "
+                "lease_expires_at = now() + make_interval(secs => :lease_seconds) "
+                "WHERE uuid = ANY(CAST(:uuids AS TEXT[])) AND lease_owner = :owner "
+                f"AND state IN {ACTIVE_STUDY_JOB_STATES}"
+            ),
+            {"uuids": list(uuids), "owner": owner, "lease_seconds": STUDY_JOB_LEASE_SECONDS},
+        )
+        session.commit()
+        return result.rowcount
+
+
+class LeaseHeartbeat:
+    """
+    Renews owner's lease on studies every interval seconds (a quarter of the
+    lease by default) from a background thread, for as long as the block runs,
+    so that a long stage (e.g., a large download or conversion) doesn't
+    outlive the lease and let another worker reclaim the study.
+    """
+
+    def __init__(self, uuids: Iterable[str], owner: str, interval: float = None):
+        self.uuids = list(uuids)
+        self.owner = owner
+        self.interval = interval or STUDY_JOB_LEASE_SECONDS / 4
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                held = renew_study_leases(self.uuids, self.owner)
+            except Exception:  # e.g., a database blip; try again next beat
+                logger.exception("Failed to renew the lease on %s.", ", ".join(self.uuids))
+                continue
+            if held != len(self.uuids):
+                logger.warning(
+                    "Lost the claim on %d of %d UUID(s); another worker may have taken over.",
+                    len(self.uuids) - held,
+                    len(self.uuids),
+                )
+
+
+def get_unprocessed_uuids(uuids: Iterable[str], batch_size: int = 10000) -> Iterator[str]:
+    """
+    Yield the UUIDs in uuids that are not done in study_jobs.
+
+    The candidates are COPYed into a temporary table in batches and
+    anti-joined against study_jobs inside the database. Results are
+    streamed back through a server-side cursor, so neither side of the diff
+    is held in memory here.
+    """
+    uuids = iter(uuids)
+    with engine.connect() as connection, connection.begin():
+        connection.execute(
+            text(
+                "CREATE TEMPORARY TABLE candidate_uuids (uuid TEXT NOT NULL) "
+                "ON COMMIT DROP"
+            )
+        )
+        # psycopg2's COPY isn't exposed through SQLAlchemy, so use the DBAPI
+        # cursor of this same connection.
+        cursor = connection.connection.cursor()
+        while batch := list(islice(uuids, batch_size)):
+            cursor.copy_expert(
+                "COPY candidate_uuids (uuid) FROM STDIN",
+                io.StringIO("".join(f"{uuid}\n" for uuid in batch)),
+            )
+        connection.execute(text("ANALYZE candidate_uuids"))
+
+        result = connection.execution_options(stream_results=True).execute(
+            text(
+                "SELECT DISTINCT candidate_uuids.uuid FROM candidate_uuids "
+                "WHERE NOT EXISTS ("
+                "SELECT 1 FROM study_jobs "
+                "WHERE study_jobs.uuid = candidate_uuids.uuid AND study_jobs.state = 'done')"
+            )
+        )
+        for partition in result.scalars().partitions(batch_size):
+            yield from partition
+
+
+def get_changes_cursor() -> Optional[int]:
+    """Get the last consumed Orthanc change sequence number, if any."""
+    with Session(engine) as session:
+        result = session.execute(
+            text("SELECT last_seq FROM orthanc_changes_cursor WHERE id = 1")
+        )
+        return result.scalar()
+
+
+def set_changes_cursor(last_seq: int) -> None:
+    """Record the last consumed Orthanc change sequence number."""
+    with Session(engine) as session:
+        session.execute(
+            text(
+                "INSERT INTO orthanc_changes_cursor (id, last_seq, updated_at) "
+                "VALUES (1, :last_seq, now()) "
+                "ON CONFLICT (id) DO UPDATE "
+                "SET last_seq = EXCLUDED.last_seq, updated_at = EXCLUDED.updated_at"
+            ),
+            {"last_seq": last_seq},
+        )
+        session.commit()
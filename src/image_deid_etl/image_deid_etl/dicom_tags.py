@@ -0,0 +1,265 @@
+import math
+import os
+import struct
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, NamedTuple, Optional
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Record field -> DICOM keyword for every tag the pipeline looks at.
+HEADER_FIELDS = {
+    "patient_id": "PatientID",  # (0010,0020) MRN
+    "patient_name": "PatientName",  # (0010,0010)
+    "patient_birth_date": "PatientBirthDate",  # (0010,0030)
+    "accession_number": "AccessionNumber",  # (0008,0050)
+    "modality": "Modality",  # (0008,0060)
+    "study_date": "StudyDate",  # (0008,0020)
+    "study_time": "StudyTime",  # (0008,0030)
+    "acquisition_date": "AcquisitionDate",  # (0008,0022)
+    "instance_creation_date": "InstanceCreationDate",  # (0008,0012)
+    "study_description": "StudyDescription",  # (0008,1030)
+    "series_description": "SeriesDescription",  # (0008,103E)
+    "requested_procedure_description": "RequestedProcedureDescription",  # (0032,1060)
+    "performed_procedure_description": "PerformedProcedureStepDescription",  # (0040,0254)
+    "series_instance_uid": "SeriesInstanceUID",  # (0020,000E)
+    "sop_instance_uid": "SOPInstanceUID",  # (0008,0018)
+    "series_number": "SeriesNumber",  # (0020,0011)
+    "pixel_spacing": "PixelSpacing",  # (0028,0030)
+    "spacing_between_slices": "SpacingBetweenSlices",  # (0018,0088)
+}
+
+# Most files handed to a scan worker at once; large enough to amortize the
+# inter-process round trip, small enough to keep every worker busy.
+SCAN_BATCH_SIZE = 256
+
+# A DICOM file starts with a 128-byte preamble and the "DICM" prefix...
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+# ...except for old (e.g., ACR-NEMA style) files, which start straight at the
+# first data element: a (group, element) tag from one of these groups, then
+# either an explicit VR or an implicit-VR value length.
+BARE_DICOM_GROUPS = (0x0002, 0x0008)
+BARE_DICOM_MAX_FIRST_LENGTH = 0x10000
+DICOM_VRS = frozenset(
+    b"AE AS AT CS DA DS DT FL FD IS LO LT OB OD OF OL OV OW PN SH SL SQ SS ST SV TM UC UI UL UN UR US UT UV".split()
+)
+
+
+class DicomHeader(NamedTuple):
+    """
+    The header fields of one DICOM file that the pipeline uses. A field is
+    None when its tag is absent from the file.
+    """
+
+    path: str
+    patient_id: Optional[str]
+    patient_name: Optional[str]
+    patient_birth_date: Optional[str]
+    accession_number: Optional[str]
+    modality: Optional[str]
+    study_date: Optional[str]
+    study_time: Optional[str]
+    acquisition_date: Optional[str]
+    instance_creation_date: Optional[str]
+    study_description: Optional[str]
+    series_description: Optional[str]
+    requested_procedure_description: Optional[str]
+    performed_procedure_description: Optional[str]
+    series_instance_uid: Optional[str]
+    sop_instance_uid: Optional[str]
+    series_number: Optional[int]
+    pixel_spacing: Optional[tuple[float, float]]
+    spacing_between_slices: Optional[float]
+    transfer_syntax_uid: Optional[str]
+
+
+def _convert(field: str, value):
+    # Text fields keep empty strings; callers distinguish an empty tag from a
+    # missing one. Numeric fields that are malformed (e.g., a non-numeric or
+    # single-valued PixelSpacing) are None, as if they were missing.
+    if value is None:
+        return None
+    if field == "patient_name":
+        return str(value)
+    if field in ("series_number", "pixel_spacing", "spacing_between_slices") and value == "":
+        return None
+    try:
+        if field == "series_number":
+            return int(value)
+        if field == "pixel_spacing":
+            spacing = tuple(float(spacing) for spacing in value)
+            return spacing if len(spacing) == 2 else None
+        if field == "spacing_between_slices":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return value
+
+
+def read_dicom_header(path: str, fp=None, force: bool = False) -> DicomHeader:
+    """
+    Read only the tags in HEADER_FIELDS from a DICOM file (or fp, already
+    open on it), stopping before the pixel data, so the (potentially huge)
+    image payload is never loaded.
+    """
+    ds = pydicom.dcmread(
+        fp or path,
+        stop_before_pixels=True,
+        specific_tags=list(HEADER_FIELDS.values()),
+        force=force,
+    )
+    values = {}
+    for field, keyword in HEADER_FIELDS.items():
+        try:
+            element = ds.get(keyword)
+        except (TypeError, ValueError):  # pydicom couldn't convert the raw value
+            element = None
+        values[field] = _convert(field, element)
+    file_meta = getattr(ds, "file_meta", None)
+    transfer_syntax_uid = getattr(file_meta, "TransferSyntaxUID", None)
+    return DicomHeader(
+        path=path,
+        transfer_syntax_uid=str(transfer_syntax_uid) if transfer_syntax_uid else None,
+        **values,
+    )
+
+
+def dicom_prefix_kind(prefix: bytes) -> Optional[str]:
+    """
+    Classify the first DICOM_PREAMBLE_LENGTH + 4 bytes of a file: "preamble"
+    for a standard DICOM file, "bare" for one that looks like a DICOM data set
+    without the preamble, None for anything else.
+    """
+    if prefix[DICOM_PREAMBLE_LENGTH : DICOM_PREAMBLE_LENGTH + 4] == DICOM_PREFIX:
+        return "preamble"
+    if len(prefix) < 8:
+        return None
+    group, element, length = struct.unpack("<HHI", prefix[:8])
+    if group not in BARE_DICOM_GROUPS or element > 0x00FF:
+        return None
+    if prefix[4:6] in DICOM_VRS or length < BARE_DICOM_MAX_FIRST_LENGTH:
+        return "bare"
+    return None
+
+
+def sniff_dicom_header(path: str) -> Optional[DicomHeader]:
+    """
+    The header of path (as read_dicom_header) if it is a DICOM file, or None
+    if it isn't, in one open of the file. This is what libmagic's
+    "DICOM medical imaging data" check looks for, plus preamble-less files.
+    """
+    with open(path, "rb") as fp:
+        kind = dicom_prefix_kind(fp.read(DICOM_PREAMBLE_LENGTH + 4))
+        if kind is None:
+            return None
+        fp.seek(0)
+        if kind == "preamble":
+            return read_dicom_header(path, fp)
+        try:
+            # Non-DICOM bytes make pydicom warn about, e.g., unknown encodings.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                header = read_dicom_header(path, fp, force=True)
+        except Exception:  # not a DICOM after all
+            return None
+    # Forced reads accept almost anything; a real data set has some of our tags.
+    if all(value is None for value in header[1:]):
+        return None
+    return header
+
+
+def missing_as_list(value):
+    """Map a missing tag (None) to [], the pipeline's historical placeholder."""
+    return [] if value is None else value
+
+
+def available_cpus() -> int:
+    """
+    The number of CPUs this process may use: the cgroup CPU quota (e.g., the
+    vCPUs of an AWS Batch job) when there is one, otherwise the number of CPUs
+    it may be scheduled on.
+    """
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def _read_header_or_none(path: str) -> Optional[DicomHeader]:
+    try:
+        return read_dicom_header(path)
+    except InvalidDicomError:
+        return None
+
+
+class HeaderScanner:
+    """
+    Reads DICOM headers in batches across a pool of worker processes. Results
+    come back in input order, so a scan produces exactly what reading the
+    files one by one would.
+
+    With workers=0 the pool is sized to available_cpus(); with one worker (or
+    one CPU) files are read in this process.
+    """
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers or available_cpus()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def scan(self, paths: Iterable[str], skip_invalid: bool = False) -> list:
+        """
+        Read the headers of paths. A file that isn't DICOM raises
+        InvalidDicomError, or yields None when skip_invalid is set.
+        """
+        return self._map(_read_header_or_none if skip_invalid else read_dicom_header, paths)
+
+    def sniff(self, paths: Iterable[str]) -> list:
+        """sniff_dicom_header for every one of paths: None for files that aren't DICOM."""
+        return self._map(sniff_dicom_header, paths)
+
+    def _map(self, read, paths: Iterable[str]) -> list:
+        paths = list(paths)
+        if self.workers == 1 or len(paths) <= 1:
+            return [read(path) for path in paths]
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        chunksize = max(1, min(SCAN_BATCH_SIZE, math.ceil(len(paths) / self.workers)))
+        return list(self._executor.map(read, paths, chunksize=chunksize))
+
+
+def scan_dicom_headers(paths: Iterable[str], workers: int = 0, skip_invalid: bool = False) -> list:
+    """Read the headers of paths with a one-off HeaderScanner."""
+    with HeaderScanner(workers) as scanner:
+        return scanner.scan(paths, skip_invalid)
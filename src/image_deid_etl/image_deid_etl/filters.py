@@ -0,0 +1,79 @@
+import importlib.resources as pkg_resources
+import json
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_series_filters() -> dict:
+    """
+    Load the rules for series we never process from series_filters.json:
+      - modalities: series (acquisition) modalities to drop, e.g. OT or SR
+      - session_descriptions: case-insensitive substrings of a study's
+        description (session label) that drop the whole study
+      - series_descriptions: case-insensitive substrings of a series'
+        description that drop the series (e.g., localizers, screen saves
+        and dose reports)
+    """
+    return json.load(pkg_resources.open_text(__package__, "series_filters.json"))
+
+
+def is_excluded_series(
+    modality: str, study_description: str, skip_modalities=(), series_description: str = ""
+) -> bool:
+    rules = load_series_filters()
+    if modality in rules["modalities"] or modality in skip_modalities:
+        return True
+    if any(match.lower() in series_description.lower() for match in rules["series_descriptions"]):
+        return True
+    return any(
+        match.lower() in study_description.lower()
+        for match in rules["session_descriptions"]
+    )
+
+
+def partition_series(study_metadata: dict, series_metadata: list, skip_modalities=()):
+    """
+    Split Orthanc series metadata into (series to download, series to skip)
+    using the rules in series_filters.json plus skip_modalities.
+    """
+    study_description = study_metadata["MainDicomTags"].get("StudyDescription", "")
+    keep = []
+    skip = []
+    for series in series_metadata:
+        modality = series["MainDicomTags"].get("Modality", "")
+        series_description = series["MainDicomTags"].get("SeriesDescription", "")
+        if is_excluded_series(modality, study_description, skip_modalities, series_description):
+            skip.append(series)
+        else:
+            keep.append(series)
+    return keep, skip
+
+
+def delete_excluded_acquisitions(data_dir: str) -> None:
+    """
+    Apply the rules in series_filters.json to a downloaded {sub}/{ses}/{acq}
+    tree, for anything that could not be filtered before download, in one
+    walk of the tree.
+    """
+    from image_deid_etl.header_index import open_header_index
+    from image_deid_etl.pruning import (
+        acquisitions_matching,
+        acquisitions_with_modality,
+        prune_tree,
+        sessions_matching,
+    )
+
+    rules = load_series_filters()
+    index = open_header_index(data_dir)  # DICOM header index, if one was built
+    try:
+        prune_tree(
+            data_dir,
+            [
+                acquisitions_with_modality(rules["modalities"], index),
+                acquisitions_matching(rules["series_descriptions"]),
+                sessions_matching(rules["session_descriptions"]),
+            ],
+        )
+    finally:
+        if index:
+            index.close()
@@ -0,0 +1,281 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from glob import glob
+from typing import Iterable, Iterator, Optional
+
+from pydicom.errors import InvalidDicomError
+
+from image_deid_etl.dicom_tags import DicomHeader, read_dicom_header, scan_dicom_headers
+
+logger = logging.getLogger(__name__)
+
+# DicomHeader fields stored as-is; pixel_spacing is split into two columns.
+_TEXT_FIELDS = [
+    field
+    for field in DicomHeader._fields
+    if field not in ("path", "series_number", "pixel_spacing", "spacing_between_slices")
+]
+
+_COLUMNS = (
+    ["directory", "filename"]
+    + _TEXT_FIELDS
+    + [
+        "series_number",
+        "pixel_spacing_row",
+        "pixel_spacing_column",
+        "spacing_between_slices",
+    ]
+)
+
+_SCHEMA = f"""
+CREATE TABLE headers (
+    directory TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    {", ".join(f"{field} TEXT" for field in _TEXT_FIELDS)},
+    series_number INTEGER,
+    pixel_spacing_row REAL,
+    pixel_spacing_column REAL,
+    spacing_between_slices REAL,
+    PRIMARY KEY (directory, filename)
+);
+CREATE TABLE acquisitions (
+    directory TEXT PRIMARY KEY,
+    dicom_count INTEGER NOT NULL,
+    newest_mtime_ns INTEGER NOT NULL
+)
+"""
+
+# Depth of the acquisition directories in a {sub}/{ses}/{acq} tree.
+_ACQUISITION_DEPTH = 3
+
+
+def header_index_path(data_dir: str) -> str:
+    """
+    The index for data_dir lives next to it (e.g., DICOMs.index.sqlite), so
+    globs over data_dir never see it.
+    """
+    return os.path.normpath(data_dir) + ".index.sqlite"
+
+
+def _fingerprint(acquisition: str) -> tuple[int, int]:
+    """The number of .dcm files in an acquisition directory and the newest of their mtimes."""
+    count = newest = 0
+    with os.scandir(acquisition) as entries:
+        for entry in entries:
+            if entry.name.endswith(".dcm") and entry.is_file():
+                count += 1
+                newest = max(newest, entry.stat().st_mtime_ns)
+    return count, newest
+
+
+def _to_row(data_dir: str, header: DicomHeader) -> tuple:
+    relative_path = os.path.relpath(header.path, data_dir)
+    pixel_spacing = header.pixel_spacing or (None, None)
+    return (
+        os.path.dirname(relative_path),
+        os.path.basename(relative_path),
+        *(getattr(header, field) for field in _TEXT_FIELDS),
+        header.series_number,
+        *pixel_spacing[:2],
+        header.spacing_between_slices,
+    )
+
+
+def _from_row(data_dir: str, row: sqlite3.Row) -> DicomHeader:
+    pixel_spacing = None
+    if row["pixel_spacing_row"] is not None:
+        pixel_spacing = (row["pixel_spacing_row"], row["pixel_spacing_column"])
+    return DicomHeader(
+        path=os.path.join(data_dir, row["directory"], row["filename"]),
+        series_number=row["series_number"],
+        pixel_spacing=pixel_spacing,
+        spacing_between_slices=row["spacing_between_slices"],
+        **{field: row[field] for field in _TEXT_FIELDS},
+    )
+
+
+class HeaderIndex:
+    """
+    A SQLite table of the header of every DICOM in a {sub}/{ses}/{acq} tree,
+    keyed by acquisition directory (relative to data_dir) and file name.
+
+    The index also records a fingerprint of each acquisition's DICOMs (their
+    number and newest mtime). Lookups only use the indexed headers of an
+    acquisition whose fingerprint still matches; the headers of acquisitions
+    that changed, or that the index doesn't know, are read from their files.
+    Acquisitions no longer on disk are skipped.
+    """
+
+    def __init__(self, data_dir: str, path: str):
+        self.data_dir = os.path.normpath(data_dir)
+        self.path = path
+        # Stages may query the index from worker threads; one at a time.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+    def _relative(self, directory: str) -> str:
+        relative = os.path.relpath(os.path.normpath(directory), self.data_dir)
+        return "" if relative == "." else relative
+
+    def _select(self, table: str, prefix: str) -> list[sqlite3.Row]:
+        # Rows of table for the acquisitions under the relative directory prefix.
+        with self._lock:
+            return self._connection.execute(
+                f"""
+                SELECT * FROM {table}
+                WHERE :prefix = '' OR directory = :prefix
+                    OR substr(directory, 1, length(:prefix) + 1) = :prefix || '/'
+                ORDER BY directory
+                """,
+                {"prefix": prefix},
+            ).fetchall()
+
+    def headers(self, directory: str) -> list[DicomHeader]:
+        """Headers of every DICOM under directory, in path order."""
+        prefix = self._relative(directory)
+        depth = len(prefix.split(os.sep)) if prefix else 0
+        if depth > _ACQUISITION_DEPTH:
+            return []
+        acquisitions = sorted(
+            os.path.relpath(path, self.data_dir)
+            for path in glob(os.path.join(directory, *["*"] * (_ACQUISITION_DEPTH - depth)))
+            if os.path.isdir(path)
+        )
+        fingerprints = {
+            row["directory"]: (row["dicom_count"], row["newest_mtime_ns"])
+            for row in self._select("acquisitions", prefix)
+        }
+        fresh = {
+            acquisition
+            for acquisition in acquisitions
+            if fingerprints.get(acquisition) == _fingerprint(os.path.join(self.data_dir, acquisition))
+        }
+        indexed = {}
+        if fresh:
+            for row in self._select("headers", prefix):
+                if row["directory"] in fresh:
+                    indexed.setdefault(row["directory"], []).append(row)
+
+        headers = []
+        for acquisition in acquisitions:
+            if acquisition in fresh:
+                rows = sorted(indexed.get(acquisition, []), key=lambda row: row["filename"])
+                headers.extend(_from_row(self.data_dir, row) for row in rows)
+            else:
+                logger.debug("Reading the headers of %s: not in the index or changed since.", acquisition)
+                path = os.path.join(self.data_dir, acquisition)
+                headers.extend(_read_headers(sorted(glob(os.path.join(path, "*.dcm")))))
+        return headers
+
+    def modality(self, directory: str) -> Optional[str]:
+        """The most common Modality among the DICOMs of an acquisition directory."""
+        modalities = Counter(
+            header.modality for header in self.headers(directory) if header.modality is not None
+        )
+        if not modalities:
+            return None
+        return min(modalities, key=lambda modality: (-modalities[modality], modality))
+
+
+def _dicom_paths(data_dir: str) -> list[str]:
+    return sorted(glob(os.path.join(data_dir, "*", "*", "*", "*.dcm")))
+
+
+def _read_headers(paths: Iterable[str]) -> Iterator[DicomHeader]:
+    for path in paths:
+        try:
+            yield read_dicom_header(path)
+        except InvalidDicomError:
+            logger.warning("Skipping %s: not a DICOM file.", path)
+
+
+def build_header_index(data_dir: str, workers: int = 0) -> HeaderIndex:
+    """
+    Read the header of every {sub}/{ses}/{acq}/*.dcm file under data_dir once,
+    with a pool of workers processes (0 sizes it to the CPU quota), and store
+    them in a fresh index, replacing any previous one.
+    """
+    start = time.perf_counter()
+    path = header_index_path(data_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+    paths = _dicom_paths(data_dir)
+    # Fingerprint the acquisitions before reading them, so that changes made
+    # during the scan make the fingerprint stale rather than the headers.
+    acquisitions = sorted({os.path.dirname(file_path) for file_path in paths})
+    fingerprints = [
+        (os.path.relpath(acquisition, data_dir), *_fingerprint(acquisition))
+        for acquisition in acquisitions
+    ]
+    headers = []
+    for file_path, header in zip(paths, scan_dicom_headers(paths, workers, skip_invalid=True)):
+        if header is None:
+            logger.warning("Skipping %s: not a DICOM file.", file_path)
+        else:
+            headers.append(header)
+
+    index = HeaderIndex(data_dir, path)
+    with index._connection:
+        index._connection.executescript(_SCHEMA)
+        index._connection.executemany(
+            "INSERT INTO acquisitions (directory, dicom_count, newest_mtime_ns) VALUES (?, ?, ?)",
+            fingerprints,
+        )
+        index._connection.executemany(
+            f"INSERT INTO headers ({', '.join(_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+            (_to_row(data_dir, header) for header in headers),
+        )
+    logger.info(
+        "Indexed %d DICOM headers in %.1f seconds.", len(index), time.perf_counter() - start
+    )
+    return index
+
+
+def open_header_index(data_dir: str) -> Optional[HeaderIndex]:
+    """
+    Open the index built for data_dir, or return None if there isn't one (or
+    it predates acquisition fingerprints, so none of its headers can be trusted).
+    """
+    path = header_index_path(data_dir)
+    if not os.path.exists(path):
+        return None
+    index = HeaderIndex(data_dir, path)
+    with index._lock:
+        fingerprinted = index._connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'acquisitions'"
+        ).fetchone()
+    if fingerprinted is None:
+        logger.warning("Ignoring the header index %s: it has no acquisition fingerprints.", path)
+        index.close()
+        return None
+    return index
+
+
+def read_headers(directory: str, pattern: str, index: HeaderIndex = None) -> Iterable[DicomHeader]:
+    """
+    Headers of the DICOMs under directory: from index when there is one,
+    otherwise read lazily from the files matching the glob pattern, so that
+    callers can stop early.
+    """
+    if index is not None:
+        return index.headers(directory)
+    return _read_headers(glob(os.path.join(directory, pattern)))
@@ -1,6 +1,4 @@
 import nibabel as nib
-import matplotlib.image
-from matplotlib import cm
 import numpy as np
 import cv2
 from PIL import Image
@@ -29,6 +27,9 @@ def merge_images_vertically(imgs):
 def resize_im(input_im,max_w,max_h):
     return cv2.resize(input_im, dsize=(max_w, max_h), interpolation=cv2.INTER_CUBIC)
 
+# dtypes cv2.resize interpolates natively; anything else is resized as float32
+RESIZE_DTYPES = [np.dtype(dtype) for dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64)]
+
 def split_image(img_fdata,x,y,z):
     z_slice_numer = round(z/2)
     z_slice = img_fdata[:, :, z_slice_numer]
@@ -36,6 +37,11 @@ def split_image(img_fdata,x,y,z):
     y_slice = img_fdata[:, y_slice_number, :]
     x_slice_number = round(x/2)
     x_slice = img_fdata[x_slice_number, :, :]
+    return stack_slices(x_slice,y_slice,z_slice)
+
+def stack_slices(x_slice,y_slice,z_slice):
+    slices = [im if im.dtype in RESIZE_DTYPES else im.astype(np.float32) for im in (x_slice,y_slice,z_slice)]
+    (x_slice,y_slice,z_slice) = slices
     max_width = max(y_slice.shape[0],x_slice.shape[0],z_slice.shape[0])
     max_height = max(y_slice.shape[1],x_slice.shape[1],z_slice.shape[1])
     x_slice = resize_im(x_slice,max_width,max_height)
@@ -43,6 +49,26 @@ def split_image(img_fdata,x,y,z):
     z_slice = resize_im(z_slice,max_width,max_height)
     return np.hstack((x_slice,y_slice,z_slice))
 
+def read_orthogonal_slices(img):
+# the (x, y, z) mid-slices of a nibabel image (first volume of 4D data), as split_image takes them
+#   slicing img.dataobj only reads the data around each slice (memory-mapped for uncompressed
+#   .nii), never the other volumes of 4D data, & keeps the on-disk dtype unless the header
+#   scales the data
+    (x,y,z) = img.shape[0:3]
+    first_volume = (0,)*(len(img.shape)-3) # first volume of 4D data
+    z_slice = np.asarray(img.dataobj[(slice(None),slice(None),round(z/2))+first_volume])
+    y_slice = np.asarray(img.dataobj[(slice(None),round(y/2),slice(None))+first_volume])
+    x_slice = np.asarray(img.dataobj[(round(x/2),slice(None),slice(None))+first_volume])
+    return x_slice,y_slice,z_slice
+
+def window_image(image):
+# map an image's intensity range (min-max) to 0-255 grayscale
+    image = image.astype(np.float32)
+    low,high = image.min(),image.max()
+    if high == low:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return np.round((image-low)*(255/(high-low))).astype(np.uint8)
+
 def make_image_montage(filename,out_dir):
 # make one image for a given nifti file (3 dimensions, horizontally stacked)
     missing=0
@@ -51,18 +77,17 @@ def make_image_montage(filename,out_dir):
         print('ERROR WITH DATA TYPE OF NIFTI FILE. CHECK '+filename)
         missing = 1
     else:
-        img_fdata = img.get_fdata()
-        if len(img.shape) == 3:
-            (x,y,z) = img.shape
-        else:
-            (x,y,z,w) = img.shape
-            img_fdata = img_fdata[:,:,:,0]
-        montage = split_image(img_fdata,x,y,z)
+        montage = render_montage(img)
         fn = filename.split('/')[-1]
-        out_fn = out_dir+'/'+fn.strip('.nii.gz')+'.png'
-        matplotlib.image.imsave(out_fn, montage, cmap = cm.gray)
+        out_fn = out_dir+'/'+fn[:-len('.nii.gz')]+'.png'
+        Image.fromarray(montage).save(out_fn)
     return missing
 
+def render_montage(img):
+# the grayscale montage of a nibabel image's three orthogonal mid-slices (first volume of 4D data)
+#   the slices stay in their native dtype until the final intensity windowing
+    return window_image(stack_slices(*read_orthogonal_slices(img)))
+
 def make_nifti_images(data_dir, parent_dir):
 # make PNGS for all nii.gz files in NIfTIs/
     ses_list = glob(data_dir+'/*/*/*')
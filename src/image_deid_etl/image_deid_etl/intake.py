@@ -0,0 +1,193 @@
+import fcntl
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+from image_deid_etl.dicom_tags import DicomHeader, HeaderScanner, available_cpus
+
+logger = logging.getLogger(__name__)
+
+# Series modalities that never leave intake (presentation states, secondary
+# captures, key object selections and structured reports).
+EXCLUDED_MODALITIES = ["PR", "OT", "KO", "SR"]
+
+# Linux ioctl that makes a copy-on-write clone of a file (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+
+class IntakeReport(NamedTuple):
+    placed: int
+    excluded: int
+    not_dicom: int
+    directories: int
+    seconds: float
+
+
+def _reflink(source: str, target: str) -> None:
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+    shutil.copymode(source, target)
+
+
+def link_or_copy(source: str, target: str) -> None:
+    """
+    Place source at target without copying its data when possible: a hard
+    link, else a reflink, else (e.g., across filesystems) a real copy. An
+    existing target is replaced.
+    """
+    if os.path.lexists(target):
+        if os.path.samefile(source, target):
+            return
+        os.remove(target)
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        pass
+    try:
+        _reflink(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def index_accession_mapping(accession_mapping) -> dict:
+    """
+    Index an accession mapping (PatientID, StudyDate, Modality and
+    AccessionNumber columns) by (PatientID, StudyDate), for resolving the
+    accessions of DICOMs that don't have one.
+    """
+    index = {}
+    if len(accession_mapping) == 0:
+        return index
+    for patient_id, study_date, modality, accession in zip(
+        accession_mapping["PatientID"],
+        accession_mapping["StudyDate"],
+        accession_mapping["Modality"],
+        accession_mapping["AccessionNumber"],
+    ):
+        index.setdefault((patient_id, study_date), []).append((modality, accession))
+    return index
+
+
+def resolve_accession(header: DicomHeader, accession_index: dict) -> str:
+    """
+    The accession of a DICOM, filled in from accession_index when it is
+    empty: the only study of the patient on that date, or, failing that, the
+    only one of that modality.
+    """
+    accession = header.accession_number
+    if accession != "":
+        return accession
+    study_date = header.study_date
+    if study_date is None:
+        study_date = header.instance_creation_date
+    rows = accession_index.get((header.patient_id, int(study_date)), [])
+    if len(rows) != 1:
+        rows = [row for row in rows if row[0] == header.modality]
+    if len(rows) == 1:
+        return str(rows[0][1])
+    return accession
+
+
+def acquisition_dir(header: DicomHeader, out_dir: str, accession_index: dict) -> Optional[str]:
+    """
+    {out_dir}/{sub}/{session}/{acq} for a DICOM, where
+        sub = <MRN Sub-Name>
+        session = <Accession-number Study-description>
+        acq = <Series-modality Series-description>
+    or None if its modality is excluded.
+    """
+    if header.modality in EXCLUDED_MODALITIES:
+        return None
+    sub_name = header.patient_name
+    if "^" in sub_name:
+        sub_name = sub_name.split("^")
+        sub_name = sub_name[0] + " " + sub_name[1]
+    # clean rogue characters
+    study_desc = header.study_description.replace("+", "").replace("/", "")
+    series_desc = header.series_description.replace("+", "").replace("/", "")
+    sub_dir = out_dir + str(header.patient_id) + " " + str(sub_name)
+    ses_dir = sub_dir + "/" + resolve_accession(header, accession_index) + " " + study_desc
+    return ses_dir + "/" + header.modality + " " + series_desc
+
+
+def _site_files(data_dir: str) -> list[str]:
+    files = []
+    for root, dirs, names in os.walk(data_dir):
+        if "DICOMs/" in root + "/":  # already structured output
+            dirs[:] = []
+            continue
+        files.extend(os.path.join(root, name) for name in names)
+    return files
+
+
+def ingest_site_files(
+    data_dir: str, out_dir: str, accession_mapping=(), workers: int = 0
+) -> IntakeReport:
+    """
+    Structure the files an external site delivered under data_dir into
+    out_dir's {sub}/{session}/{acq} tree.
+
+    Every file is sniffed (and its header read) by a pool of workers
+    processes (0 sizes it to the CPU quota). DICOMs get a .dcm extension
+    and are placed with link_or_copy, so the delivery and the structured
+    tree share their data when they're on one filesystem. Everything else,
+    and DICOMs of excluded modalities, is deleted from data_dir. Each target
+    directory is created once, before anything is placed.
+    """
+    start = time.perf_counter()
+    workers = workers or available_cpus()
+    accession_index = index_accession_mapping(accession_mapping)
+
+    files = _site_files(data_dir)
+    candidates = [path for path in files if ".DS_Store" not in path and "DICOMDIR" not in path]
+    with HeaderScanner(workers) as scanner:
+        sniffed = dict(zip(candidates, scanner.sniff(candidates)))  # header if DICOM, else None
+
+    placements = {}  # target -> source
+    excluded = not_dicom = 0
+    for path in files:
+        header = sniffed.get(path)
+        if header is None:
+            os.remove(path)  # e.g., .DS_Store files
+            not_dicom += 1
+            continue
+        if path[-4:] != ".dcm":
+            os.rename(path, path + ".dcm")
+            path = path + ".dcm"
+        target_dir = acquisition_dir(header, out_dir, accession_index)
+        if target_dir is None:
+            os.remove(path)  # delete files of non-interest modalities
+            excluded += 1
+            continue
+        # Of several files with the same target, the last one wins, as when they were copied in turn.
+        placements[os.path.join(target_dir, os.path.basename(path))] = path
+
+    directories = sorted({os.path.dirname(target) for target in placements})
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda target: link_or_copy(placements[target], target), placements))
+
+    report = IntakeReport(
+        len(placements), excluded, not_dicom, len(directories), time.perf_counter() - start
+    )
+    logger.info(
+        "Placed %d DICOMs from %s in %d acquisitions under %s (%d excluded, %d not DICOM) in %.1f seconds.",
+        report.placed,
+        data_dir,
+        report.directories,
+        out_dir,
+        report.excluded,
+        report.not_dicom,
+        report.seconds,
+    )
+    return report
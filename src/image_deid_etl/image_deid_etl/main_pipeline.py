@@ -1,10 +1,12 @@
 import logging
+from functools import lru_cache
 
 import pandas
 
 from image_deid_etl.exceptions import ImproperlyConfigured
 from image_deid_etl.external_data_handling import *
 from image_deid_etl.images_no_save import *
+from image_deid_etl.sidecars import finalize_sidecars
 import sys
 
 logger = logging.getLogger(__name__)
@@ -16,6 +18,24 @@ if SUBJECT_ID_MAPPING_PATH is None:
     raise ImproperlyConfigured(
         "You must supply a valid string path in SUBJECT_ID_MAPPING_PATH."
     )
+# Resolve local paths now: the worker runs each study in its own working directory.
+if "://" not in SUBJECT_ID_MAPPING_PATH:
+    SUBJECT_ID_MAPPING_PATH = os.path.abspath(SUBJECT_ID_MAPPING_PATH)
+CORSICA_MAPPING_PATH = os.path.abspath('corsica_identified_mapping.csv')
+
+
+@lru_cache(maxsize=None)
+def _read_subject_id_mapping():
+    return pandas.read_csv(SUBJECT_ID_MAPPING_PATH)
+
+
+def load_subject_id_mapping(reload=False):
+    # Read SUBJECT_ID_MAPPING_PATH once per process (again with reload, e.g.
+    # when a subject isn't found, since it may have been added since); callers
+    # get a copy since the mapping functions modify the frame in place.
+    if reload:
+        _read_subject_id_mapping.cache_clear()
+    return _read_subject_id_mapping().copy()
 
 
 def subject_info(local_path, program, file_dir, validate=0):
@@ -28,18 +48,21 @@ def subject_info(local_path, program, file_dir, validate=0):
     if program == 'cbtn':
         # get CBTN Subject IDs
         try:
-            cbtn_all_df = pandas.read_csv(SUBJECT_ID_MAPPING_PATH)
+            cbtn_all_df = load_subject_id_mapping()
         except IndexError as error:
             logger.error("Missing CBTN subject ID .csv file from internal EIG database: %r", error)
             sys.exit(1)
         try:
-            sub_mapping,sub_missing_c_ids,sub_missing_ses = get_subject_mapping_cbtn(cbtn_all_df,sub_info,local_path)
+            sub_mapping,sub_missing_c_ids,sub_missing_ses = get_subject_mapping_cbtn(cbtn_all_df,sub_info.copy(),local_path)
+            if not sub_missing_c_ids.empty: # the cached mapping may predate these subjects; re-read it & try again
+                logger.info('Subject(s) missing from the cached subject ID mapping; reloading it.')
+                cbtn_all_df = load_subject_id_mapping(reload=True)
+                sub_mapping,sub_missing_c_ids,sub_missing_ses = get_subject_mapping_cbtn(cbtn_all_df,sub_info.copy(),local_path)
         except ValueError as error:
             logger.error("Error in getting CBTN subject mapping: %r", error)
             sys.exit(1)
     elif program == 'corsica':
-        corsica_fn='corsica_identified_mapping.csv'
-        sub_mapping,sub_missing_c_ids,sub_missing_ses = get_subject_mapping_corsica(corsica_fn,sub_info,local_path,program,'Patient_Name') # MRN or Patient_Name
+        sub_mapping,sub_missing_c_ids,sub_missing_ses = get_subject_mapping_corsica(CORSICA_MAPPING_PATH,sub_info,local_path,program,'Patient_Name') # MRN or Patient_Name
     # account for missing subject labels
     if not sub_missing_c_ids.empty:
         output_fn = file_dir+'missing_subject_ids_'+todays_date+'.csv'
@@ -93,7 +116,7 @@ def validate_info(local_path, program, file_dir):
             sub_list=sub_missing_proj['accession_num'].unique().tolist()
             print('Accessions missing projects '+', '.join(sub_list))
 
-def run_deid(local_path, program):
+def run_deid(local_path, program, convert_workers=0):
     file_dir = local_path+'files/'
     # The "files/" directory path needs to exist, otherwise subject_info will fail to write the csv files. Equivalent
     # to mkdir -p.
@@ -118,8 +141,8 @@ def run_deid(local_path, program):
         print('Unique FW-projects: '+', '.join(proj_list))
         #  convert DICOMs to NIfTI
         logger.info('Converting DICOMs to NIfTI.')
-        convert_dicom2nifti(local_path+'DICOMs/') # skips acquisition directories w/niftis already in them
-        filter_sidecars(local_path+'DICOMs/')
+        convert_dicom2nifti(local_path+'DICOMs/', convert_workers) # skips acquisition directories w/niftis already in them
+        finalize_sidecars(local_path+'DICOMs/') # add voxel dimensions & remove PHI fields, in one pass
         if sub_mapping.empty:
             raise FileNotFoundError(
                 f"'NIfTI files created but no subject mapping to use. Target directory cannot be created. Exiting..."
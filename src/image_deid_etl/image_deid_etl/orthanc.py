@@ -1,14 +1,25 @@
 import json
 import logging
 import os
+import re
+import sys
+import tempfile
+import threading
+import time
 import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+from image_deid_etl.archive import CHUNK_SIZE, extract_zip_stream, verify_zip_file
 from image_deid_etl.exceptions import ImproperlyConfigured
+from image_deid_etl.filters import partition_series
 
 logger = logging.getLogger(__name__)
 
@@ -22,38 +33,162 @@ if ORTHANC_HOST is None:
 
 ORTHANC_PORT = os.getenv("ORTHANC_PORT", 80)
 
+# Tuning knobs for the pooled HTTP session shared by every Orthanc call.
+ORTHANC_POOL_SIZE = int(os.getenv("ORTHANC_POOL_SIZE", 10))
+ORTHANC_CONNECT_TIMEOUT = float(os.getenv("ORTHANC_CONNECT_TIMEOUT", 10))
+ORTHANC_READ_TIMEOUT = float(os.getenv("ORTHANC_READ_TIMEOUT", 300))
+ORTHANC_MAX_RETRIES = int(os.getenv("ORTHANC_MAX_RETRIES", 5))
+ORTHANC_BACKOFF_FACTOR = float(os.getenv("ORTHANC_BACKOFF_FACTOR", 0.5))
+
+# Orthanc identifiers are SHA-1 hashes rendered as five dash-separated groups
+# of eight hex digits. They are collapsed so that latency is reported per
+# endpoint rather than per resource.
+ORTHANC_ID_PATTERN = re.compile(r"[0-9a-f]{8}(?:-[0-9a-f]{8}){4}")
+
+
 def get_orthanc_url():
     return f"http://{ORTHANC_CREDENTIALS}@{ORTHANC_HOST}:{ORTHANC_PORT}"
 
+
+class OrthancClient:
+    """
+    A keep-alive HTTP client for Orthanc's REST API.
+
+    Owns a single requests.Session with a sized connection pool, so repeated
+    calls reuse TCP connections instead of paying a handshake each time.
+    Connection resets and 5xx responses are retried with exponential backoff,
+    and the wall-clock time of every call is accumulated per endpoint.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        pool_size: int = ORTHANC_POOL_SIZE,
+        timeout: tuple[float, float] = (ORTHANC_CONNECT_TIMEOUT, ORTHANC_READ_TIMEOUT),
+        max_retries: int = ORTHANC_MAX_RETRIES,
+        backoff_factor: float = ORTHANC_BACKOFF_FACTOR,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            # Orthanc's POST endpoints used here (/tools/find, /instances) are
+            # safe to repeat.
+            allowed_methods=frozenset(["GET", "HEAD", "POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._latency = defaultdict(lambda: {"calls": 0, "total": 0.0, "max": 0.0})
+        self._latency_lock = threading.Lock()
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, self.base_url + path, **kwargs)
+        finally:
+            self._record_latency(method, path, time.perf_counter() - start)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def get_json(self, path: str):
+        return self.get(path).json()
+
+    def post_json(self, path: str, data: dict):
+        return self.post(path, data=json.dumps(data)).json()
+
+    def _record_latency(self, method: str, path: str, elapsed: float) -> None:
+        endpoint = f"{method} {ORTHANC_ID_PATTERN.sub('{id}', path)}"
+        with self._latency_lock:
+            counter = self._latency[endpoint]
+            counter["calls"] += 1
+            counter["total"] += elapsed
+            counter["max"] = max(counter["max"], elapsed)
+
+    def latency_report(self) -> dict[str, dict[str, float]]:
+        """Return call counts and total/mean/max seconds, keyed by endpoint."""
+        with self._latency_lock:
+            return {
+                endpoint: {**counter, "mean": counter["total"] / counter["calls"]}
+                for endpoint, counter in self._latency.items()
+            }
+
+    def log_latency_report(self) -> None:
+        report = self.latency_report()
+        for endpoint, counter in sorted(
+            report.items(), key=lambda item: item[1]["total"], reverse=True
+        ):
+            logger.info(
+                "Orthanc %s: %d call(s), %.2fs total, %.3fs mean, %.3fs max",
+                endpoint,
+                counter["calls"],
+                counter["total"],
+                counter["mean"],
+                counter["max"],
+            )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(orthanc_url: str) -> OrthancClient:
+    """Return the shared OrthancClient for orthanc_url, creating it on first use."""
+    with _clients_lock:
+        if orthanc_url not in _clients:
+            _clients[orthanc_url] = OrthancClient(orthanc_url)
+        return _clients[orthanc_url]
+
+
+def log_latency_reports() -> None:
+    """Log per-endpoint latency counters for every Orthanc client in use."""
+    for client in list(_clients.values()):
+        client.log_latency_report()
+
 def all_study_uuids(orthanc_url):
 # get a list of all study uuids for a given instance
-    return requests.get(orthanc_url+'/studies/', verify=False).json()
+    return get_client(orthanc_url).get_json('/studies/')
 
 def all_patient_uuids(orthanc_url):
-    return requests.get(orthanc_url+'/patients/', verify=False).json()
+    return get_client(orthanc_url).get_json('/patients/')
 
 def get_uuids_from_accession(orthanc_url,accession):
 # requires orthanc_url
     data = {'Level':'Study',
             'Query':{'AccessionNumber':str(accession)} }
-    data_json = json.dumps(data)
-    resp = requests.post(orthanc_url+'/tools/find', data=data_json, verify=False)
-    return resp.json()
+    return get_client(orthanc_url).post_json('/tools/find', data)
 
 def get_uuids_from_mrn(orthanc_url,mrn):
 # requires orthanc_url
     data = {'Level':'Study',
             'Query':{'PatientID':str(mrn)} }
-    data_json = json.dumps(data)
-    resp = requests.post(orthanc_url+'/tools/find', data=data_json, verify=False)
-    return resp.json()
+    return get_client(orthanc_url).post_json('/tools/find', data)
 
 def get_patient_uuid_from_mrn(orthanc_url, mrn):
     data = {'Level':'Patient',
             'Query':{'PatientID':str(mrn)} }
-    data_json = json.dumps(data)
-    resp = requests.post(orthanc_url+'/tools/find', data=data_json, verify=False)
-    return resp.json()
+    return get_client(orthanc_url).post_json('/tools/find', data)
 
 def get_uuids(orthanc_url,accession_df,in_type):
     out_list = []
@@ -81,15 +216,36 @@ def get_uuids(orthanc_url,accession_df,in_type):
 
     return out_list,missing_list,accession_df
 
+def get_last_change(orthanc_url):
+    """Return the sequence number of the most recent change on the instance."""
+    return get_client(orthanc_url).get_json('/changes?last')['Last']
+
+
+def get_stable_study_changes(orthanc_url, since, limit=1000):
+    """
+    Page through Orthanc's /changes feed after sequence number since, and
+    return ({study uuid: seq of its latest StableStudy event}, last seq read).
+    """
+    studies = {}
+    last = since
+    while True:
+        page = get_client(orthanc_url).get_json(f'/changes?since={last}&limit={limit}')
+        for change in page['Changes']:
+            if change['ChangeType'] == 'StableStudy':
+                studies[change['ID']] = change['Seq']
+        last = max(last, page['Last'])
+        if page['Done'] or not page['Changes']:
+            return studies, last
+
 def get_study_metadata(orthanc_url,uuid):
 # requires orthanc_url
-    return requests.get(orthanc_url+'/studies/'+uuid+'/', verify=False).json()
+    return get_client(orthanc_url).get_json('/studies/'+uuid+'/')
 
 def get_series_metadata(orthanc_url,uuid):
-    return requests.get(orthanc_url+'/studies/'+uuid+'/series', verify=False).json()
+    return get_client(orthanc_url).get_json('/studies/'+uuid+'/series')
 
 def get_patient_metadata(orthanc_url,uuid):
-    return requests.get(orthanc_url+'/patients/'+uuid+'/', verify=False).json()
+    return get_client(orthanc_url).get_json('/patients/'+uuid+'/')
 
 def all_instance_mrns(orthanc_url):
 # get a list of mrns for all studies on a given instance
@@ -131,9 +287,7 @@ def compare_s3_orthanc(orthanc_cred,orthanc_ip,orthanc_port,s3_path):
 
     ## create local text file with list of uuids on Orthanc & load the list
     localhost=orthanc_cred+'@'+orthanc_ip
-    os.system('curl -s -k https://'+localhost+':'+orthanc_port+'/studies > all_study_uuids_'+orthanc_ip+'.json')
-    with open('all_study_uuids_'+orthanc_ip+'.json') as data_file:
-        orthanc_uuids = json.load(data_file)
+    orthanc_uuids = all_study_uuids('https://'+localhost+':'+orthanc_port)
 
     # sort in order to compare
     s3_uuids.sort()
@@ -153,8 +307,185 @@ def compare_s3_orthanc(orthanc_cred,orthanc_ip,orthanc_port,s3_path):
         return 0
 
 
-def download_unpack_copy(orthanc_url, uuid, data_dir, ses_mod_to_skip):
-    """Download and unpack a specified study from Orthanc"""
+# Progress on a resumable download is checkpointed to its state file after
+# this many bytes.
+DOWNLOAD_CHECKPOINT_BYTES = 64 * 1024 * 1024
+
+
+def _archive_state_path(output_path):
+    return output_path + ".state.json"
+
+
+def _read_archive_state(output_path):
+    try:
+        with open(_archive_state_path(output_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_archive_state(output_path, state):
+    state_path = _archive_state_path(output_path)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def remove_study_archive(output_path):
+    """Delete a study archive along with any partial download and state file."""
+    for path in (output_path, output_path + ".part", _archive_state_path(output_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def download_study_archive(orthanc_url, uuid, output_path):
+    """
+    Save a study archive from Orthanc to output_path.
+
+    Bytes land in {output_path}.part, and the bytes received and expected size
+    are recorded in {output_path}.state.json as they arrive. If a previous
+    attempt left a partial download behind, it is resumed with an HTTP Range
+    request; if Orthanc answers with the full archive instead, the download
+    starts over.
+    """
+    part_path = output_path + ".part"
+    state = _read_archive_state(output_path)
+    offset = os.path.getsize(part_path) if state and os.path.exists(part_path) else 0
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with get_client(orthanc_url).get(
+        f"/studies/{uuid}/archive", headers=headers, stream=True
+    ) as response:
+        if response.status_code == 416 and offset == state.get("expected_size"):
+            # The previous attempt received everything but died before the
+            # rename.
+            logger.info("Partial download of study %s was already complete.", uuid)
+            os.replace(part_path, output_path)
+            return
+        response.raise_for_status()
+
+        if response.status_code == 206:
+            logger.info("Resuming download of study %s at byte %d...", uuid, offset)
+            mode = "ab"
+            # Content-Range: bytes <start>-<end>/<total>
+            expected_size = response.headers.get("Content-Range", "").rpartition("/")[2]
+        else:
+            if offset:
+                logger.info("Orthanc ignored the range request; restarting download of study %s.", uuid)
+            offset = 0
+            mode = "wb"
+            expected_size = response.headers.get("Content-Length")
+        expected_size = int(expected_size) if expected_size and expected_size.isdigit() else None
+
+        state = {"uuid": uuid, "bytes_received": offset, "expected_size": expected_size}
+        _write_archive_state(output_path, state)
+        checkpoint = offset
+        with open(part_path, mode) as outfile:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                outfile.write(chunk)
+                state["bytes_received"] += len(chunk)
+                if state["bytes_received"] - checkpoint >= DOWNLOAD_CHECKPOINT_BYTES:
+                    outfile.flush()
+                    _write_archive_state(output_path, state)
+                    checkpoint = state["bytes_received"]
+        _write_archive_state(output_path, state)
+
+    if expected_size is not None and state["bytes_received"] != expected_size:
+        raise zipfile.BadZipFile(
+            f"Study {uuid} archive truncated: expected {expected_size} bytes, "
+            f"received {state['bytes_received']}. Re-run to resume."
+        )
+    os.replace(part_path, output_path)
+
+
+def stream_unpack_study(orthanc_url, uuid, data_dir):
+    """
+    Extract a study archive from Orthanc into data_dir as it downloads, without
+    writing the archive itself to disk. Returns a byte/time report.
+    """
+    start = time.perf_counter()
+    with get_client(orthanc_url).get(f"/studies/{uuid}/archive", stream=True) as response:
+        response.raise_for_status()
+        report = extract_zip_stream(response.iter_content(chunk_size=CHUNK_SIZE), data_dir)
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and int(content_length) != report["bytes_received"]:
+            raise zipfile.BadZipFile(
+                f"Study {uuid} archive truncated: expected {content_length} bytes, "
+                f"received {report['bytes_received']}."
+            )
+    report["uuid"] = uuid
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+# Guards the final renames of series fetched in parallel, so that two series
+# landing in the same acquisition directory can't claim the same file name.
+_placement_lock = threading.Lock()
+
+
+def _place_series_files(staging_dir, data_dir, series_id):
+    """Move files extracted from one series archive into the data_dir tree."""
+    for root, _, files in os.walk(staging_dir):
+        target_dir = os.path.join(data_dir, os.path.relpath(root, staging_dir))
+        os.makedirs(target_dir, exist_ok=True)
+        with _placement_lock:
+            for file in files:
+                target_path = os.path.join(target_dir, file)
+                if os.path.exists(target_path):
+                    # Orthanc numbers instances per archive, so two series
+                    # with the same modality and description collide.
+                    target_path = os.path.join(target_dir, f"{series_id[:8]}_{file}")
+                os.replace(os.path.join(root, file), target_path)
+
+
+def fetch_series(orthanc_url, series_id, data_dir):
+    """
+    Stream one series archive from Orthanc into data_dir. Orthanc nests series
+    archives under the same {sub}/{ses}/{acq} folders as study archives.
+    """
+    # Stage under a dot-directory on the same filesystem: glob('*') ignores it
+    # and the final move is a rename.
+    with tempfile.TemporaryDirectory(prefix=".series-", dir=data_dir) as staging_dir:
+        with get_client(orthanc_url).get(f"/series/{series_id}/archive", stream=True) as response:
+            response.raise_for_status()
+            report = extract_zip_stream(response.iter_content(chunk_size=CHUNK_SIZE), staging_dir)
+        _place_series_files(staging_dir, data_dir, series_id)
+    return report
+
+
+def fetch_study_series_parallel(orthanc_url, uuid, data_dir, series, workers=4):
+    """
+    Download a study by fetching each of its series' archives concurrently,
+    using a pool of workers threads. series is the list returned by
+    get_series_metadata. Returns a byte/time report like stream_unpack_study.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(
+            executor.map(lambda info: fetch_series(orthanc_url, info["ID"], data_dir), series)
+        )
+    return {
+        "uuid": uuid,
+        "series": len(reports),
+        "members": sum(report["members"] for report in reports),
+        "bytes_received": sum(report["bytes_received"] for report in reports),
+        "bytes_written": sum(report["bytes_written"] for report in reports),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def download_unpack_copy(orthanc_url, uuid, data_dir, ses_mod_to_skip, stream=True, series_workers=0):
+    """
+    Download and unpack a specified study from Orthanc.
+
+    By default, the archive is extracted while it streams in. With stream=False,
+    the archive is first saved to {data_dir}{uuid}.zip and then extracted. With
+    series_workers > 0, the study's series archives are instead fetched
+    concurrently by that many threads. Series excluded by series_filters.json
+    or ses_mod_to_skip are never downloaded; if a study has any, its
+    remaining series are fetched individually.
+    Returns a byte/time report, or None if the study was skipped.
+    """
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
@@ -164,24 +495,82 @@ def download_unpack_copy(orthanc_url, uuid, data_dir, ses_mod_to_skip):
             "Unable to retrieve study UUID from Orthanc. Invalid study UUID? Orthanc instance up and running?"
             )
         sys.exit(1)
-    modality = info[0]['MainDicomTags']['Modality']
-    if modality not in ses_mod_to_skip:
+    # Drop unwanted series (e.g., digital radiography, ultrasound or SR
+    # documents) before transferring anything.
+    info, skipped = partition_series(get_study_metadata(orthanc_url,uuid), info, ses_mod_to_skip)
+    for series in skipped:
+        logger.info(
+            "Not downloading series %s of study %s; skipping %s %s.",
+            series['ID'],
+            uuid,
+            series['MainDicomTags'].get('Modality', ''),
+            series['MainDicomTags'].get('SeriesDescription', ''),
+        )
+    if not info:
+        logger.info("Not downloading study %s; no series left to process.", uuid)
+        return None
+    if skipped and series_workers <= 0:
+        # A study archive would include the skipped series, so fetch the
+        # remaining ones individually.
+        series_workers = 1
+
+    if series_workers > 0:
+        logger.info("Fetching %d series of study %s with %d workers...", len(info), uuid, series_workers)
+        report = fetch_study_series_parallel(orthanc_url, uuid, data_dir, info, series_workers)
+    elif stream:
+        logger.info("Streaming and extracting study %s...", uuid)
+        report = stream_unpack_study(orthanc_url, uuid, data_dir)
+    else:
+        start = time.perf_counter()
         output_path = f"{data_dir}{uuid}.zip"
 
+        expected_size = _read_archive_state(output_path).get("expected_size")
+
+        # A killed job can leave a truncated archive behind, so only trust an
+        # existing one if it passes the integrity check.
+        if os.path.exists(output_path) and not verify_zip_file(output_path, expected_size):
+            logger.warning("Archive for study %s is incomplete or corrupt. Downloading again.", uuid)
+            remove_study_archive(output_path)
+
         # Download the study archive from Orthanc.
         if not os.path.exists(output_path):
             logger.info("Downloading study %s...", uuid)
-            os.system(f"curl -s -k {orthanc_url}/studies/{uuid}/archive > {output_path}")
+            download_study_archive(orthanc_url, uuid, output_path)
+            expected_size = _read_archive_state(output_path).get("expected_size")
+            if not verify_zip_file(output_path, expected_size):
+                # Resuming across a regenerated archive can splice two
+                # different byte streams; start from scratch next time.
+                remove_study_archive(output_path)
+                raise zipfile.BadZipFile(f"Downloaded archive for study {uuid} failed the integrity check.")
         else:
             logger.info("Already downloaded study %s. Skipping download.", uuid)
 
-        # Unpack the study archive.
+        # Unpack the study archive. Member CRCs are verified as they are read.
         logger.info("Extracting study %s...", uuid)
-        with zipfile.ZipFile(output_path, 'r') as zip_ref:
-            zip_ref.extractall(data_dir)
-    else:
-        # E.g., Skip digital radiography or ultrasound images.
-        logger.info("Not downloading study %s; skipping modality %s.", uuid, modality)
+        try:
+            with zipfile.ZipFile(output_path, 'r') as zip_ref:
+                zip_ref.extractall(data_dir)
+                infolist = zip_ref.infolist()
+        except zipfile.BadZipFile:
+            remove_study_archive(output_path)
+            raise
+        report = {
+            "uuid": uuid,
+            "members": len(infolist),
+            "bytes_received": os.path.getsize(output_path),
+            "bytes_written": sum(member.file_size for member in infolist),
+            "seconds": time.perf_counter() - start,
+        }
+
+    logger.info(
+        "Study %s: %d file(s), %.1f MB received, %.1f MB extracted in %.1fs.",
+        uuid,
+        report["members"],
+        report["bytes_received"] / 1e6,
+        report["bytes_written"] / 1e6,
+        report["seconds"],
+    )
+    return report
 
 # the following code is to upload a .zip to an Orthanc instance
 #   modified from: https://hg.orthanc-server.com/orthanc/file/Orthanc-1.9.7/OrthancServer/Resources/Samples/ImportDicomFiles/OrthancImport.py
@@ -199,7 +588,7 @@ def IsJson(content):
 def UploadBuffer(dicom,target_url):
     if IsJson(dicom):
         return
-    r = requests.post('%s/instances' % target_url, verify=False, data = dicom) # this is the upload
+    r = get_client(target_url).post('/instances', data = dicom) # this is the upload
     try:
         r.raise_for_status()
     except:
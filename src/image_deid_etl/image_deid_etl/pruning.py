@@ -0,0 +1,174 @@
+import logging
+import os
+import re
+import time
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from image_deid_etl.header_index import HeaderIndex
+
+logger = logging.getLogger(__name__)
+
+# Depths of the directories in a {sub}/{ses}/{acq} tree, relative to its root.
+SUBJECT, SESSION, ACQUISITION = 1, 2, 3
+
+
+class PruneRule(NamedTuple):
+    """
+    Removes the directories at depth (or, when depth is None, the files at
+    any depth) for which matches(entry) is true, recording reason for each.
+    """
+
+    reason: str
+    depth: Optional[int]
+    matches: Callable[[os.DirEntry], bool]
+
+
+class PruneReport(NamedTuple):
+    # (path, reason) for every file or directory removed, in walk order;
+    # the contents of a removed directory are not listed separately.
+    removed: list[tuple[str, str]]
+    bytes_freed: int
+
+
+def acquisitions_with_modality(modalities: Iterable[str], index: HeaderIndex = None) -> PruneRule:
+    """
+    Acquisitions whose modality (from index when it has one, otherwise the
+    first two letters of the directory name, e.g. "OT_...") is in modalities.
+    """
+    modalities = frozenset(modalities)
+
+    def matches(entry: os.DirEntry) -> bool:
+        modality = index.modality(entry.path) if index else None
+        if modality is None:  # fall back to the modality prefix of the directory name
+            modality = entry.name[0:2]
+        return modality in modalities
+
+    return PruneRule("modality", ACQUISITION, matches)
+
+
+def acquisitions_matching(substrings: Iterable[str]) -> PruneRule:
+    """
+    Acquisitions whose directory name ("<modality> <series description>")
+    contains any of substrings, ignoring case.
+    """
+    substrings = [substring.lower() for substring in substrings]
+    return PruneRule(
+        "series description",
+        ACQUISITION,
+        lambda entry: any(substring in entry.name.lower() for substring in substrings),
+    )
+
+
+def sessions_matching(substrings: Iterable[str]) -> PruneRule:
+    """Sessions whose directory name contains any of substrings, ignoring case."""
+    substrings = [substring.lower() for substring in substrings]
+    return PruneRule(
+        "session description",
+        SESSION,
+        lambda entry: any(substring in entry.name.lower() for substring in substrings),
+    )
+
+
+def sessions_with_accessions(accessions: Iterable[str]) -> PruneRule:
+    """Sessions whose directory name contains any of accessions."""
+    accessions = sorted(set(accessions), key=len, reverse=True)
+    if not accessions:
+        return PruneRule("accession", SESSION, lambda entry: False)
+    # One scan of each name, however many accessions there are.
+    pattern = re.compile("|".join(re.escape(accession) for accession in accessions))
+    return PruneRule("accession", SESSION, lambda entry: pattern.search(entry.name) is not None)
+
+
+def files_with_suffix(suffixes: Iterable[str]) -> PruneRule:
+    """Files, at any depth, whose names end with any of suffixes."""
+    suffixes = tuple(suffixes)
+    return PruneRule("suffix", None, lambda entry: entry.name.endswith(suffixes))
+
+
+def _remove_tree(path: str) -> int:
+    """shutil.rmtree, but returning the bytes freed."""
+    freed = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                freed += _remove_tree(entry.path)
+            else:
+                freed += entry.stat(follow_symlinks=False).st_size
+                os.remove(entry.path)
+    os.rmdir(path)
+    return freed
+
+
+def _prune(
+    path: str,
+    depth: int,
+    rules: list[PruneRule],
+    remove_empty: bool,
+    max_depth: Optional[int],
+    report: dict,
+) -> bool:
+    """
+    Prune the directory at path, bottom-up. Returns whether it is now empty.
+    Directories deeper than max_depth (None for no limit) are never listed.
+    """
+    empty = True
+    with os.scandir(path) as entries:
+        entries = list(entries)
+    for entry in entries:
+        # Dot-entries are scratch space (e.g., decompressed copies); never touch them.
+        if entry.name.startswith("."):
+            empty = False
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            rule = next(
+                (rule for rule in rules if rule.depth == depth + 1 and rule.matches(entry)), None
+            )
+            if rule is not None:
+                report["bytes_freed"] += _remove_tree(entry.path)
+                report["removed"].append((entry.path, rule.reason))
+            elif max_depth is not None and depth + 1 >= max_depth:
+                empty = False  # nothing below here can match
+            elif _prune(entry.path, depth + 1, rules, remove_empty, max_depth, report) and remove_empty:
+                os.rmdir(entry.path)
+                report["removed"].append((entry.path, "empty"))
+            else:
+                empty = False
+        else:
+            rule = next((rule for rule in rules if rule.depth is None and rule.matches(entry)), None)
+            if rule is not None:
+                size = entry.stat(follow_symlinks=False).st_size
+                os.remove(entry.path)
+                report["bytes_freed"] += size
+                report["removed"].append((entry.path, rule.reason))
+            else:
+                empty = False
+    return empty
+
+
+def prune_tree(data_dir: str, rules: Iterable[PruneRule], remove_empty: bool = False) -> PruneReport:
+    """
+    Apply every rule to the tree under data_dir in a single bottom-up walk
+    and, with remove_empty, remove the directories left empty (data_dir
+    itself is always kept). A directory removed by a rule isn't walked.
+    """
+    start = time.perf_counter()
+    rules = list(rules)
+    # Without file rules or empty-directory removal, nothing below the deepest
+    # directory rule can be removed, so the walk stops there.
+    max_depth = None
+    if not remove_empty and all(rule.depth is not None for rule in rules):
+        max_depth = max((rule.depth for rule in rules), default=0)
+    report = {"removed": [], "bytes_freed": 0}
+    if os.path.isdir(data_dir):
+        _prune(os.path.normpath(data_dir), 0, rules, remove_empty, max_depth, report)
+    report = PruneReport(**report)
+    logger.info(
+        "Pruned %d entries (%.1f MB) from %s in %.1f seconds.",
+        len(report.removed),
+        report.bytes_freed / 1e6,
+        data_dir,
+        time.perf_counter() - start,
+    )
+    for path, reason in report.removed:
+        logger.debug("Removed %s (%s).", path, reason)
+    return report
@@ -0,0 +1,292 @@
+import json
+import logging
+import os
+import shutil
+from glob import glob
+from typing import NamedTuple, Optional
+
+import pandas as pd
+
+from image_deid_etl.sidecars import load_sidecar, write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the manifest's layout changes.
+MANIFEST_VERSION = 1
+
+# Files written by dcm2niix that belong in the output tree.
+OUTPUT_SUFFIXES = (".nii.gz", ".json", ".bval", ".bvec")
+
+# Sidecars with fewer fields than this usually mean dcm2niix couldn't read the
+# DICOM headers properly, so the acquisition is quarantined for review...
+SHORT_SIDECAR_FIELDS = 20
+# ...unless it is a derived series (or CT), whose sidecars are always short.
+SHORT_SIDECAR_EXEMPT = [
+    "ep2d_diff_mddw_",
+    "Diffusion_Series_Texture",
+    "RGB",
+    "ColFA",
+    "DTI_Fibers",
+    "Perfusion_Weighted",
+    "Color_Map",
+    "Vessels_3D",
+]
+
+# Acquisitions known to contain PHI (burned in or as text), matched against
+# the lower-cased SeriesDescription; they are deleted rather than moved.
+PHI_LABELS = [
+    "screensave",
+    "screen save",
+    "screen_save",
+    "cover image",
+    "cover_image",
+    "documents",
+    "dose_report",
+    "dose report",
+    "dosereport",
+    "protocol",
+    "capture",
+]
+
+
+class PlannedMove(NamedTuple):
+    source: str
+    target: str
+
+
+class AcquisitionPlan(NamedTuple):
+    """
+    What happens to one converted acquisition directory: its output files are
+    moved into target_dir ("move", or "quarantine" for short sidecars), or the
+    whole directory is deleted ("delete", for PHI-containing series).
+    """
+
+    acquisition: str
+    action: str
+    project: str
+    subject: str
+    session: str
+    label: Optional[str]
+    target_dir: Optional[str]
+    moves: list[PlannedMove]
+
+
+def structure_manifest_path(output_dir: str) -> str:
+    """
+    The manifest for output_dir lives next to it (e.g., NIfTIs.manifest.json),
+    so it is never uploaded with the NIfTIs.
+    """
+    return os.path.normpath(output_dir) + ".manifest.json"
+
+
+def quarantine_dir(output_dir: str) -> str:
+    """Where acquisitions with short sidecars go: <program>/<site>/NIfTIs_short_json/."""
+    return os.path.join(os.path.dirname(os.path.normpath(output_dir)), "NIfTIs_short_json")
+
+
+def _output_files(acquisition: str) -> dict[str, list[str]]:
+    """The acquisition's output files, by suffix, in name order."""
+    files = {suffix: [] for suffix in OUTPUT_SUFFIXES}
+    with os.scandir(acquisition) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            for suffix in OUTPUT_SUFFIXES:
+                if entry.name.endswith(suffix):
+                    files[suffix].append(entry.path)
+    return {suffix: sorted(paths) for suffix, paths in files.items()}
+
+
+def _is_short(sidecar_path: str, sidecar: dict) -> bool:
+    return (
+        len(sidecar) < SHORT_SIDECAR_FIELDS
+        and not any(name in sidecar_path for name in SHORT_SIDECAR_EXEMPT)
+        and sidecar.get("Modality") != "CT"
+    )
+
+
+def _has_phi(label: str) -> bool:
+    return "Study_acquired_outside_hospital" in label or any(
+        marker in label.lower() for marker in PHI_LABELS
+    )
+
+
+def _claim(target_dir: str, claimed: set) -> str:
+    # Number repeated labels: "07 - T1", "07 - T1 (1)", "07 - T1 (2)", ...
+    candidate = target_dir
+    copy_num = 1
+    while candidate in claimed or os.path.exists(candidate):
+        candidate = f"{target_dir} ({copy_num})"
+        copy_num += 1
+    claimed.add(candidate)
+    return candidate
+
+
+def plan_nifti_structure(
+    data_dir: str, sub_mapping: pd.DataFrame, output_dir: str, program: str
+) -> list[AcquisitionPlan]:
+    """
+    Plan where every converted acquisition under data_dir (a {sub}/{ses}/{acq}
+    tree holding one session) goes in output_dir's {project}/{sub}/{ses}/
+    tree, without touching the filesystem:
+      - the acquisition label is "<series number> - <series description>"
+      - acquisitions with short sidecars go to the quarantine tree instead
+      - PHI-containing acquisitions are deleted
+      - repeated labels get a copy number
+    Acquisitions without a sidecar (not converted) are left alone.
+    """
+    if sub_mapping.empty:
+        return []
+    if len(sub_mapping) > 1:
+        logger.warning(
+            "%d sessions mapped for %s; using the first, %s.",
+            len(sub_mapping),
+            data_dir,
+            sub_mapping["session_label"].iloc[0],
+        )
+    row = sub_mapping.iloc[0]
+    subject = row["C_ID"] if program == "cbtn" else row["Subject ID"]
+    project, session = row["fw_proj"], row["session_label"]
+    session_dirs = {
+        False: os.path.join(output_dir, project, subject, session),
+        True: os.path.join(quarantine_dir(output_dir), project, subject, session),
+    }
+
+    data_path = glob(data_dir + "*/*")[0]  # assumes only 1 session (1 study being processed)
+    with os.scandir(data_path) as entries:
+        acquisitions = sorted(
+            entry.path for entry in entries if entry.is_dir() and not entry.name.startswith(".")
+        )
+
+    plan = []
+    claimed = set()
+    for acquisition in acquisitions:
+        files = _output_files(acquisition)
+        sidecars = files[".json"]
+        if not sidecars or "dcm2nii_invalidName" in sidecars[0]:
+            continue
+        sidecar = load_sidecar(sidecars[0])
+        acq_label = str(sidecar["SeriesDescription"])
+        if _has_phi(acq_label):
+            plan.append(AcquisitionPlan(acquisition, "delete", project, subject, session, None, None, []))
+            continue
+
+        quarantined = _is_short(sidecars[0], sidecar)
+        series_num = str(sidecar["SeriesNumber"]).zfill(2)
+        # replace any single quotation marks with underscore in labels & file names (a rare case but has been found)
+        label = series_num + " - " + acq_label.replace("'", "_")
+        target_dir = _claim(os.path.join(session_dirs[quarantined], label), claimed)
+        moves = [
+            PlannedMove(path, os.path.join(target_dir, os.path.basename(path).replace("'", "_")))
+            for suffix in OUTPUT_SUFFIXES
+            for path in files[suffix]
+        ]
+        plan.append(
+            AcquisitionPlan(
+                acquisition,
+                "quarantine" if quarantined else "move",
+                project,
+                subject,
+                session,
+                os.path.basename(target_dir),
+                target_dir,
+                moves,
+            )
+        )
+    return plan
+
+
+def write_structure_manifest(output_dir: str, plan: list[AcquisitionPlan]) -> str:
+    """
+    Record plan as JSON next to output_dir, for auditing and the uploader
+    (see manifest_projects and rename_project).
+    """
+    path = structure_manifest_path(output_dir)
+    write_json_atomic(
+        path,
+        {
+            "version": MANIFEST_VERSION,
+            "output_dir": output_dir,
+            "acquisitions": [
+                {
+                    **acquisition._asdict(),
+                    "moves": [move._asdict() for move in acquisition.moves],
+                }
+                for acquisition in plan
+            ],
+        },
+    )
+    return path
+
+
+def load_structure_manifest(output_dir: str) -> Optional[dict]:
+    """The manifest written for output_dir, or None if there isn't one."""
+    path = structure_manifest_path(output_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def manifest_projects(output_dir: str) -> Optional[list[str]]:
+    """
+    The projects that the manifest for output_dir moved acquisitions into
+    (quarantined ones aren't uploaded), or None if there is no manifest.
+    """
+    manifest = load_structure_manifest(output_dir)
+    if manifest is None:
+        return None
+    return sorted(
+        {
+            acquisition["project"]
+            for acquisition in manifest["acquisitions"]
+            if acquisition["action"] == "move"
+        }
+    )
+
+
+def rename_project(output_dir: str, project: str, new_project: str) -> None:
+    """
+    Rename a project directory under output_dir, and its acquisitions' paths
+    in the manifest to match, so the manifest stays a true record of the tree.
+    """
+    os.rename(os.path.join(output_dir, project), os.path.join(output_dir, new_project))
+    manifest = load_structure_manifest(output_dir)
+    if manifest is None:
+        return
+    old_prefix = os.path.join(manifest["output_dir"], project) + os.sep
+    new_prefix = os.path.join(manifest["output_dir"], new_project) + os.sep
+
+    def renamed(path: str) -> str:
+        return new_prefix + path[len(old_prefix) :] if path.startswith(old_prefix) else path
+
+    for acquisition in manifest["acquisitions"]:
+        if acquisition["action"] != "move" or acquisition["project"] != project:
+            continue
+        acquisition["project"] = new_project
+        acquisition["target_dir"] = renamed(acquisition["target_dir"])
+        for move in acquisition["moves"]:
+            move["target"] = renamed(move["target"])
+    write_json_atomic(structure_manifest_path(output_dir), manifest)
+
+
+def apply_nifti_structure(output_dir: str, plan: list[AcquisitionPlan]) -> None:
+    """
+    Carry out plan. Every move is a rename within one filesystem, and each
+    target directory is created exactly once.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for acquisition in plan:
+        if acquisition.action == "delete":
+            shutil.rmtree(acquisition.acquisition)  # deletes directories & all files
+            continue
+        os.makedirs(acquisition.target_dir)
+        for move in acquisition.moves:
+            os.rename(move.source, move.target)
+    logger.info(
+        "Moved %d acquisitions to %s, quarantined %d and deleted %d.",
+        sum(1 for acquisition in plan if acquisition.action == "move"),
+        output_dir,
+        sum(1 for acquisition in plan if acquisition.action == "quarantine"),
+        sum(1 for acquisition in plan if acquisition.action == "delete"),
+    )
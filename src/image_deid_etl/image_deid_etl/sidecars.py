@@ -0,0 +1,301 @@
+import copy
+import importlib.resources as pkg_resources
+import json
+import logging
+import os
+import stat
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from glob import glob
+from typing import Callable, Iterable, NamedTuple, Optional
+
+import nibabel as nib
+
+from image_deid_etl.header_index import HeaderIndex, open_header_index, read_headers
+
+logger = logging.getLogger(__name__)
+
+# A sidecar transform takes a sidecar's path and contents and returns the new
+# contents, without modifying its input or touching the disk.
+SidecarTransform = Callable[[str, dict], dict]
+
+# Overrides the packaged sidecar_policy.json.
+SIDECAR_POLICY_PATH = os.getenv("SIDECAR_POLICY_PATH")
+
+
+@lru_cache(maxsize=None)
+def load_sidecar_policy() -> dict:
+    """
+    Load the sidecar scrubbing policy from SIDECAR_POLICY_PATH, or the
+    packaged sidecar_policy.json:
+      - version: bumped whenever the policy changes, and logged with every scrub
+      - remove_fields: fields that may hold PHI and are dropped from every sidecar
+    """
+    if SIDECAR_POLICY_PATH:
+        with open(SIDECAR_POLICY_PATH) as f:
+            return json.load(f)
+    return json.load(pkg_resources.open_text(__package__, "sidecar_policy.json"))
+
+
+class SidecarChange(NamedTuple):
+    path: str
+    written: bool
+    removed: list
+
+
+def _umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Read once, at import: os.umask can only be read by setting it, which isn't
+# safe once sidecars are being written from several threads.
+UMASK = _umask()
+
+
+def write_json_atomic(path: str, obj) -> None:
+    """
+    Replace the JSON file at path in one step: write a temporary file in the
+    same directory, then rename it over the original, so a crash never leaves
+    a truncated sidecar behind. The file keeps the original's permissions
+    (mkstemp creates it 0600), or gets the usual ones for a new file.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    fd, temp_path = tempfile.mkstemp(
+        prefix=".", suffix=".tmp", dir=os.path.dirname(path) or "."
+    )
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, "w") as outfile:
+            json.dump(obj, outfile)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def dicom_spacing(headers) -> Optional[tuple[float, float, float]]:
+    """
+    (row spacing, column spacing, slice spacing) from the first DICOM header
+    with both PixelSpacing and SpacingBetweenSlices.
+    """
+    for header in headers:
+        if (header.pixel_spacing is not None) and (header.spacing_between_slices is not None):
+            return (*header.pixel_spacing, header.spacing_between_slices)
+    return None
+
+
+def nifti_spacing(nifti_path: str) -> Optional[tuple[float, float, float]]:
+    """
+    The same spacing taken from a NIfTI header's pixdim, without loading the
+    image data. dcm2niix puts DICOM columns on the first axis, so the first
+    two zooms are swapped back into PixelSpacing (row, column) order.
+    """
+    # pixdim is float32; round off the noise from widening it to a double.
+    zooms = [round(float(zoom), 6) for zoom in nib.load(nifti_path).header.get_zooms()]
+    if len(zooms) < 3:
+        return None
+    return (zooms[1], zooms[0], zooms[2])
+
+
+def add_voxel_dimensions(index: HeaderIndex = None) -> SidecarTransform:
+    """
+    A transform adding voxel dimensions (dim1, dim2, dim3) to the sidecars of
+    converted acquisitions.
+
+    Spacing comes from the acquisition's DICOM headers in index (or the DICOMs
+    themselves, without one) and, failing that, from the NIfTI header.
+    Sidecars that already have the dimensions are left alone.
+    """
+    series_spacing = {}
+    # Sidecars of one acquisition may be transformed by several threads at once;
+    # each acquisition's spacing is worked out by one of them, while the rest wait.
+    acquisition_locks = defaultdict(threading.Lock)
+    locks_lock = threading.Lock()
+
+    def acquisition_spacing(acquisition: str):
+        # None when the acquisition wasn't converted, () when its DICOMs have no spacing.
+        with locks_lock:
+            lock = acquisition_locks[acquisition]
+        with lock:
+            if acquisition not in series_spacing:
+                spacing = None
+                if glob(acquisition + "/*.nii.gz"):
+                    spacing = dicom_spacing(read_headers(acquisition, "*.dcm", index)) or ()
+                # Only stored once known, so a failed read is retried by the next sidecar.
+                series_spacing[acquisition] = spacing
+            return series_spacing[acquisition]
+
+    def transform(json_path: str, sidecar: dict) -> dict:
+        if all(dim in sidecar for dim in ("dim1", "dim2", "dim3")):
+            return sidecar
+        acquisition = os.path.dirname(json_path)
+        try:
+            spacing = acquisition_spacing(acquisition)
+            if spacing is None:  # not converted
+                return sidecar
+            nifti_path = json_path[: -len(".json")] + ".nii.gz"
+            if not spacing and os.path.exists(nifti_path):
+                spacing = nifti_spacing(nifti_path)
+        except Exception:
+            logger.exception("Unable to find voxel dimensions for %s.", json_path)
+            return sidecar
+        if not spacing:
+            return sidecar
+        return {**sidecar, "dim1": spacing[0], "dim2": spacing[1], "dim3": spacing[2]}
+
+    return transform
+
+
+def remove_fields(fields: Iterable[str]) -> SidecarTransform:
+    """A transform dropping fields (e.g., the sidecar policy's remove_fields) from sidecars."""
+    fields = frozenset(fields)
+
+    def transform(json_path: str, sidecar: dict) -> dict:
+        return {key: value for key, value in sidecar.items() if key not in fields}
+
+    return transform
+
+
+class SidecarCache:
+    """
+    The latest contents of the sidecars loaded or written by this process, so
+    later stages (e.g., Flywheel metadata injection) don't have to parse them
+    again.
+
+    Entries are keyed by file identity (device and inode) and only used while
+    the file's modification time and size are unchanged, so they survive the
+    renames and moves that restructure the output, but never go stale.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stat(path: str):
+        stat = os.stat(path)
+        return (stat.st_dev, stat.st_ino), (stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path: str) -> Optional[dict]:
+        key, version = self._stat(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return copy.deepcopy(entry[1])
+
+    def put(self, path: str, sidecar: dict) -> None:
+        key, version = self._stat(path)
+        with self._lock:
+            self._entries[key] = (version, copy.deepcopy(sidecar))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+SIDECAR_CACHE = SidecarCache()
+
+
+def load_sidecar(path: str) -> dict:
+    """A sidecar's contents, from SIDECAR_CACHE when it is current."""
+    sidecar = SIDECAR_CACHE.get(path)
+    if sidecar is None:
+        with open(path) as infile:
+            sidecar = json.load(infile, strict=False)
+        SIDECAR_CACHE.put(path, sidecar)
+    return sidecar
+
+
+def write_sidecar(path: str, sidecar: dict) -> None:
+    """Atomically replace a sidecar and remember its new contents."""
+    write_json_atomic(path, sidecar)
+    SIDECAR_CACHE.put(path, sidecar)
+
+
+def transform_sidecar(path: str, transforms: Iterable[SidecarTransform]) -> SidecarChange:
+    """
+    Apply transforms, in order, to one sidecar with a single parse and (if
+    anything changed) a single atomic write.
+    """
+    original = load_sidecar(path)
+    sidecar = original
+    for transform in transforms:
+        sidecar = transform(path, sidecar)
+    removed = [field for field in original if field not in sidecar]
+    if sidecar == original and list(sidecar) == list(original):
+        return SidecarChange(path, False, removed)
+    write_sidecar(path, sidecar)
+    return SidecarChange(path, True, removed)
+
+
+def transform_sidecars(
+    data_dir: str, transforms: Iterable[SidecarTransform], workers: int = None
+) -> list[SidecarChange]:
+    """
+    Apply transforms to every .json sidecar under data_dir, using a pool of
+    workers threads (the ThreadPoolExecutor default when None). Returns what
+    was done to each sidecar, in walk order.
+    """
+    transforms = list(transforms)
+    paths = [
+        os.path.join(root, file)
+        for root, dirs, files in os.walk(data_dir)
+        for file in files
+        if ".json" in file
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        changes = list(executor.map(lambda path: transform_sidecar(path, transforms), paths))
+    return changes
+
+
+def log_sidecar_changes(data_dir: str, changes: list[SidecarChange]) -> None:
+    """Log the fields removed from each sidecar, and totals per field."""
+    policy_version = load_sidecar_policy()["version"]
+    totals = Counter()
+    for change in changes:
+        if change.removed:
+            logger.info("Removed %s from %s.", ", ".join(change.removed), change.path)
+            totals.update(change.removed)
+    logger.info(
+        "Rewrote %d of %d sidecars under %s (sidecar policy version %s).",
+        sum(1 for change in changes if change.written),
+        len(changes),
+        data_dir,
+        policy_version,
+    )
+    for field, count in sorted(totals.items()):
+        logger.info("  %s: removed from %d sidecars", field, count)
+
+
+def scrub_sidecars(data_dir: str, workers: int = None) -> list[SidecarChange]:
+    """Remove the sidecar policy's remove_fields from every sidecar under data_dir."""
+    changes = transform_sidecars(
+        data_dir, [remove_fields(load_sidecar_policy()["remove_fields"])], workers
+    )
+    log_sidecar_changes(data_dir, changes)
+    return changes
+
+
+def finalize_sidecars(data_dir: str, workers: int = None) -> list[SidecarChange]:
+    """
+    Add voxel dimensions to, and remove the sidecar policy's remove_fields
+    from, every sidecar under data_dir, in one pass.
+    """
+    transforms = [remove_fields(load_sidecar_policy()["remove_fields"])]
+    index = open_header_index(data_dir)
+    try:
+        changes = transform_sidecars(data_dir, [add_voxel_dimensions(index)] + transforms, workers)
+    finally:
+        if index:
+            index.close()
+    log_sidecar_changes(data_dir, changes)
+    return changes
@@ -0,0 +1,18 @@
+import pytest
+
+from image_deid_etl.conversion import is_compressed_syntax
+
+
+@pytest.mark.parametrize(
+    "transfer_syntax_uid, compressed",
+    [
+        ("1.2.840.10008.1.2", False),  # Implicit VR Little Endian
+        ("1.2.840.10008.1.2.1", False),  # Explicit VR Little Endian
+        ("1.2.840.10008.1.2.4.90", True),  # JPEG 2000 (lossless only)
+        ("1.2.840.10008.1.2.5", True),  # RLE Lossless
+        ("1.2.826.0.1.3680043.8.498.1", True),  # private
+        ("1.2.840.10008.5.1.4.1.1.4", True),  # not a transfer syntax
+    ],
+)
+def test_is_compressed_syntax(transfer_syntax_uid, compressed):
+    assert is_compressed_syntax(transfer_syntax_uid) is compressed
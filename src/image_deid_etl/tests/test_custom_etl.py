@@ -0,0 +1,314 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from image_deid_etl.custom_etl import (
+    closest,
+    get_fw_proj_cbtn,
+    load_diagnosis_mapping,
+    make_session_labels,
+)
+
+FIELDS = ["PerformedProcDesc", "StudyDesc", "RequestedProcDesc"]
+
+
+# The row-by-row session labeler that make_session_labels replaced, kept as the
+# reference its output is checked against.
+def rowwise_body_part_examined(desc):
+    abbrv=[]
+    parts=[]
+    if ('brain' in desc.lower()) \
+    or ('head' in desc.lower()) \
+    or ('stealth' in desc.lower()) \
+    or ('neuro' in desc.lower()) \
+    or ('orbits' in desc.lower()) \
+    or ('spectroscopy' in desc.lower()):
+        abbrv.append('B')
+        parts.append('brain')
+    if ('face' in desc.lower()) or \
+        ('maxillofacial' in desc.lower()):
+        abbrv.append('F')
+        parts.append('face')
+    if 'spine' in desc.lower():
+        abbrv.append('S')
+        parts.append('spine')
+    if 'neck' in desc.lower():
+        abbrv.append('N')
+        parts.append('neck')
+    if 'pituitary' in desc.lower():
+        abbrv.append('P')
+        parts.append('pituitary')
+    if ('sinuses' in desc.lower()) or \
+        ('sinus' in desc.lower()):
+        abbrv.append('Si')
+        parts.append('sinuses')
+    if 'chest' in desc.lower():
+        abbrv.append('C')
+        parts.append('chest')
+    if 'finger' in desc.lower():
+        abbrv.append('Fi')
+        parts.append('finger')
+    if 'iac' in desc.lower():
+        abbrv.append('IAC')
+        parts.append('iac')
+    if 'shoulder' in desc.lower():
+        abbrv.append('Sh')
+        parts.append('shoulder')
+    if 'knee' in desc.lower():
+        abbrv.append('K')
+        parts.append('knee')
+    if ('skull base to mid thigh' in desc.lower()) or \
+        ('hip' in desc.lower()):
+        abbrv.append('Bo')
+        parts.append('Body')
+    if abbrv==[]:
+        return []
+    else:
+        abbrv=''.join(abbrv)
+        parts='_'.join(parts)
+        return abbrv+'_'+parts
+
+def rowwise_session_labels(input_df,fields_to_use):
+# construct session label based on DICOM metadata
+#   assumes directory structure: {data_dir}/{sub}/{ses}/{acq}/*.dcm
+    session_labels=[]
+    accession_numbers=[]
+    missing_sessions=[]
+    req_descs=[]
+    perf_descs=[]
+    study_descs=[]
+    # for each subject, loop through acquisitions/DICOMs until find desired info & construct session label
+    for ind,row in input_df.iterrows(): # for each session
+        subject_dob=row['DOB']
+        date_of_imaging = row['ImagingDate']
+        time_of_imaging = row['ImagingTime']
+        accession = row['accession_num']
+        req_desc = row['RequestedProcDesc']
+        perf_desc = row['PerformedProcDesc']
+        study_desc = row['StudyDesc']
+        body_part_examined=[]
+        desc=[]
+        body_part_examined=[]
+        for i in range(len(fields_to_use)): # loop through input fields, in order, until a description is found
+            if (desc==[]) or (body_part_examined==[]):
+                this_field = fields_to_use[i]
+                if (row[this_field] != ' ') and (row[this_field] != []):
+                    desc = row[this_field]
+                    # print(row['Last Name'])
+                    body_part_examined = rowwise_body_part_examined(desc)
+        if len(time_of_imaging)<4:
+            study_time=''
+        else:
+            study_time='_'+time_of_imaging[0:2]+'h'+time_of_imaging[2:4]+'m'
+        if (subject_dob == 19010101) or (subject_dob == []) or (date_of_imaging == []) or (body_part_examined == []):
+            # print('Not enough info in DICOM header to create session labels for '+ses)
+            missing_sessions.append(accession)
+        else:
+            age_in_days_at_imaging = abs((date_of_imaging - subject_dob).days)
+            session_labels.append(str(age_in_days_at_imaging)+'d_'+body_part_examined+study_time)
+            accession_numbers.append(accession)
+            req_descs.append(req_desc)
+            perf_descs.append(perf_desc)
+            study_descs.append(study_desc)
+    out_df = pd.DataFrame({'accession_num': accession_numbers, \
+                            'session_label': session_labels , \
+                            'RequestedProcDesc': req_descs , \
+                            'PerformedProcDesc': perf_descs , \
+                            'StudyDesc': study_descs })
+    return out_df,pd.DataFrame(missing_sessions,columns=['accession_num'])
+
+
+def session_fields(*rows) -> pd.DataFrame:
+    """A get_dicom_fields-like frame of (DOB, ImagingDate, ImagingTime, descriptions) rows."""
+    return pd.DataFrame(
+        [
+            {
+                "accession_num": f"A{ind}",
+                "DOB": dob,
+                "ImagingDate": imaging_date,
+                "ImagingTime": imaging_time,
+                "PerformedProcDesc": performed,
+                "StudyDesc": study,
+                "RequestedProcDesc": requested,
+            }
+            for ind, (dob, imaging_date, imaging_time, performed, study, requested) in enumerate(rows)
+        ]
+    )
+
+
+DOB = datetime(2010, 3, 1)
+IMAGED = datetime(2012, 5, 17)
+
+SESSIONS = session_fields(
+    (DOB, IMAGED, "070907.0705", "MRI BRAIN W/WO CONTRAST", " ", []),
+    (DOB, IMAGED, "1230", " ", "MR Head and Neck", "CT Sinus"),
+    (DOB, IMAGED, "12", [], [], "CT MAXILLOFACIAL IAC"),  # short time
+    (DOB, DOB, [], "Stealth Brain", " ", " "),
+    (IMAGED, DOB, "0815", "MRI C-SPINE", " ", " "),  # imaged "before" birth
+    (19010101, IMAGED, "1230", "MR Brain", " ", " "),  # placeholder DOB
+    ([], IMAGED, "1230", "MR Brain", " ", " "),  # empty DOB
+    (DOB, [], "1230", "MR Brain", " ", " "),  # empty imaging date
+    (DOB, IMAGED, "1230", "Outside study", "Outside study", "Outside study"),  # unknown body part
+    (DOB, IMAGED, "1230", "Outside study", "XR Chest", " "),  # known part in a later field
+    (DOB, IMAGED, "1230", " ", [], []),  # no description at all
+)
+
+
+def test_session_labels_match_rowwise():
+    labels, missing = make_session_labels(SESSIONS, FIELDS)
+    expected_labels, expected_missing = rowwise_session_labels(SESSIONS, FIELDS)
+
+    pd.testing.assert_frame_equal(labels, expected_labels)
+    pd.testing.assert_frame_equal(missing, expected_missing)
+
+
+def test_session_labels():
+    labels, missing = make_session_labels(SESSIONS, FIELDS)
+
+    assert labels["session_label"].tolist() == [
+        "808d_B_brain_07h09m",
+        "808d_BN_brain_neck_12h30m",
+        "808d_FIAC_face_iac",
+        "0d_B_brain",
+        "808d_S_spine_08h15m",
+        "808d_C_chest_12h30m",
+    ]
+    assert missing["accession_num"].tolist() == ["A5", "A6", "A7", "A8", "A10"]
+
+
+@pytest.mark.parametrize("blank", ["", "   ", "not a date"])
+def test_blank_dates_are_missing(blank):
+    sessions = session_fields(
+        (blank, IMAGED, "1230", "MR Brain", " ", " "),
+        (DOB, blank, "1230", "MR Brain", " ", " "),
+        (DOB, IMAGED, "1230", "MR Brain", " ", " "),
+    )
+
+    labels, missing = make_session_labels(sessions, FIELDS)
+
+    assert labels["accession_num"].tolist() == ["A2"]
+    assert labels["session_label"].tolist() == ["808d_B_brain_12h30m"]
+    assert missing["accession_num"].tolist() == ["A0", "A1"]
+
+
+# The per-session project lookup that get_fw_proj_cbtn replaced, kept as the
+# reference its output is checked against.
+def rowwise_fw_proj_cbtn(cbtn_df,sub_mapping):
+# using the C-ID and age-at-imaging, extract the target project for each session
+#   based on the CBTN-all spreadsheet. Uses age-at-imaging to find the closest event
+#   in time in CBTN-all & then uses the Diagnosis category to derive a Flywheel project label
+#   (based on a mapping dictionary).
+    cbtn_df = cbtn_df[['CBTN Subject ID','Age at Diagnosis','Diagnosis']]
+    proj_mapping = load_diagnosis_mapping()
+    sub_list = sub_mapping['C_ID'].values.tolist()
+    session_list = sub_mapping['session_label'].values.tolist()
+    age_at_imaging = [i.split('d_')[0] for i in session_list] # extract age-at-imaging from session label for *all* subjects
+    ind=0
+    fw_projects = []
+    missing_tag = 'subject missing in cbtn-all'
+    for sub in sub_list:
+        # get all the data from CBTN-all for this subject
+        sub_rows = cbtn_df[(cbtn_df['CBTN Subject ID'] == sub)]
+        if sub_rows.empty:
+            fw_projects.append(missing_tag)
+        else:
+            sub_rows = sub_rows[sub_rows['Diagnosis']!='Not Reported'] # remove 'not reported' rows
+            sub_rows = sub_rows[sub_rows['Diagnosis']!='Other'] # remove 'other' rows
+            if (not sub_rows.empty) and (not sub_rows[sub_rows['Diagnosis']=="Supratentorial or Spinal Cord PNET"].empty): # if there is a PNET diagnosis
+                if len(sub_rows['Diagnosis'].unique()) > 1: # if there are additional diagnoses available
+                    sub_rows = sub_rows[sub_rows['Diagnosis']!='Supratentorial or Spinal Cord PNET']     # remove "PNET" rows                
+            if sub_rows.empty:
+                diagnosis_to_use='Not Reported'
+                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label
+            elif (len(sub_rows['Diagnosis'].unique()) == 1):
+                diagnosis_to_use=sub_rows['Diagnosis'].unique().tolist()[0]
+                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label                
+            else:
+                # use the age-in-days at imaging (from the session labels) to find the row with the closest age-at-diagnosis value
+                closest_diagnosis = closest(sub_rows['Age at Diagnosis'].values.astype(int).tolist(), int(age_at_imaging[ind])) # closest age row
+                # grab the diagnosis label for that row
+                diagnosis_to_use = sub_rows[sub_rows['Age at Diagnosis']==str(closest_diagnosis)]['Diagnosis'].tolist()[0]
+                # map to the FW-project labels
+                fw_projects.append(proj_mapping[diagnosis_to_use]) # use hard-coded dictionary to map to fw-proj label
+        ind+=1
+    sub_mapping['fw_proj'] = fw_projects # add column to output
+    subs_no_proj = sub_mapping[sub_mapping['fw_proj']==missing_tag].reset_index(drop=True)
+    subs_with_proj = sub_mapping[sub_mapping['fw_proj']!=missing_tag].reset_index(drop=True)
+    return subs_with_proj,subs_no_proj
+
+
+PNET = "Supratentorial or Spinal Cord PNET"
+
+# (CBTN Subject ID, Age at Diagnosis, Diagnosis)
+CBTN = pd.DataFrame(
+    [
+        ("C1", "400", "Medulloblastoma"),
+        ("C2", "400", "Not Reported"),
+        ("C2", "500", "Other"),
+        ("C3", "400", PNET),
+        ("C4", "100", PNET),
+        ("C4", "900", "Medulloblastoma"),
+        ("C5", "100", "Medulloblastoma"),
+        ("C5", "1000", "High-grade glioma/astrocytoma (WHO grade III/IV)"),
+        ("C5", "1500", "Other"),
+        ("C6", "100", "Chordoma"),
+        ("C6", "300", "Dysplasia/Gliosis"),
+        ("C6", "300", "Medulloblastoma"),
+        ("C7", "100", "Medulloblastoma"),
+        ("C7", "2000", "Medulloblastoma"),
+    ],
+    columns=["CBTN Subject ID", "Age at Diagnosis", "Diagnosis"],
+)
+
+# (C_ID, session_label)
+SUB_MAPPING = pd.DataFrame(
+    [
+        ("C1", "10d_B_brain"),
+        ("C2", "10d_B_brain"),
+        ("C3", "10d_B_brain"),
+        ("C4", "10d_B_brain"),
+        ("C5", "200d_B_brain_12h30m"),
+        ("C5", "900d_B_brain"),
+        ("C6", "200d_B_brain"),  # as close to 100 as to 300
+        ("C6", "290d_B_brain"),  # two diagnoses at 300
+        ("C7", "1900d_B_brain"),
+        ("C8", "10d_B_brain"),  # not in CBTN-all
+    ],
+    columns=["C_ID", "session_label"],
+)
+
+
+def test_fw_projects_match_rowwise():
+    with_proj, without_proj = get_fw_proj_cbtn(CBTN, SUB_MAPPING.copy())
+    expected_with, expected_without = rowwise_fw_proj_cbtn(CBTN, SUB_MAPPING.copy())
+
+    pd.testing.assert_frame_equal(with_proj, expected_with)
+    pd.testing.assert_frame_equal(without_proj, expected_without)
+
+
+def test_fw_projects():
+    with_proj, without_proj = get_fw_proj_cbtn(CBTN, SUB_MAPPING.copy())
+
+    assert with_proj["fw_proj"].tolist() == [
+        "Medullo",
+        "Other",
+        "PNET",
+        "Medullo",
+        "Medullo",
+        "HGG",
+        "Chordoma",
+        "Dysplasia_Gliosis",
+        "Medullo",
+    ]
+    assert without_proj["C_ID"].tolist() == ["C8"]
+
+
+def test_fw_projects_unknown_diagnosis():
+    cbtn_df = pd.DataFrame(
+        [("C1", "400", "Not a diagnosis")],
+        columns=["CBTN Subject ID", "Age at Diagnosis", "Diagnosis"],
+    )
+
+    with pytest.raises(KeyError):
+        get_fw_proj_cbtn(cbtn_df, SUB_MAPPING.head(1).copy())
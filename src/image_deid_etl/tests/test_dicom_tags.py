@@ -0,0 +1,55 @@
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from image_deid_etl.dicom_tags import read_dicom_header
+
+
+def write_dicom(path, **elements) -> str:
+    """A minimal MR DICOM file at path with elements, as keyword=(VR, value)."""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.Modality = "MR"
+    for keyword, (vr, value) in elements.items():
+        ds.add_new(keyword, vr, value)
+    ds.save_as(str(path), write_like_original=False)
+    return str(path)
+
+
+def test_read_dicom_header(tmp_path):
+    path = write_dicom(
+        tmp_path / "ok.dcm",
+        SeriesNumber=("IS", 7),
+        PixelSpacing=("DS", ["0.5", "0.6"]),
+        SpacingBetweenSlices=("DS", "3"),
+    )
+
+    header = read_dicom_header(path)
+
+    assert header.modality == "MR"
+    assert header.series_number == 7
+    assert header.pixel_spacing == (0.5, 0.6)
+    assert header.spacing_between_slices == 3.0
+
+
+@pytest.mark.parametrize(
+    "elements",
+    [
+        {"PixelSpacing": ("DS", "0.5")},  # single-valued
+        {"PixelSpacing": ("LO", "abc\\1")},  # non-numeric
+        {"SeriesNumber": ("LO", "x1")},
+        {"SpacingBetweenSlices": ("LO", "n/a")},
+    ],
+)
+def test_malformed_numeric_tags_are_none(tmp_path, elements):
+    header = read_dicom_header(write_dicom(tmp_path / "bad.dcm", **elements))
+
+    assert header.modality == "MR"
+    assert header.series_number is None
+    assert header.pixel_spacing is None
+    assert header.spacing_between_slices is None
@@ -0,0 +1,48 @@
+import os
+
+from image_deid_etl.filters import delete_excluded_acquisitions, partition_series
+
+
+def series(series_id, modality, description=None):
+    tags = {"Modality": modality}
+    if description is not None:
+        tags["SeriesDescription"] = description
+    return {"ID": series_id, "MainDicomTags": tags}
+
+
+def test_partition_series():
+    study = {"MainDicomTags": {"StudyDescription": "MRI BRAIN W/WO CONTRAST"}}
+    series_metadata = [
+        series("t1", "MR", "AX T1 POST"),
+        series("localizer", "MR", "3-Plane Localizer"),
+        series("screen-save", "MR", "Screen Save"),
+        series("dose", "CT", "Dose Report"),
+        series("secondary", "OT", "AX T1 POST"),
+        series("no-description", "MR"),
+        series("skipped", "PT", "PET AC"),
+    ]
+
+    keep, skip = partition_series(study, series_metadata, ["PT"])
+
+    assert [s["ID"] for s in keep] == ["t1", "no-description"]
+    assert [s["ID"] for s in skip] == ["localizer", "screen-save", "dose", "secondary", "skipped"]
+
+
+def test_partition_series_by_study_description():
+    study = {"MainDicomTags": {"StudyDescription": "NM Bone Scan"}}
+
+    keep, skip = partition_series(study, [series("t1", "MR", "AX T1 POST")])
+
+    assert keep == []
+    assert [s["ID"] for s in skip] == ["t1"]
+
+
+def test_delete_excluded_acquisitions(tmp_path):
+    session = tmp_path / "DICOMs" / "123 Doe John" / "A1 MRI BRAIN"
+    for acquisition in ["MR AX T1 POST", "MR 3-Plane Localizer", "OT Screen Save", "SR Dose Report"]:
+        (session / acquisition).mkdir(parents=True)
+        (session / acquisition / "1.dcm").write_bytes(b"")
+
+    delete_excluded_acquisitions(str(tmp_path / "DICOMs") + "/")
+
+    assert os.listdir(session) == ["MR AX T1 POST"]
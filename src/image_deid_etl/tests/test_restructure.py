@@ -0,0 +1,49 @@
+import os
+
+from image_deid_etl.restructure import (
+    AcquisitionPlan,
+    PlannedMove,
+    load_structure_manifest,
+    manifest_projects,
+    quarantine_dir,
+    rename_project,
+    write_structure_manifest,
+)
+
+
+def planned(output_dir, action, project, label):
+    target_dir = os.path.join(output_dir, project, "C1", "10d_B_brain", label)
+    moves = [PlannedMove(f"/src/{label}/a.nii.gz", os.path.join(target_dir, "a.nii.gz"))]
+    return AcquisitionPlan(f"/src/{label}", action, project, "C1", "10d_B_brain", label, target_dir, moves)
+
+
+def test_manifest_follows_project_rename(tmp_path):
+    output_dir = str(tmp_path / "NIfTIs")
+    plan = [
+        planned(output_dir, "move", "HGG", "01 - T1"),
+        planned(output_dir, "move", "HGG_extra", "02 - T2"),
+        planned(quarantine_dir(output_dir), "quarantine", "Medullo", "03 - ADC"),
+        AcquisitionPlan("/src/04", "delete", "HGG", "C1", "10d_B_brain", None, None, []),
+    ]
+    write_structure_manifest(output_dir, plan)
+    for acquisition in plan[:2]:
+        os.makedirs(acquisition.target_dir)
+
+    assert manifest_projects(output_dir) == ["HGG", "HGG_extra"]
+
+    rename_project(output_dir, "HGG", "HGG_v2")
+
+    assert sorted(os.listdir(output_dir)) == ["HGG_extra", "HGG_v2"]
+    assert manifest_projects(output_dir) == ["HGG_extra", "HGG_v2"]
+    acquisitions = load_structure_manifest(output_dir)["acquisitions"]
+    renamed_dir = os.path.join(output_dir, "HGG_v2", "C1", "10d_B_brain", "01 - T1")
+    assert acquisitions[0]["target_dir"] == renamed_dir
+    assert acquisitions[0]["moves"][0]["target"] == os.path.join(renamed_dir, "a.nii.gz")
+    assert os.path.isdir(acquisitions[0]["target_dir"])
+    # HGG_extra shares the prefix but isn't the renamed project.
+    assert acquisitions[1]["target_dir"] == plan[1].target_dir
+    assert acquisitions[2]["project"] == "Medullo"
+
+
+def test_no_manifest(tmp_path):
+    assert manifest_projects(str(tmp_path / "NIfTIs")) is None
@@ -0,0 +1,25 @@
+import json
+import os
+import stat
+
+from image_deid_etl.sidecars import UMASK, write_json_atomic
+
+
+def test_write_json_atomic_keeps_mode(tmp_path):
+    path = tmp_path / "sidecar.json"
+    path.write_text("{}")
+    os.chmod(path, 0o644)
+
+    write_json_atomic(str(path), {"SeriesNumber": 7})
+
+    assert json.loads(path.read_text()) == {"SeriesNumber": 7}
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(tmp_path) == ["sidecar.json"]
+
+
+def test_write_json_atomic_new_file_follows_umask(tmp_path):
+    path = tmp_path / "manifest.json"
+
+    write_json_atomic(str(path), {})
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~UMASK